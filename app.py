@@ -1,8 +1,14 @@
-import copy
 import json
 import os
+import asyncio
+import math
+import tempfile
+import functools
 import logging
 import uuid
+from dataclasses import dataclass
+from datetime import datetime
+from types import MappingProxyType
 from dotenv import load_dotenv
 import httpx
 from quart import (
@@ -15,14 +21,49 @@ from quart import (
     render_template,
 )
 
-from openai import AsyncAzureOpenAI
-from azure.identity.aio import DefaultAzureCredential, get_bearer_token_provider
-from backend.auth.auth_utils import get_authenticated_user_details
-from backend.history.cosmosdbservice import CosmosConversationClient
+from openai import AsyncAzureOpenAI, DEFAULT_MAX_RETRIES
+from backend.auth.auth_utils import (
+    get_authenticated_user_details,
+    get_principal_groups,
+)
+from backend.credential import CredentialManager
+from backend.admission import AdmissionController, TokenBudget, TokenCounter
+from backend.completion_tokens import (
+    CompletionStats,
+    MeteredStream,
+    completion_token_limit,
+    model_context_length,
+    record_completion,
+)
+from backend.context_window import ContextWindow
+from backend.load_balancer import Backend, BackendPool
+from backend.scheduler import BACKGROUND, INTERACTIVE, PRIORITIES, PriorityScheduler
+from backend.history.cosmosdbservice import (
+    CosmosConversationClient,
+    InvalidContinuationTokenError,
+)
+from backend.request_logging import configure_logging, log_model_args
+from backend.semantic_cache import SemanticCache
+from backend.single_flight import SingleFlight, Subscription
+from backend.response_cache import (
+    ReplayStream,
+    RecordingStream,
+    ResponseCache,
+    answer_from_completion,
+    make_cache_key,
+    replay_completion,
+)
 
 from backend.utils import (
+    close_graph_client,
+    coalesce_stream_events,
+    format_as_compact_ndjson,
     format_as_ndjson,
+    format_compact_stream_frames,
+    format_stream_metadata,
     format_stream_response,
+    heuristic_title,
+    filter_cache_stats,
     generateFilterString,
     parse_multi_columns,
     format_non_streaming_response,
@@ -75,7 +116,7 @@ async def assets(path):
 # Debug settings
 DEBUG = os.environ.get("DEBUG", "false")
 if DEBUG.lower() == "true":
-    logging.basicConfig(level=logging.DEBUG)
+    configure_logging(level=logging.DEBUG)
 
 USER_AGENT = "GitHubSampleWebApp/AsyncAzureOpenAI/1.0.0"
 
@@ -118,6 +159,8 @@ AZURE_OPENAI_KEY = os.environ.get("AZURE_OPENAI_KEY")
 AZURE_OPENAI_TEMPERATURE = os.environ.get("AZURE_OPENAI_TEMPERATURE", 0)
 AZURE_OPENAI_TOP_P = os.environ.get("AZURE_OPENAI_TOP_P", 1.0)
 AZURE_OPENAI_MAX_TOKENS = os.environ.get("AZURE_OPENAI_MAX_TOKENS", 1000)
+AZURE_OPENAI_CONTEXT_LENGTH = os.environ.get("AZURE_OPENAI_CONTEXT_LENGTH")
+AZURE_OPENAI_PROMPT_TOKEN_RESERVE = os.environ.get("AZURE_OPENAI_PROMPT_TOKEN_RESERVE", 0)
 AZURE_OPENAI_STOP_SEQUENCE = os.environ.get("AZURE_OPENAI_STOP_SEQUENCE")
 AZURE_OPENAI_SYSTEM_MESSAGE = os.environ.get(
     "AZURE_OPENAI_SYSTEM_MESSAGE",
@@ -135,6 +178,58 @@ AZURE_OPENAI_EMBEDDING_ENDPOINT = os.environ.get("AZURE_OPENAI_EMBEDDING_ENDPOIN
 AZURE_OPENAI_EMBEDDING_KEY = os.environ.get("AZURE_OPENAI_EMBEDDING_KEY")
 AZURE_OPENAI_EMBEDDING_NAME = os.environ.get("AZURE_OPENAI_EMBEDDING_NAME", "")
 
+# AOAI connection pool settings
+AZURE_OPENAI_MAX_CONNECTIONS = os.environ.get("AZURE_OPENAI_MAX_CONNECTIONS", 100)
+AZURE_OPENAI_MAX_KEEPALIVE_CONNECTIONS = os.environ.get(
+    "AZURE_OPENAI_MAX_KEEPALIVE_CONNECTIONS", 20
+)
+AZURE_OPENAI_KEEPALIVE_EXPIRY = os.environ.get("AZURE_OPENAI_KEEPALIVE_EXPIRY", 30.0)
+AZURE_OPENAI_HTTP2 = os.environ.get("AZURE_OPENAI_HTTP2", "false").lower() == "true"
+
+# Azure OpenAI load balancing settings
+AZURE_OPENAI_BACKENDS = os.environ.get("AZURE_OPENAI_BACKENDS")
+AZURE_OPENAI_BACKEND_FAILURE_THRESHOLD = os.environ.get(
+    "AZURE_OPENAI_BACKEND_FAILURE_THRESHOLD", 5
+)
+AZURE_OPENAI_BACKEND_OPEN_SECONDS = os.environ.get("AZURE_OPENAI_BACKEND_OPEN_SECONDS", 30)
+AZURE_OPENAI_BACKEND_COOLDOWN_SECONDS = os.environ.get(
+    "AZURE_OPENAI_BACKEND_COOLDOWN_SECONDS", 10
+)
+AZURE_OPENAI_HEDGE_ENABLED = (
+    os.environ.get("AZURE_OPENAI_HEDGE_ENABLED", "false").lower() == "true"
+)
+AZURE_OPENAI_HEDGE_PERCENTILE = os.environ.get("AZURE_OPENAI_HEDGE_PERCENTILE", 95)
+AZURE_OPENAI_HEDGE_MIN_SAMPLES = os.environ.get("AZURE_OPENAI_HEDGE_MIN_SAMPLES", 20)
+
+# Upstream call scheduling settings
+AZURE_OPENAI_SCHEDULER_ENABLED = (
+    os.environ.get("AZURE_OPENAI_SCHEDULER_ENABLED", "false").lower() == "true"
+)
+AZURE_OPENAI_CONCURRENCY_LIMIT = os.environ.get("AZURE_OPENAI_CONCURRENCY_LIMIT", 32)
+AZURE_OPENAI_MAX_CONCURRENCY_LIMIT = os.environ.get("AZURE_OPENAI_MAX_CONCURRENCY_LIMIT", 256)
+AZURE_OPENAI_LATENCY_TARGET = os.environ.get("AZURE_OPENAI_LATENCY_TARGET", 10)
+AZURE_OPENAI_SCHEDULER_MAX_WAIT = os.environ.get("AZURE_OPENAI_SCHEDULER_MAX_WAIT", 10)
+REQUEST_PRIORITY_HEADER = "X-Request-Priority"
+
+# Token budget admission control settings
+AZURE_OPENAI_TOKENS_PER_MINUTE = os.environ.get("AZURE_OPENAI_TOKENS_PER_MINUTE")
+AZURE_OPENAI_ADMISSION_QUEUE_SIZE = os.environ.get("AZURE_OPENAI_ADMISSION_QUEUE_SIZE", 50)
+AZURE_OPENAI_ADMISSION_MAX_WAIT = os.environ.get("AZURE_OPENAI_ADMISSION_MAX_WAIT", 5)
+# gunicorn workers share their parent's pid, and with it the budget file
+AZURE_OPENAI_TOKEN_BUDGET_FILE = os.environ.get(
+    "AZURE_OPENAI_TOKEN_BUDGET_FILE",
+    os.path.join(tempfile.gettempdir(), f"aoai-token-budget-{os.getppid()}"),
+)
+
+# Conversation history window settings
+AZURE_OPENAI_HISTORY_TOKEN_BUDGET = os.environ.get("AZURE_OPENAI_HISTORY_TOKEN_BUDGET")
+AZURE_OPENAI_HISTORY_SUMMARY_MAX_TOKENS = os.environ.get(
+    "AZURE_OPENAI_HISTORY_SUMMARY_MAX_TOKENS", 256
+)
+AZURE_OPENAI_HISTORY_SUMMARY_CACHE_SIZE = os.environ.get(
+    "AZURE_OPENAI_HISTORY_SUMMARY_CACHE_SIZE", 1000
+)
+
 # CosmosDB Mongo vcore vector db Settings
 AZURE_COSMOSDB_MONGO_VCORE_CONNECTION_STRING = os.environ.get(
     "AZURE_COSMOSDB_MONGO_VCORE_CONNECTION_STRING"
@@ -172,6 +267,27 @@ AZURE_COSMOSDB_MONGO_VCORE_VECTOR_COLUMNS = os.environ.get(
 )
 
 SHOULD_STREAM = True if AZURE_OPENAI_STREAM.lower() == "true" else False
+AZURE_OPENAI_STREAM_COALESCE_MS = os.environ.get("AZURE_OPENAI_STREAM_COALESCE_MS", 25)
+AZURE_OPENAI_STREAM_COALESCE_BYTES = os.environ.get(
+    "AZURE_OPENAI_STREAM_COALESCE_BYTES", 1024
+)
+STREAM_FORMAT_HEADER = "X-Stream-Format"
+
+# Streamed answers that finished, and that were cut short by the client
+stream_stats = {"completed": 0, "cancelled": 0, "failed": 0, "estimated_tokens_saved": 0}
+COMPACT_STREAM_FORMAT = "compact"
+
+# Response cache settings
+RESPONSE_CACHE_ENABLED = os.environ.get("RESPONSE_CACHE_ENABLED", "false").lower() == "true"
+RESPONSE_CACHE_MAX_ENTRIES = os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", 1000)
+RESPONSE_CACHE_TTL = os.environ.get("RESPONSE_CACHE_TTL", 3600)
+CHAT_SINGLE_FLIGHT_ENABLED = (
+    os.environ.get("CHAT_SINGLE_FLIGHT_ENABLED", "true").lower() == "true"
+)
+SEMANTIC_CACHE_ENABLED = os.environ.get("SEMANTIC_CACHE_ENABLED", "false").lower() == "true"
+SEMANTIC_CACHE_THRESHOLD = os.environ.get("SEMANTIC_CACHE_THRESHOLD", 0.95)
+SEMANTIC_CACHE_PARTITION_SIZE = os.environ.get("SEMANTIC_CACHE_PARTITION_SIZE", 500)
+SEMANTIC_CACHE_MAX_PARTITIONS = os.environ.get("SEMANTIC_CACHE_MAX_PARTITIONS", 100)
 
 # Chat History CosmosDB Integration Settings
 AZURE_COSMOSDB_DATABASE = os.environ.get("AZURE_COSMOSDB_DATABASE")
@@ -183,6 +299,14 @@ AZURE_COSMOSDB_ACCOUNT_KEY = os.environ.get("AZURE_COSMOSDB_ACCOUNT_KEY")
 AZURE_COSMOSDB_ENABLE_FEEDBACK = (
     os.environ.get("AZURE_COSMOSDB_ENABLE_FEEDBACK", "false").lower() == "true"
 )
+AZURE_OPENAI_TITLE_TIMEOUT = os.environ.get("AZURE_OPENAI_TITLE_TIMEOUT", 5)
+AZURE_COSMOSDB_CONVERSATIONS_PAGE_SIZE = os.environ.get(
+    "AZURE_COSMOSDB_CONVERSATIONS_PAGE_SIZE", 25
+)
+AZURE_COSMOSDB_MESSAGES_PAGE_SIZE = os.environ.get("AZURE_COSMOSDB_MESSAGES_PAGE_SIZE", 100)
+# History pages are followed by passing this response header back as the
+# continuation_token parameter; it is absent on the last page
+CONTINUATION_TOKEN_HEADER = "X-Continuation-Token"
 
 # Elasticsearch Integration Settings
 ELASTICSEARCH_ENDPOINT = os.environ.get("ELASTICSEARCH_ENDPOINT")
@@ -307,8 +431,46 @@ def should_use_data():
 SHOULD_USE_DATA = should_use_data()
 
 
+AZURE_OPENAI_TOKEN_SCOPE = "https://cognitiveservices.azure.com/.default"
+
+# Azure AD credential shared by every client in this worker
+credential_manager = None
+
+
+def get_credential_manager():
+    global credential_manager
+    if credential_manager is None:
+        credential_manager = CredentialManager()
+    return credential_manager
+
+
+# Azure OpenAI deployments shared by every request served by this worker
+openai_backend_pool = None
+
+
+def init_openai_http_client():
+    http2 = AZURE_OPENAI_HTTP2
+    if http2:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            logging.warning(
+                "AZURE_OPENAI_HTTP2 is enabled but the h2 package is not installed, falling back to HTTP/1.1"
+            )
+            http2 = False
+
+    limits = httpx.Limits(
+        max_connections=int(AZURE_OPENAI_MAX_CONNECTIONS),
+        max_keepalive_connections=int(AZURE_OPENAI_MAX_KEEPALIVE_CONNECTIONS),
+        keepalive_expiry=float(AZURE_OPENAI_KEEPALIVE_EXPIRY),
+    )
+    return httpx.AsyncClient(limits=limits, http2=http2)
+
+
 # Initialize Azure OpenAI Client
-def init_openai_client(use_data=SHOULD_USE_DATA):
+def init_openai_client(
+    use_data=SHOULD_USE_DATA, endpoint=None, api_key=None, max_retries=DEFAULT_MAX_RETRIES
+):
     azure_openai_client = None
     try:
         # API version check
@@ -321,24 +483,26 @@ def init_openai_client(use_data=SHOULD_USE_DATA):
             )
 
         # Endpoint
-        if not AZURE_OPENAI_ENDPOINT and not AZURE_OPENAI_RESOURCE:
-            raise Exception(
-                "AZURE_OPENAI_ENDPOINT or AZURE_OPENAI_RESOURCE is required"
-            )
+        if not endpoint:
+            if not AZURE_OPENAI_ENDPOINT and not AZURE_OPENAI_RESOURCE:
+                raise Exception(
+                    "AZURE_OPENAI_ENDPOINT or AZURE_OPENAI_RESOURCE is required"
+                )
 
-        endpoint = (
-            AZURE_OPENAI_ENDPOINT
-            if AZURE_OPENAI_ENDPOINT
-            else f"https://{AZURE_OPENAI_RESOURCE}.openai.azure.com/"
-        )
+            endpoint = (
+                AZURE_OPENAI_ENDPOINT
+                if AZURE_OPENAI_ENDPOINT
+                else f"https://{AZURE_OPENAI_RESOURCE}.openai.azure.com/"
+            )
+            api_key = AZURE_OPENAI_KEY
 
         # Authentication
-        aoai_api_key = AZURE_OPENAI_KEY
+        aoai_api_key = api_key
         ad_token_provider = None
         if not aoai_api_key:
             logging.debug("No AZURE_OPENAI_KEY found, using Azure AD auth")
-            ad_token_provider = get_bearer_token_provider(
-                DefaultAzureCredential(), "https://cognitiveservices.azure.com/.default"
+            ad_token_provider = get_credential_manager().get_bearer_token_provider(
+                AZURE_OPENAI_TOKEN_SCOPE
             )
 
         # Deployment
@@ -355,6 +519,8 @@ def init_openai_client(use_data=SHOULD_USE_DATA):
             azure_ad_token_provider=ad_token_provider,
             default_headers=default_headers,
             azure_endpoint=endpoint,
+            http_client=init_openai_http_client(),
+            max_retries=max_retries,
         )
 
         return azure_openai_client
@@ -364,6 +530,100 @@ def init_openai_client(use_data=SHOULD_USE_DATA):
         raise e
 
 
+def openai_backend_configs():
+    if not AZURE_OPENAI_BACKENDS:
+        return [{"key": AZURE_OPENAI_KEY, "deployment": AZURE_OPENAI_MODEL}]
+
+    configs = json.loads(AZURE_OPENAI_BACKENDS)
+    for config in configs:
+        if not config.get("endpoint"):
+            raise ValueError("Every entry of AZURE_OPENAI_BACKENDS needs an endpoint")
+    return configs
+
+
+def init_openai_backend_pool():
+    configs = openai_backend_configs()
+    backends = []
+    for config in configs:
+        # With several backends the pool moves throttled calls to another
+        # deployment instead of retrying the same one
+        client = init_openai_client(
+            endpoint=config.get("endpoint"),
+            api_key=config.get("key"),
+            max_retries=0 if len(configs) > 1 else DEFAULT_MAX_RETRIES,
+        )
+        deployment = config.get("deployment") or AZURE_OPENAI_MODEL
+        backends.append(
+            Backend(
+                f"{client.base_url.host}/{deployment}",
+                client,
+                deployment,
+                weight=float(config.get("weight", 1)),
+            )
+        )
+
+    scheduler = None
+    if AZURE_OPENAI_SCHEDULER_ENABLED:
+        scheduler = PriorityScheduler(
+            initial_limit=int(AZURE_OPENAI_CONCURRENCY_LIMIT),
+            max_limit=int(AZURE_OPENAI_MAX_CONCURRENCY_LIMIT),
+            latency_target=float(AZURE_OPENAI_LATENCY_TARGET),
+            max_wait=float(AZURE_OPENAI_SCHEDULER_MAX_WAIT),
+        )
+
+    return BackendPool(
+        backends,
+        failure_threshold=int(AZURE_OPENAI_BACKEND_FAILURE_THRESHOLD),
+        open_seconds=float(AZURE_OPENAI_BACKEND_OPEN_SECONDS),
+        cooldown_seconds=float(AZURE_OPENAI_BACKEND_COOLDOWN_SECONDS),
+        scheduler=scheduler,
+    )
+
+
+def get_openai_backend_pool():
+    # The pool is normally created in the before_serving hook; create it
+    # lazily for callers that use this module without serving the app.
+    global openai_backend_pool
+    if openai_backend_pool is None:
+        openai_backend_pool = init_openai_backend_pool()
+    return openai_backend_pool
+
+
+# Tokenizer of the chat model, loaded once per worker
+token_counter = None
+
+
+def get_token_counter():
+    global token_counter
+    if token_counter is None:
+        token_counter = TokenCounter(AZURE_OPENAI_MODEL_NAME)
+    return token_counter
+
+
+# Token budget of the upstream calls of all workers
+admission_controller = None
+
+
+def get_admission_controller():
+    global admission_controller
+    if admission_controller is None and AZURE_OPENAI_TOKENS_PER_MINUTE:
+        admission_controller = AdmissionController(
+            TokenBudget(int(AZURE_OPENAI_TOKENS_PER_MINUTE), AZURE_OPENAI_TOKEN_BUDGET_FILE),
+            get_token_counter(),
+            queue_size=int(AZURE_OPENAI_ADMISSION_QUEUE_SIZE),
+            max_wait=float(AZURE_OPENAI_ADMISSION_MAX_WAIT),
+        )
+    return admission_controller
+
+
+async def admit_openai_call(messages, max_tokens):
+    # Waits until the call fits the token budget, or raises
+    # AdmissionRejectedError to shed it
+    controller = get_admission_controller()
+    if controller is not None:
+        await controller.admit(messages, max_tokens)
+
+
 def init_cosmosdb_client():
     cosmos_conversation_client = None
     if CHAT_HISTORY_ENABLED:
@@ -373,7 +633,7 @@ def init_cosmosdb_client():
             )
 
             if not AZURE_COSMOSDB_ACCOUNT_KEY:
-                credential = DefaultAzureCredential()
+                credential = get_credential_manager()
             else:
                 credential = AZURE_COSMOSDB_ACCOUNT_KEY
 
@@ -394,8 +654,148 @@ def init_cosmosdb_client():
     return cosmos_conversation_client
 
 
-def get_configured_data_source():
-    data_source = {}
+# Chat history CosmosDB client shared by every request served by this worker
+cosmos_conversation_client = None
+cosmos_conversation_client_ready = False
+
+
+def get_cosmosdb_client():
+    global cosmos_conversation_client
+    if cosmos_conversation_client is None:
+        cosmos_conversation_client = init_cosmosdb_client()
+    return cosmos_conversation_client
+
+
+async def ensure_cosmosdb_client():
+    # The database and container only need to be validated once per worker,
+    # after which readiness checks are answered without a round trip.
+    global cosmos_conversation_client_ready
+    cosmos_conversation_client = get_cosmosdb_client()
+    if not cosmos_conversation_client:
+        return False, None
+
+    if cosmos_conversation_client_ready:
+        return True, "CosmosDB client initialized successfully"
+
+    success, err = await cosmos_conversation_client.ensure()
+    cosmos_conversation_client_ready = success
+    return success, err
+
+
+@bp.before_app_serving
+async def init_clients():
+    global openai_backend_pool
+    # Fail fast on data source misconfiguration instead of on every request
+    if SHOULD_USE_DATA:
+        get_data_source_config()
+
+    try:
+        openai_backend_pool = init_openai_backend_pool()
+    except Exception:
+        # Surface configuration errors on the request path instead of
+        # preventing the frontend from being served.
+        openai_backend_pool = None
+
+    # Load the tokenizer before the first request needs it
+    get_token_counter()
+    get_admission_controller()
+    get_context_window()
+
+    # Prefetch the tokens the clients will need and keep them fresh
+    token_scopes = []
+    if openai_backend_pool is not None and not all(
+        config.get("key") for config in openai_backend_configs()
+    ):
+        token_scopes.append(AZURE_OPENAI_TOKEN_SCOPE)
+    if CHAT_HISTORY_ENABLED and not AZURE_COSMOSDB_ACCOUNT_KEY:
+        token_scopes.append(f"https://{AZURE_COSMOSDB_ACCOUNT}.documents.azure.com/.default")
+    if token_scopes:
+        await get_credential_manager().start(*token_scopes)
+
+    if CHAT_HISTORY_ENABLED:
+        try:
+            success, err = await ensure_cosmosdb_client()
+            if not success:
+                logging.warning(f"CosmosDB is not ready: {err}")
+        except Exception:
+            logging.exception("Exception in CosmosDB startup validation")
+
+
+# Work that outlives the request that started it, like saving a generated
+# conversation title
+background_tasks = set()
+
+
+def finish_background_task(task):
+    background_tasks.discard(task)
+    # Failures nobody waited for, e.g. when the completion failed first,
+    # would otherwise only be reported when the task is garbage collected
+    if not task.cancelled() and task.exception() is not None:
+        logging.error("Background task failed", exc_info=task.exception())
+
+
+def run_in_background(coro):
+    # Keeps a reference so the task isn't garbage collected before it is done
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(finish_background_task)
+    return task
+
+
+@bp.after_app_serving
+async def close_clients():
+    global openai_backend_pool, embedding_http_client, cosmos_conversation_client, cosmos_conversation_client_ready, credential_manager
+    # Let background work finish while the clients it needs are still open
+    if background_tasks:
+        await asyncio.gather(*background_tasks, return_exceptions=True)
+
+    if openai_backend_pool is not None:
+        await openai_backend_pool.close()
+        openai_backend_pool = None
+
+    if embedding_http_client is not None:
+        await embedding_http_client.aclose()
+        embedding_http_client = None
+
+    if cosmos_conversation_client is not None:
+        await cosmos_conversation_client.cosmosdb_client.close()
+        cosmos_conversation_client = None
+        cosmos_conversation_client_ready = False
+
+    if credential_manager is not None:
+        await credential_manager.close()
+        credential_manager = None
+
+    await close_graph_client()
+
+
+def int_setting(name, value, default):
+    value = value if value else default
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{name} must be an integer, got '{value}'")
+
+
+def columns_setting(value):
+    return parse_multi_columns(value) if value else []
+
+
+@dataclass(frozen=True)
+class DataSourceConfig:
+    type: str
+    parameters: MappingProxyType
+
+    def to_request(self, filter=None):
+        # Only the top-level parameters are copied; the nested settings are
+        # shared by every request and must not be modified.
+        parameters = dict(self.parameters)
+        if self.type == "azure_search":
+            parameters["filter"] = filter
+        return {"type": self.type, "parameters": parameters}
+
+
+def compile_data_source():
     query_type = "simple"
     if DATASOURCE_TYPE == "AzureCognitiveSearch":
         # Set query type
@@ -407,20 +807,6 @@ def get_configured_data_source():
         ):
             query_type = "semantic"
 
-        # Set filter
-        filter = None
-        userToken = None
-        if AZURE_SEARCH_PERMITTED_GROUPS_COLUMN:
-            userToken = request.headers.get("X-MS-TOKEN-AAD-ACCESS-TOKEN", "")
-            logging.debug(f"USER TOKEN is {'present' if userToken else 'not present'}")
-            if not userToken:
-                raise Exception(
-                    "Document-level access control is enabled, but user access token could not be fetched."
-                )
-
-            filter = generateFilterString(userToken)
-            logging.debug(f"FILTER: {filter}")
-
         # Set authentication
         authentication = {}
         if AZURE_SEARCH_KEY:
@@ -436,11 +822,7 @@ def get_configured_data_source():
                 "authentication": authentication,
                 "index_name": AZURE_SEARCH_INDEX,
                 "fields_mapping": {
-                    "content_fields": (
-                        parse_multi_columns(AZURE_SEARCH_CONTENT_COLUMNS)
-                        if AZURE_SEARCH_CONTENT_COLUMNS
-                        else []
-                    ),
+                    "content_fields": columns_setting(AZURE_SEARCH_CONTENT_COLUMNS),
                     "title_field": (
                         AZURE_SEARCH_TITLE_COLUMN if AZURE_SEARCH_TITLE_COLUMN else None
                     ),
@@ -452,17 +834,13 @@ def get_configured_data_source():
                         if AZURE_SEARCH_FILENAME_COLUMN
                         else None
                     ),
-                    "vector_fields": (
-                        parse_multi_columns(AZURE_SEARCH_VECTOR_COLUMNS)
-                        if AZURE_SEARCH_VECTOR_COLUMNS
-                        else []
-                    ),
+                    "vector_fields": columns_setting(AZURE_SEARCH_VECTOR_COLUMNS),
                 },
                 "in_scope": (
                     True if AZURE_SEARCH_ENABLE_IN_DOMAIN.lower() == "true" else False
                 ),
-                "top_n_documents": (
-                    int(AZURE_SEARCH_TOP_K) if AZURE_SEARCH_TOP_K else int(SEARCH_TOP_K)
+                "top_n_documents": int_setting(
+                    "AZURE_SEARCH_TOP_K", AZURE_SEARCH_TOP_K, SEARCH_TOP_K
                 ),
                 "query_type": query_type,
                 "semantic_configuration": (
@@ -471,11 +849,9 @@ def get_configured_data_source():
                     else ""
                 ),
                 "role_information": AZURE_OPENAI_SYSTEM_MESSAGE,
-                "filter": filter,
-                "strictness": (
-                    int(AZURE_SEARCH_STRICTNESS)
-                    if AZURE_SEARCH_STRICTNESS
-                    else int(SEARCH_STRICTNESS)
+                "filter": None,
+                "strictness": int_setting(
+                    "AZURE_SEARCH_STRICTNESS", AZURE_SEARCH_STRICTNESS, SEARCH_STRICTNESS
                 ),
             },
         }
@@ -493,10 +869,8 @@ def get_configured_data_source():
                 "database_name": AZURE_COSMOSDB_MONGO_VCORE_DATABASE,
                 "container_name": AZURE_COSMOSDB_MONGO_VCORE_CONTAINER,
                 "fields_mapping": {
-                    "content_fields": (
-                        parse_multi_columns(AZURE_COSMOSDB_MONGO_VCORE_CONTENT_COLUMNS)
-                        if AZURE_COSMOSDB_MONGO_VCORE_CONTENT_COLUMNS
-                        else []
+                    "content_fields": columns_setting(
+                        AZURE_COSMOSDB_MONGO_VCORE_CONTENT_COLUMNS
                     ),
                     "title_field": (
                         AZURE_COSMOSDB_MONGO_VCORE_TITLE_COLUMN
@@ -513,10 +887,8 @@ def get_configured_data_source():
                         if AZURE_COSMOSDB_MONGO_VCORE_FILENAME_COLUMN
                         else None
                     ),
-                    "vector_fields": (
-                        parse_multi_columns(AZURE_COSMOSDB_MONGO_VCORE_VECTOR_COLUMNS)
-                        if AZURE_COSMOSDB_MONGO_VCORE_VECTOR_COLUMNS
-                        else []
+                    "vector_fields": columns_setting(
+                        AZURE_COSMOSDB_MONGO_VCORE_VECTOR_COLUMNS
                     ),
                 },
                 "in_scope": (
@@ -524,15 +896,15 @@ def get_configured_data_source():
                     if AZURE_COSMOSDB_MONGO_VCORE_ENABLE_IN_DOMAIN.lower() == "true"
                     else False
                 ),
-                "top_n_documents": (
-                    int(AZURE_COSMOSDB_MONGO_VCORE_TOP_K)
-                    if AZURE_COSMOSDB_MONGO_VCORE_TOP_K
-                    else int(SEARCH_TOP_K)
+                "top_n_documents": int_setting(
+                    "AZURE_COSMOSDB_MONGO_VCORE_TOP_K",
+                    AZURE_COSMOSDB_MONGO_VCORE_TOP_K,
+                    SEARCH_TOP_K,
                 ),
-                "strictness": (
-                    int(AZURE_COSMOSDB_MONGO_VCORE_STRICTNESS)
-                    if AZURE_COSMOSDB_MONGO_VCORE_STRICTNESS
-                    else int(SEARCH_STRICTNESS)
+                "strictness": int_setting(
+                    "AZURE_COSMOSDB_MONGO_VCORE_STRICTNESS",
+                    AZURE_COSMOSDB_MONGO_VCORE_STRICTNESS,
+                    SEARCH_STRICTNESS,
                 ),
                 "query_type": query_type,
                 "role_information": AZURE_OPENAI_SYSTEM_MESSAGE,
@@ -552,11 +924,7 @@ def get_configured_data_source():
                 },
                 "index_name": ELASTICSEARCH_INDEX,
                 "fields_mapping": {
-                    "content_fields": (
-                        parse_multi_columns(ELASTICSEARCH_CONTENT_COLUMNS)
-                        if ELASTICSEARCH_CONTENT_COLUMNS
-                        else []
-                    ),
+                    "content_fields": columns_setting(ELASTICSEARCH_CONTENT_COLUMNS),
                     "title_field": (
                         ELASTICSEARCH_TITLE_COLUMN
                         if ELASTICSEARCH_TITLE_COLUMN
@@ -570,26 +938,18 @@ def get_configured_data_source():
                         if ELASTICSEARCH_FILENAME_COLUMN
                         else None
                     ),
-                    "vector_fields": (
-                        parse_multi_columns(ELASTICSEARCH_VECTOR_COLUMNS)
-                        if ELASTICSEARCH_VECTOR_COLUMNS
-                        else []
-                    ),
+                    "vector_fields": columns_setting(ELASTICSEARCH_VECTOR_COLUMNS),
                 },
                 "in_scope": (
                     True if ELASTICSEARCH_ENABLE_IN_DOMAIN.lower() == "true" else False
                 ),
-                "top_n_documents": (
-                    int(ELASTICSEARCH_TOP_K)
-                    if ELASTICSEARCH_TOP_K
-                    else int(SEARCH_TOP_K)
+                "top_n_documents": int_setting(
+                    "ELASTICSEARCH_TOP_K", ELASTICSEARCH_TOP_K, SEARCH_TOP_K
                 ),
                 "query_type": query_type,
                 "role_information": AZURE_OPENAI_SYSTEM_MESSAGE,
-                "strictness": (
-                    int(ELASTICSEARCH_STRICTNESS)
-                    if ELASTICSEARCH_STRICTNESS
-                    else int(SEARCH_STRICTNESS)
+                "strictness": int_setting(
+                    "ELASTICSEARCH_STRICTNESS", ELASTICSEARCH_STRICTNESS, SEARCH_STRICTNESS
                 ),
             },
         }
@@ -604,11 +964,7 @@ def get_configured_data_source():
                 "version": AZURE_MLINDEX_VERSION,
                 "project_resource_id": AZURE_ML_PROJECT_RESOURCE_ID,
                 "fieldsMapping": {
-                    "content_fields": (
-                        parse_multi_columns(AZURE_MLINDEX_CONTENT_COLUMNS)
-                        if AZURE_MLINDEX_CONTENT_COLUMNS
-                        else []
-                    ),
+                    "content_fields": columns_setting(AZURE_MLINDEX_CONTENT_COLUMNS),
                     "title_field": (
                         AZURE_MLINDEX_TITLE_COLUMN
                         if AZURE_MLINDEX_TITLE_COLUMN
@@ -622,26 +978,18 @@ def get_configured_data_source():
                         if AZURE_MLINDEX_FILENAME_COLUMN
                         else None
                     ),
-                    "vector_fields": (
-                        parse_multi_columns(AZURE_MLINDEX_VECTOR_COLUMNS)
-                        if AZURE_MLINDEX_VECTOR_COLUMNS
-                        else []
-                    ),
+                    "vector_fields": columns_setting(AZURE_MLINDEX_VECTOR_COLUMNS),
                 },
                 "in_scope": (
                     True if AZURE_MLINDEX_ENABLE_IN_DOMAIN.lower() == "true" else False
                 ),
-                "top_n_documents": (
-                    int(AZURE_MLINDEX_TOP_K)
-                    if AZURE_MLINDEX_TOP_K
-                    else int(SEARCH_TOP_K)
+                "top_n_documents": int_setting(
+                    "AZURE_MLINDEX_TOP_K", AZURE_MLINDEX_TOP_K, SEARCH_TOP_K
                 ),
                 "query_type": query_type,
                 "role_information": AZURE_OPENAI_SYSTEM_MESSAGE,
-                "strictness": (
-                    int(AZURE_MLINDEX_STRICTNESS)
-                    if AZURE_MLINDEX_STRICTNESS
-                    else int(SEARCH_STRICTNESS)
+                "strictness": int_setting(
+                    "AZURE_MLINDEX_STRICTNESS", AZURE_MLINDEX_STRICTNESS, SEARCH_STRICTNESS
                 ),
             },
         }
@@ -655,11 +1003,7 @@ def get_configured_data_source():
                 "authentication": {"type": "api_key", "key": PINECONE_API_KEY},
                 "index_name": PINECONE_INDEX_NAME,
                 "fields_mapping": {
-                    "content_fields": (
-                        parse_multi_columns(PINECONE_CONTENT_COLUMNS)
-                        if PINECONE_CONTENT_COLUMNS
-                        else []
-                    ),
+                    "content_fields": columns_setting(PINECONE_CONTENT_COLUMNS),
                     "title_field": (
                         PINECONE_TITLE_COLUMN if PINECONE_TITLE_COLUMN else None
                     ),
@@ -667,22 +1011,16 @@ def get_configured_data_source():
                     "filepath_field": (
                         PINECONE_FILENAME_COLUMN if PINECONE_FILENAME_COLUMN else None
                     ),
-                    "vector_fields": (
-                        parse_multi_columns(PINECONE_VECTOR_COLUMNS)
-                        if PINECONE_VECTOR_COLUMNS
-                        else []
-                    ),
+                    "vector_fields": columns_setting(PINECONE_VECTOR_COLUMNS),
                 },
                 "in_scope": (
                     True if PINECONE_ENABLE_IN_DOMAIN.lower() == "true" else False
                 ),
-                "top_n_documents": (
-                    int(PINECONE_TOP_K) if PINECONE_TOP_K else int(SEARCH_TOP_K)
+                "top_n_documents": int_setting(
+                    "PINECONE_TOP_K", PINECONE_TOP_K, SEARCH_TOP_K
                 ),
-                "strictness": (
-                    int(PINECONE_STRICTNESS)
-                    if PINECONE_STRICTNESS
-                    else int(SEARCH_STRICTNESS)
+                "strictness": int_setting(
+                    "PINECONE_STRICTNESS", PINECONE_STRICTNESS, SEARCH_STRICTNESS
                 ),
                 "query_type": query_type,
                 "role_information": AZURE_OPENAI_SYSTEM_MESSAGE,
@@ -720,23 +1058,141 @@ def get_configured_data_source():
             )
         data_source["parameters"]["embedding_dependency"] = embeddingDependency
 
-    return data_source
+    return DataSourceConfig(
+        type=data_source["type"],
+        parameters=MappingProxyType(data_source["parameters"]),
+    )
+
+
+# Data source settings compiled once per worker
+data_source_config = None
+
+
+def get_data_source_config():
+    global data_source_config
+    if data_source_config is None:
+        data_source_config = compile_data_source()
+    return data_source_config
+
+
+async def get_configured_data_source():
+    data_source_config = get_data_source_config()
+
+    # Set filter
+    filter = None
+    if (
+        data_source_config.type == "azure_search"
+        and AZURE_SEARCH_PERMITTED_GROUPS_COLUMN
+    ):
+        # Prefer the groups claims EasyAuth already passed along and only
+        # fall back to Microsoft Graph when the token doesn't carry them
+        group_ids = get_principal_groups(
+            request.headers.get("X-Ms-Client-Principal")
+        )
+        logging.debug(
+            f"USER GROUPS are {'present' if group_ids is not None else 'not present'} in the client principal"
+        )
+
+        userToken = request.headers.get("X-MS-TOKEN-AAD-ACCESS-TOKEN", "")
+        logging.debug(f"USER TOKEN is {'present' if userToken else 'not present'}")
+        if group_ids is None and not userToken:
+            raise Exception(
+                "Document-level access control is enabled, but user access token could not be fetched."
+            )
+
+        # EasyAuth sets the principal id to the user's AAD object id
+        user_id = request.headers.get("X-Ms-Client-Principal-Id")
+        filter = await generateFilterString(userToken, user_id, group_ids)
+        logging.debug(f"FILTER: {filter}")
+
+    return data_source_config.to_request(filter)
+
+
+SUMMARY_PROMPT = "Summarize the conversation below for yourself, so you can continue it without the full transcript. Keep the facts, names, numbers, decisions and open questions, and leave out pleasantries. If a previous summary is given, extend it with the new messages. Respond with the summary only."
+
+
+async def summarize_conversation(summary, messages):
+    transcript = "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+    if summary:
+        transcript = f"Previous summary: {summary}\n\n{transcript}"
+    summary_messages = [
+        {"role": "system", "content": SUMMARY_PROMPT},
+        {"role": "user", "content": transcript},
+    ]
+    max_tokens = int(AZURE_OPENAI_HISTORY_SUMMARY_MAX_TOKENS)
+
+    await admit_openai_call(summary_messages, max_tokens)
+    response = await get_openai_backend_pool().call(
+        lambda backend: backend.client.chat.completions.create(
+            model=backend.deployment,
+            messages=summary_messages,
+            temperature=0,
+            max_tokens=max_tokens,
+        )
+    )
+    return response.choices[0].message.content
+
+
+# Keeps long conversations within AZURE_OPENAI_HISTORY_TOKEN_BUDGET
+context_window = None
+
+
+def get_context_window():
+    global context_window
+    if context_window is None and AZURE_OPENAI_HISTORY_TOKEN_BUDGET:
+        context_window = ContextWindow(
+            get_token_counter(),
+            summarize_conversation,
+            int(AZURE_OPENAI_HISTORY_TOKEN_BUDGET),
+            cache_size=int(AZURE_OPENAI_HISTORY_SUMMARY_CACHE_SIZE),
+        )
+    return context_window
+
 
+# Lengths of the completions received by this worker
+completion_stats = CompletionStats()
 
-def prepare_model_args(request_body):
+
+def max_completion_tokens(messages):
+    context_length = (
+        int(AZURE_OPENAI_CONTEXT_LENGTH)
+        if AZURE_OPENAI_CONTEXT_LENGTH
+        else model_context_length(AZURE_OPENAI_MODEL_NAME)
+    )
+    if not context_length:
+        return int(AZURE_OPENAI_MAX_TOKENS)
+
+    counter = get_token_counter()
+    prompt_tokens = counter.count_messages(messages) + int(AZURE_OPENAI_PROMPT_TOKEN_RESERVE)
+    if SHOULD_USE_DATA:
+        # The system message is sent as the data source's role information
+        prompt_tokens += counter.count_text(AZURE_OPENAI_SYSTEM_MESSAGE)
+    return completion_token_limit(context_length, prompt_tokens, int(AZURE_OPENAI_MAX_TOKENS))
+
+
+async def prepare_model_args(request_body):
     request_messages = request_body.get("messages", [])
     messages = []
     if not SHOULD_USE_DATA:
         messages = [{"role": "system", "content": AZURE_OPENAI_SYSTEM_MESSAGE}]
 
-    for message in request_messages:
-        if message:
-            messages.append({"role": message["role"], "content": message["content"]})
+    history = [
+        {"role": message["role"], "content": message["content"]}
+        for message in request_messages
+        if message
+    ]
+    window = get_context_window()
+    if window is not None and history:
+        conversation_id = request_body.get("history_metadata", {}).get(
+            "conversation_id"
+        ) or request_body.get("conversation_id")
+        history = await window.apply(conversation_id, history)
+    messages.extend(history)
 
     model_args = {
         "messages": messages,
         "temperature": float(AZURE_OPENAI_TEMPERATURE),
-        "max_tokens": int(AZURE_OPENAI_MAX_TOKENS),
+        "max_tokens": max_completion_tokens(messages),
         "top_p": float(AZURE_OPENAI_TOP_P),
         "stop": (
             parse_multi_columns(AZURE_OPENAI_STOP_SEQUENCE)
@@ -748,43 +1204,11 @@ def prepare_model_args(request_body):
     }
 
     if SHOULD_USE_DATA:
-        model_args["extra_body"] = {"data_sources": [get_configured_data_source()]}
-
-    model_args_clean = copy.deepcopy(model_args)
-    if model_args_clean.get("extra_body"):
-        secret_params = [
-            "key",
-            "connection_string",
-            "embedding_key",
-            "encoded_api_key",
-            "api_key",
-        ]
-        for secret_param in secret_params:
-            if model_args_clean["extra_body"]["data_sources"][0]["parameters"].get(
-                secret_param
-            ):
-                model_args_clean["extra_body"]["data_sources"][0]["parameters"][
-                    secret_param
-                ] = "*****"
-        authentication = model_args_clean["extra_body"]["data_sources"][0][
-            "parameters"
-        ].get("authentication", {})
-        for field in authentication:
-            if field in secret_params:
-                model_args_clean["extra_body"]["data_sources"][0]["parameters"][
-                    "authentication"
-                ][field] = "*****"
-        embeddingDependency = model_args_clean["extra_body"]["data_sources"][0][
-            "parameters"
-        ].get("embedding_dependency", {})
-        if "authentication" in embeddingDependency:
-            for field in embeddingDependency["authentication"]:
-                if field in secret_params:
-                    model_args_clean["extra_body"]["data_sources"][0]["parameters"][
-                        "embedding_dependency"
-                    ]["authentication"][field] = "*****"
-
-    logging.debug(f"REQUEST BODY: {json.dumps(model_args_clean, indent=4)}")
+        model_args["extra_body"] = {
+            "data_sources": [await get_configured_data_source()]
+        }
+
+    log_model_args(model_args)
 
     return model_args
 
@@ -822,67 +1246,304 @@ async def promptflow_request(request):
         logging.error(f"An error occurred while making promptflow_request: {e}")
 
 
-async def send_chat_request(request):
-    filtered_messages = []
-    messages = request.get("messages", [])
-    for message in messages:
-        if message.get("role") != 'tool':
-            filtered_messages.append(message)
-            
-    request['messages'] = filtered_messages
-    model_args = prepare_model_args(request)
+# Answers cached per worker, keyed on the full model request
+response_cache = (
+    ResponseCache(int(RESPONSE_CACHE_MAX_ENTRIES), float(RESPONSE_CACHE_TTL))
+    if RESPONSE_CACHE_ENABLED
+    else None
+)
+
+# Client for an embedding deployment configured by its full endpoint URL
+embedding_http_client = None
+
+
+async def embed_with_azure_openai(text):
+    if AZURE_OPENAI_EMBEDDING_NAME:
+        response = await get_openai_backend_pool().call(
+            lambda backend: backend.client.embeddings.create(
+                model=AZURE_OPENAI_EMBEDDING_NAME, input=text
+            )
+        )
+        return response.data[0].embedding
+
+    global embedding_http_client
+    if embedding_http_client is None:
+        embedding_http_client = init_openai_http_client()
+    response = await embedding_http_client.post(
+        AZURE_OPENAI_EMBEDDING_ENDPOINT,
+        headers={"api-key": AZURE_OPENAI_EMBEDDING_KEY},
+        json={"input": text},
+    )
+    response.raise_for_status()
+    return response.json()["data"][0]["embedding"]
+
+
+# Answers to paraphrased questions, matched on the question embedding
+semantic_cache = (
+    SemanticCache(
+        embed_with_azure_openai,
+        threshold=float(SEMANTIC_CACHE_THRESHOLD),
+        ttl=float(RESPONSE_CACHE_TTL),
+        partition_size=int(SEMANTIC_CACHE_PARTITION_SIZE),
+        max_partitions=int(SEMANTIC_CACHE_MAX_PARTITIONS),
+    )
+    if SEMANTIC_CACHE_ENABLED
+    and (
+        AZURE_OPENAI_EMBEDDING_NAME
+        or (AZURE_OPENAI_EMBEDDING_ENDPOINT and AZURE_OPENAI_EMBEDDING_KEY)
+    )
+    else None
+)
+
+
+# Upstream calls shared by identical concurrent requests
+chat_single_flight = SingleFlight() if CHAT_SINGLE_FLIGHT_ENABLED else None
+
+
+def semantic_cache_question(model_args):
+    # Follow-up questions depend on the earlier turns, so only the first
+    # question of a conversation is looked up by meaning
+    user_messages = [m for m in model_args["messages"] if m["role"] == "user"]
+    if len(user_messages) != 1 or model_args["messages"][-1] is not user_messages[0]:
+        return None
+    question = user_messages[0]["content"]
+    return question if isinstance(question, str) and question.strip() else None
+
+
+async def get_cached_answer(model_args, cache_key):
+    # Returns a cached answer, or the callbacks that store the answer to
+    # this request once it has been received
+    stores = []
+    if response_cache is not None:
+        answer = response_cache.get(cache_key)
+        if answer:
+            return answer, stores
+        stores.append(functools.partial(response_cache.put, cache_key))
+
+    question = semantic_cache_question(model_args) if semantic_cache else None
+    if question:
+        embedding = await semantic_cache.embed_question(question)
+        if embedding is not None:
+            # Everything but the question itself, including the security
+            # filter, selects the partition
+            partition_key = make_cache_key(
+                {**model_args, "messages": model_args["messages"][:-1]}
+            )
+            answer = semantic_cache.get(partition_key, embedding)
+            if answer:
+                return answer, stores
+            stores.append(functools.partial(semantic_cache.put, partition_key, embedding))
+
+    return None, stores
+
+
+async def create_chat_completion(model_args, cache_stores, priority):
+    await admit_openai_call(model_args["messages"], model_args.get("max_tokens"))
+
+    def request(backend):
+        return backend.client.chat.completions.with_raw_response.create(
+            **{**model_args, "model": backend.deployment}
+        )
+
+    def allow_hedge():
+        # A duplicate request is charged to the token budget as well
+        controller = get_admission_controller()
+        return controller is None or controller.try_admit(
+            model_args["messages"], model_args["max_tokens"]
+        )
 
     try:
-        azure_openai_client = init_openai_client()
-        raw_response = await azure_openai_client.chat.completions.with_raw_response.create(**model_args)
+        if AZURE_OPENAI_HEDGE_ENABLED and not model_args["stream"]:
+            raw_response = await get_openai_backend_pool().hedged_call(
+                request,
+                percentile=float(AZURE_OPENAI_HEDGE_PERCENTILE),
+                min_samples=int(AZURE_OPENAI_HEDGE_MIN_SAMPLES),
+                allow_hedge=allow_hedge,
+                priority=priority,
+            )
+        else:
+            raw_response = await get_openai_backend_pool().call(request, priority=priority)
         response = raw_response.parse()
         apim_request_id = raw_response.headers.get("apim-request-id") 
     except Exception as e:
         logging.exception("Exception in send_chat_request")
         raise e
 
+    if model_args["stream"]:
+        response = MeteredStream(response, completion_stats, model_args["max_tokens"])
+    else:
+        record_completion(
+            completion_stats, response, model_args["max_tokens"], get_token_counter()
+        )
+
+    if cache_stores:
+        def store_answer(answer):
+            for store in cache_stores:
+                store(answer)
+
+        # Only answers that were received in full are cached
+        if model_args["stream"]:
+            response = RecordingStream(response, store_answer)
+        else:
+            store_answer(answer_from_completion(response))
+
     return response, apim_request_id
 
 
-async def complete_chat_request(request_body):
+async def prepare_chat_request(request):
+    filtered_messages = []
+    messages = request.get("messages", [])
+    for message in messages:
+        if message.get("role") != 'tool':
+            filtered_messages.append(message)
+            
+    request['messages'] = filtered_messages
+    return await prepare_model_args(request)
+
+
+async def send_chat_request(model_args, priority=INTERACTIVE):
+    request_key = make_cache_key(model_args)
+
+    answer, cache_stores = await get_cached_answer(model_args, request_key)
+    if answer:
+        if model_args["stream"]:
+            return ReplayStream(answer), None
+        return replay_completion(answer), None
+
+    start = functools.partial(create_chat_completion, model_args, cache_stores, priority)
+    if chat_single_flight is None:
+        return await start()
+
+    # Identical requests in flight at the same time share one completion
+    if model_args["stream"]:
+        return await chat_single_flight.stream(request_key, start)
+    return await chat_single_flight.complete(request_key, start)
+
+
+async def complete_chat_request(request_body, priority=INTERACTIVE, finalize=None):
+    # finalize is awaited once the answer is complete and returns history
+    # metadata that is only known by then, or None
     if USE_PROMPTFLOW and PROMPTFLOW_ENDPOINT and PROMPTFLOW_API_KEY:
         response = await promptflow_request(request_body)
         history_metadata = request_body.get("history_metadata", {})
+        if finalize is not None:
+            history_metadata = {**history_metadata, **(await finalize() or {})}
         return format_pf_non_streaming_response(
             response, history_metadata, PROMPTFLOW_RESPONSE_FIELD_NAME, PROMPTFLOW_CITATIONS_FIELD_NAME
         )
     else:
-        response, apim_request_id = await send_chat_request(request_body)
+        model_args = await prepare_chat_request(request_body)
+        response, apim_request_id = await send_chat_request(model_args, priority)
         history_metadata = request_body.get("history_metadata", {})
+        if finalize is not None:
+            history_metadata = {**history_metadata, **(await finalize() or {})}
         return format_non_streaming_response(response, history_metadata, apim_request_id)
 
 
-async def stream_chat_request(request_body):
-    response, apim_request_id = await send_chat_request(request_body)
+async def close_upstream_stream(response, completed, cancelled, deltas, max_tokens):
+    # Closing the upstream response ends the completion and frees the
+    # pooled connection. Replayed answers have no upstream response, and a
+    # shared completion only stops when its last subscriber leaves.
+    upstream = getattr(response, "response", None)
+    stopped = False
+    if isinstance(upstream, Subscription):
+        stopped = await upstream.aclose()
+    elif upstream is not None:
+        await upstream.aclose()
+        stopped = True
+
+    if completed:
+        stream_stats["completed"] += 1
+    elif not cancelled:
+        stream_stats["failed"] += 1
+    elif stopped:
+        # The client went away before the answer was complete. Each delta is
+        # roughly one token, so what was left of the request's answer budget
+        # is an upper bound of the tokens saved by stopping the completion.
+        stream_stats["cancelled"] += 1
+        stream_stats["estimated_tokens_saved"] += max(max_tokens - deltas, 0)
+        logging.debug(f"Stream cancelled by the client after {deltas} deltas")
+
+
+async def stream_chat_request(request_body, compact=False, priority=INTERACTIVE, finalize=None):
+    model_args = await prepare_chat_request(request_body)
+    response, apim_request_id = await send_chat_request(model_args, priority)
     history_metadata = request_body.get("history_metadata", {})
-    
+
     async def generate():
-        async for completionChunk in response:
-            yield format_stream_response(completionChunk, history_metadata, apim_request_id)
+        header_id = None
+        completed = False
+        cancelled = False
+        deltas = 0
+        try:
+            async for completionChunk in response:
+                deltas += 1
+                if not compact:
+                    yield format_stream_response(
+                        completionChunk, history_metadata, apim_request_id
+                    )
+                    continue
+
+                frames, header_id = format_compact_stream_frames(
+                    completionChunk, header_id, history_metadata, apim_request_id
+                )
+                for frame in frames:
+                    yield frame
+            completed = True
+        except (asyncio.CancelledError, GeneratorExit):
+            # The client disconnected
+            cancelled = True
+            raise
+        finally:
+            await close_upstream_stream(
+                response, completed, cancelled, deltas, model_args["max_tokens"]
+            )
+
+        if finalize is not None:
+            metadata = await finalize()
+            if metadata:
+                yield format_stream_metadata({**history_metadata, **metadata})
 
     return generate()
 
 
-async def conversation_internal(request_body):
+async def conversation_internal(request_body, finalize=None):
+    # Integrations can run their requests at a lower priority
+    priority = PRIORITIES.get(
+        request.headers.get(REQUEST_PRIORITY_HEADER, "").lower(), INTERACTIVE
+    )
     try:
         if SHOULD_STREAM:
-            result = await stream_chat_request(request_body)
-            response = await make_response(format_as_ndjson(result))
+            # Quart cancels the response when the client disconnects; closing
+            # the stream chain then closes the upstream completion as well.
+            # Clients opt in to the compact stream format with this header
+            compact = request.headers.get(STREAM_FORMAT_HEADER) == COMPACT_STREAM_FORMAT
+            result = await stream_chat_request(
+                request_body, compact=compact, priority=priority, finalize=finalize
+            )
+            result = coalesce_stream_events(
+                result,
+                float(AZURE_OPENAI_STREAM_COALESCE_MS),
+                int(AZURE_OPENAI_STREAM_COALESCE_BYTES),
+            )
+            if compact:
+                response = await make_response(format_as_compact_ndjson(result))
+                response.headers[STREAM_FORMAT_HEADER] = COMPACT_STREAM_FORMAT
+            else:
+                response = await make_response(format_as_ndjson(result))
             response.timeout = None
             response.mimetype = "application/json-lines"
             return response
         else:
-            result = await complete_chat_request(request_body)
+            result = await complete_chat_request(request_body, priority, finalize=finalize)
             return jsonify(result)
 
     except Exception as ex:
         logging.exception(ex)
-        if hasattr(ex, "status_code"):
+        if hasattr(ex, "retry_after"):
+            headers = {"Retry-After": str(math.ceil(ex.retry_after))}
+            return jsonify({"error": str(ex)}), ex.status_code, headers
+        elif hasattr(ex, "status_code"):
             return jsonify({"error": str(ex)}), ex.status_code
         else:
             return jsonify({"error": str(ex)}), 500
@@ -897,6 +1558,52 @@ async def conversation():
     return await conversation_internal(request_json)
 
 
+@bp.route("/metrics", methods=["GET"])
+async def get_metrics():
+    metrics = {}
+    if credential_manager is not None:
+        metrics["credential"] = credential_manager.stats()
+    if AZURE_SEARCH_PERMITTED_GROUPS_COLUMN:
+        metrics["search_filter_cache"] = filter_cache_stats
+    metrics["streams"] = stream_stats
+    if cosmos_conversation_client is not None:
+        metrics["cosmosdb"] = cosmos_conversation_client.stats()
+    metrics["completions"] = completion_stats.snapshot()
+    if context_window is not None:
+        metrics["context_window"] = {
+            **context_window.stats,
+            "cached_summaries": len(context_window.summaries),
+        }
+    if admission_controller is not None:
+        metrics["admission"] = {
+            **admission_controller.stats,
+            "waiting": admission_controller.waiting,
+        }
+    if openai_backend_pool is not None:
+        metrics["openai_backends"] = openai_backend_pool.stats()
+        if AZURE_OPENAI_HEDGE_ENABLED:
+            metrics["hedging"] = openai_backend_pool.hedging_stats()
+        if openai_backend_pool.scheduler is not None:
+            metrics["scheduler"] = openai_backend_pool.scheduler.snapshot()
+    if response_cache is not None:
+        metrics["response_cache"] = {
+            **response_cache.stats,
+            "entries": len(response_cache.entries),
+        }
+    if chat_single_flight is not None:
+        metrics["single_flight"] = {
+            **chat_single_flight.stats,
+            "in_flight": len(chat_single_flight.flights) + len(chat_single_flight.tasks),
+        }
+    if semantic_cache is not None:
+        metrics["semantic_cache"] = {
+            **semantic_cache.stats,
+            "entries": semantic_cache.entries(),
+            "partitions": len(semantic_cache.partitions),
+        }
+    return jsonify(metrics), 200
+
+
 @bp.route("/frontend_settings", methods=["GET"])
 def get_frontend_settings():
     try:
@@ -918,30 +1625,42 @@ async def add_conversation():
 
     try:
         # make sure cosmos is configured
-        cosmos_conversation_client = init_cosmosdb_client()
+        cosmos_conversation_client = get_cosmosdb_client()
         if not cosmos_conversation_client:
             raise Exception("CosmosDB is not configured or not working")
 
+        messages = request_json["messages"]
+        if not (len(messages) > 0 and messages[-1]["role"] == "user"):
+            raise Exception("No user message found")
+
         # check for the conversation_id, if the conversation is not set, we will create a new one
         history_metadata = {}
-        if not conversation_id:
-            title = await generate_title(request_json["messages"])
-            conversation_dict = await cosmos_conversation_client.create_conversation(
-                user_id=user_id, title=title
-            )
-            conversation_id = conversation_dict["id"]
-            history_metadata["title"] = title
-            history_metadata["date"] = conversation_dict["createdAt"]
-
-        ## Format the incoming message object in the "chat/completions" messages format
-        ## then write it to the conversation history in cosmos
-        messages = request_json["messages"]
-        if len(messages) > 0 and messages[-1]["role"] == "user":
-            createdMessageValue = await cosmos_conversation_client.create_message(
-                uuid=str(uuid.uuid4()),
+        new_conversation = not conversation_id
+        if new_conversation:
+            # The conversation starts out with a title taken from the question;
+            # the generated title replaces it while the answer streams and is
+            # sent to the client after the answer
+            conversation_id = str(uuid.uuid4())
+            history_metadata["title"] = heuristic_title(messages)
+            history_metadata["date"] = datetime.utcnow().isoformat()
+
+        async def save_question():
+            ## Format the incoming message object in the "chat/completions" messages format
+            ## then write it to the conversation history in cosmos, in the same
+            ## batch as a new conversation
+            conversation = None
+            if new_conversation:
+                conversation = cosmos_conversation_client.conversation_document(
+                    user_id=user_id,
+                    title=history_metadata["title"],
+                    conversation_id=conversation_id,
+                    created_at=history_metadata["date"],
+                )
+            createdMessageValue = await cosmos_conversation_client.create_messages(
                 conversation_id=conversation_id,
                 user_id=user_id,
-                input_message=messages[-1],
+                input_messages=[(str(uuid.uuid4()), messages[-1])],
+                conversation=conversation,
             )
             if createdMessageValue == "Conversation not found":
                 raise Exception(
@@ -949,16 +1668,31 @@ async def add_conversation():
                     + conversation_id
                     + "."
                 )
-        else:
-            raise Exception("No user message found")
 
-        await cosmos_conversation_client.cosmosdb_client.close()
+        # The question is saved while the completion starts, rather than
+        # before it, and runs to the end even if the client leaves
+        history_task = run_in_background(save_question())
+        title_task = None
+        if new_conversation:
+            title_task = run_in_background(
+                update_generated_title(
+                    user_id, conversation_id, messages, history_metadata["title"], history_task
+                )
+            )
+
+        async def finalize():
+            # The answer only ends once the question is saved; a failed write
+            # is reported as the last frame of the stream
+            await asyncio.shield(history_task)
+            if title_task is None:
+                return None
+            generated_title = await asyncio.shield(title_task)
+            return {"title": generated_title} if generated_title else None
 
         # Submit request to Chat Completions for response
-        request_body = await request.get_json()
         history_metadata["conversation_id"] = conversation_id
-        request_body["history_metadata"] = history_metadata
-        return await conversation_internal(request_body)
+        request_json["history_metadata"] = history_metadata
+        return await conversation_internal(request_json, finalize=finalize)
 
     except Exception as e:
         logging.exception("Exception in /history/generate")
@@ -976,7 +1710,7 @@ async def update_conversation():
 
     try:
         # make sure cosmos is configured
-        cosmos_conversation_client = init_cosmosdb_client()
+        cosmos_conversation_client = get_cosmosdb_client()
         if not cosmos_conversation_client:
             raise Exception("CosmosDB is not configured or not working")
 
@@ -988,26 +1722,24 @@ async def update_conversation():
         ## then write it to the conversation history in cosmos
         messages = request_json["messages"]
         if len(messages) > 0 and messages[-1]["role"] == "assistant":
+            # write the tool message first, then the assistant message, in a single batch
+            new_messages = [(messages[-1]["id"], messages[-1])]
             if len(messages) > 1 and messages[-2].get("role", None) == "tool":
-                # write the tool message first
-                await cosmos_conversation_client.create_message(
-                    uuid=str(uuid.uuid4()),
-                    conversation_id=conversation_id,
-                    user_id=user_id,
-                    input_message=messages[-2],
-                )
-            # write the assistant message
-            await cosmos_conversation_client.create_message(
-                uuid=messages[-1]["id"],
+                new_messages.insert(0, (str(uuid.uuid4()), messages[-2]))
+            createdMessageValue = await cosmos_conversation_client.create_messages(
                 conversation_id=conversation_id,
                 user_id=user_id,
-                input_message=messages[-1],
+                input_messages=new_messages,
             )
+            if createdMessageValue == "Conversation not found":
+                raise Exception(
+                    "Conversation not found for the given conversation ID: "
+                    + conversation_id
+                    + "."
+                )
         else:
             raise Exception("No bot messages found")
 
-        # Submit request to Chat Completions for response
-        await cosmos_conversation_client.cosmosdb_client.close()
         response = {"success": True}
         return jsonify(response), 200
 
@@ -1020,7 +1752,7 @@ async def update_conversation():
 async def update_message():
     authenticated_user = get_authenticated_user_details(request_headers=request.headers)
     user_id = authenticated_user["user_principal_id"]
-    cosmos_conversation_client = init_cosmosdb_client()
+    cosmos_conversation_client = get_cosmosdb_client()
 
     ## check request for message_id
     request_json = await request.get_json()
@@ -1077,22 +1809,15 @@ async def delete_conversation():
             return jsonify({"error": "conversation_id is required"}), 400
 
         ## make sure cosmos is configured
-        cosmos_conversation_client = init_cosmosdb_client()
+        cosmos_conversation_client = get_cosmosdb_client()
         if not cosmos_conversation_client:
             raise Exception("CosmosDB is not configured or not working")
 
-        ## delete the conversation messages from cosmos first
-        deleted_messages = await cosmos_conversation_client.delete_messages(
-            conversation_id, user_id
-        )
-
-        ## Now delete the conversation
+        ## delete the conversation and its messages from cosmos
         deleted_conversation = await cosmos_conversation_client.delete_conversation(
             user_id, conversation_id
         )
 
-        await cosmos_conversation_client.cosmosdb_client.close()
-
         return (
             jsonify(
                 {
@@ -1109,26 +1834,30 @@ async def delete_conversation():
 
 @bp.route("/history/list", methods=["GET"])
 async def list_conversations():
-    offset = request.args.get("offset", 0)
+    continuation_token = request.args.get("continuation_token")
     authenticated_user = get_authenticated_user_details(request_headers=request.headers)
     user_id = authenticated_user["user_principal_id"]
 
     ## make sure cosmos is configured
-    cosmos_conversation_client = init_cosmosdb_client()
+    cosmos_conversation_client = get_cosmosdb_client()
     if not cosmos_conversation_client:
         raise Exception("CosmosDB is not configured or not working")
 
-    ## get the conversations from cosmos
-    conversations = await cosmos_conversation_client.get_conversations(
-        user_id, offset=offset, limit=25
-    )
-    await cosmos_conversation_client.cosmosdb_client.close()
+    ## get a page of conversations from cosmos
+    try:
+        conversations, continuation_token = await cosmos_conversation_client.get_conversations_page(
+            user_id,
+            page_size=int(AZURE_COSMOSDB_CONVERSATIONS_PAGE_SIZE),
+            cursor=continuation_token,
+        )
+    except InvalidContinuationTokenError as e:
+        return jsonify({"error": str(e)}), 400
     if not isinstance(conversations, list):
         return jsonify({"error": f"No conversations for {user_id} were found"}), 404
 
     ## return the conversation ids
-
-    return jsonify(conversations), 200
+    headers = {CONTINUATION_TOKEN_HEADER: continuation_token} if continuation_token else {}
+    return jsonify(conversations), 200, headers
 
 
 @bp.route("/history/read", methods=["POST"])
@@ -1144,7 +1873,7 @@ async def get_conversation():
         return jsonify({"error": "conversation_id is required"}), 400
 
     ## make sure cosmos is configured
-    cosmos_conversation_client = init_cosmosdb_client()
+    cosmos_conversation_client = get_cosmosdb_client()
     if not cosmos_conversation_client:
         raise Exception("CosmosDB is not configured or not working")
 
@@ -1163,10 +1892,16 @@ async def get_conversation():
             404,
         )
 
-    # get the messages for the conversation from cosmos
-    conversation_messages = await cosmos_conversation_client.get_messages(
-        user_id, conversation_id
-    )
+    # get a page of the messages for the conversation from cosmos
+    try:
+        conversation_messages, continuation_token = await cosmos_conversation_client.get_messages_page(
+            user_id,
+            conversation_id,
+            page_size=int(AZURE_COSMOSDB_MESSAGES_PAGE_SIZE),
+            cursor=request_json.get("continuation_token"),
+        )
+    except InvalidContinuationTokenError as e:
+        return jsonify({"error": str(e)}), 400
 
     ## format the messages in the bot frontend format
     messages = [
@@ -1180,8 +1915,8 @@ async def get_conversation():
         for msg in conversation_messages
     ]
 
-    await cosmos_conversation_client.cosmosdb_client.close()
-    return jsonify({"conversation_id": conversation_id, "messages": messages}), 200
+    headers = {CONTINUATION_TOKEN_HEADER: continuation_token} if continuation_token else {}
+    return jsonify({"conversation_id": conversation_id, "messages": messages}), 200, headers
 
 
 @bp.route("/history/rename", methods=["POST"])
@@ -1197,15 +1932,19 @@ async def rename_conversation():
         return jsonify({"error": "conversation_id is required"}), 400
 
     ## make sure cosmos is configured
-    cosmos_conversation_client = init_cosmosdb_client()
+    cosmos_conversation_client = get_cosmosdb_client()
     if not cosmos_conversation_client:
         raise Exception("CosmosDB is not configured or not working")
 
-    ## get the conversation from cosmos
-    conversation = await cosmos_conversation_client.get_conversation(
-        user_id, conversation_id
+    title = request_json.get("title", None)
+    if not title:
+        return jsonify({"error": "title is required"}), 400
+
+    ## update the title, again if the conversation changed since it was read
+    updated_conversation = await cosmos_conversation_client.update_conversation(
+        user_id, conversation_id, lambda conversation: conversation.update(title=title)
     )
-    if not conversation:
+    if not updated_conversation:
         return (
             jsonify(
                 {
@@ -1215,16 +1954,6 @@ async def rename_conversation():
             404,
         )
 
-    ## update the title
-    title = request_json.get("title", None)
-    if not title:
-        return jsonify({"error": "title is required"}), 400
-    conversation["title"] = title
-    updated_conversation = await cosmos_conversation_client.upsert_conversation(
-        conversation
-    )
-
-    await cosmos_conversation_client.cosmosdb_client.close()
     return jsonify(updated_conversation), 200
 
 
@@ -1237,7 +1966,7 @@ async def delete_all_conversations():
     # get conversations for user
     try:
         ## make sure cosmos is configured
-        cosmos_conversation_client = init_cosmosdb_client()
+        cosmos_conversation_client = get_cosmosdb_client()
         if not cosmos_conversation_client:
             raise Exception("CosmosDB is not configured or not working")
 
@@ -1249,16 +1978,10 @@ async def delete_all_conversations():
 
         # delete each conversation
         for conversation in conversations:
-            ## delete the conversation messages from cosmos first
-            deleted_messages = await cosmos_conversation_client.delete_messages(
-                conversation["id"], user_id
-            )
-
-            ## Now delete the conversation
+            ## delete the conversation and its messages from cosmos
             deleted_conversation = await cosmos_conversation_client.delete_conversation(
                 user_id, conversation["id"]
             )
-        await cosmos_conversation_client.cosmosdb_client.close()
         return (
             jsonify(
                 {
@@ -1288,7 +2011,7 @@ async def clear_messages():
             return jsonify({"error": "conversation_id is required"}), 400
 
         ## make sure cosmos is configured
-        cosmos_conversation_client = init_cosmosdb_client()
+        cosmos_conversation_client = get_cosmosdb_client()
         if not cosmos_conversation_client:
             raise Exception("CosmosDB is not configured or not working")
 
@@ -1317,14 +2040,12 @@ async def ensure_cosmos():
         return jsonify({"error": "CosmosDB is not configured"}), 404
 
     try:
-        cosmos_conversation_client = init_cosmosdb_client()
-        success, err = await cosmos_conversation_client.ensure()
-        if not cosmos_conversation_client or not success:
+        success, err = await ensure_cosmosdb_client()
+        if not success:
             if err:
                 return jsonify({"error": err}), 422
             return jsonify({"error": "CosmosDB is not configured or not working"}), 500
 
-        await cosmos_conversation_client.cosmosdb_client.close()
         return jsonify({"message": "CosmosDB is configured and working"}), 200
     except Exception as e:
         logging.exception("Exception in /history/ensure")
@@ -1364,15 +2085,43 @@ async def generate_title(conversation_messages):
     messages.append({"role": "user", "content": title_prompt})
 
     try:
-        azure_openai_client = init_openai_client(use_data=False)
-        response = await azure_openai_client.chat.completions.create(
-            model=AZURE_OPENAI_MODEL, messages=messages, temperature=1, max_tokens=64
+        await admit_openai_call(messages, 64)
+        response = await get_openai_backend_pool().call(
+            lambda backend: backend.client.chat.completions.create(
+                model=backend.deployment, messages=messages, temperature=1, max_tokens=64
+            ),
+            priority=BACKGROUND,
         )
 
         title = json.loads(response.choices[0].message.content)["title"]
         return title
     except Exception as e:
-        return messages[-2]["content"]
+        return heuristic_title(conversation_messages)
+
+
+async def update_generated_title(
+    user_id, conversation_id, conversation_messages, fallback_title, conversation_saved
+):
+    # Returns the generated title once it is saved, or None when the
+    # conversation keeps its fallback title. The title is generated while
+    # conversation_saved is still creating the conversation.
+    try:
+        title = await asyncio.wait_for(
+            generate_title(conversation_messages), float(AZURE_OPENAI_TITLE_TIMEOUT)
+        )
+    except asyncio.TimeoutError:
+        logging.warning(f"Title generation timed out for conversation {conversation_id}")
+        return None
+    if not title or title == fallback_title:
+        return None
+
+    try:
+        await conversation_saved
+        await get_cosmosdb_client().update_conversation_title(user_id, conversation_id, title)
+    except Exception:
+        logging.exception("Failed to save the generated conversation title")
+        return None
+    return title
 
 
 app = create_app()
@@ -0,0 +1,174 @@
+import os
+import mmap
+import time
+import struct
+import asyncio
+import logging
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+
+class AdmissionRejectedError(Exception):
+    # Surfaced to the client as a 503 with a Retry-After hint
+    status_code = 503
+
+    def __init__(self, retry_after):
+        super().__init__("The service is at capacity, please retry shortly")
+        self.retry_after = retry_after
+
+
+class TokenCounter:
+    # Estimates the prompt tokens of a chat request. Falls back to about
+    # four characters per token when no tiktoken encoding can be loaded,
+    # e.g. when the encoding files can't be downloaded.
+    def __init__(self, model_name=None):
+        self.encoding = None
+        if tiktoken is None:
+            return
+        try:
+            try:
+                self.encoding = tiktoken.encoding_for_model(model_name or "")
+            except KeyError:
+                self.encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            logging.warning(f"Failed to load a tiktoken encoding, estimating token counts: {e}")
+
+    def count_text(self, text):
+        if not text:
+            return 0
+        if self.encoding is None:
+            return len(text) // 4 + 1
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+    def count_messages(self, messages):
+        # Every message carries a few tokens of framing, and the reply is
+        # primed with three more
+        tokens = 3
+        for message in messages:
+            content = message.get("content")
+            tokens += 4 + self.count_text(content if isinstance(content, str) else str(content))
+        return tokens
+
+
+class LocalBucketState:
+    def __init__(self):
+        self.state = None
+
+    def update(self, update):
+        self.state = update(self.state)
+        return self.state
+
+
+class SharedBucketState:
+    # Bucket state in a small memory mapped file, updated under an exclusive
+    # file lock, so every worker process on the machine draws from it
+    FORMAT = "dd"
+
+    def __init__(self, path):
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        size = struct.calcsize(self.FORMAT)
+        if os.fstat(self.fd).st_size < size:
+            os.ftruncate(self.fd, size)
+        self.map = mmap.mmap(self.fd, size)
+
+    def update(self, update):
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            tokens, updated = struct.unpack_from(self.FORMAT, self.map)
+            state = update((tokens, updated) if updated else None)
+            struct.pack_into(self.FORMAT, self.map, 0, *state)
+            return state
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def close(self):
+        self.map.close()
+        os.close(self.fd)
+
+
+class TokenBudget:
+    # Token bucket holding up to a minute of quota and refilled continuously
+    # at tokens_per_minute / 60 tokens per second
+    def __init__(self, tokens_per_minute: int, path=None):
+        self.capacity = float(tokens_per_minute)
+        self.rate = self.capacity / 60
+        self.state = SharedBucketState(path) if path and fcntl else LocalBucketState()
+
+    def try_acquire(self, tokens):
+        # Takes the tokens and returns 0, or returns the seconds until
+        # enough tokens will be available
+        tokens = min(tokens, self.capacity)
+        wait = 0.0
+
+        def update(state):
+            nonlocal wait
+            now = time.time()
+            available, updated = state or (self.capacity, now)
+            available = min(self.capacity, available + (now - updated) * self.rate)
+            if available >= tokens:
+                return available - tokens, now
+            wait = (tokens - available) / self.rate
+            return available, now
+
+        self.state.update(update)
+        return wait
+
+
+class AdmissionController:
+    # Admits upstream calls within the token budget. Calls that don't fit
+    # wait up to max_wait for the budget to refill, with at most queue_size
+    # of them waiting at once; anything beyond that is shed right away.
+    def __init__(self, budget: TokenBudget, counter: TokenCounter, queue_size: int = 50, max_wait: float = 5):
+        self.budget = budget
+        self.counter = counter
+        self.queue_size = queue_size
+        self.max_wait = max_wait
+        self.waiting = 0
+        self.stats = {"admitted": 0, "queued": 0, "rejected": 0, "tokens": 0}
+
+    def estimate(self, messages, max_tokens):
+        return self.counter.count_messages(messages) + int(max_tokens or 0)
+
+    async def admit(self, messages, max_tokens):
+        tokens = self.estimate(messages, max_tokens)
+        wait = self.budget.try_acquire(tokens)
+        if wait:
+            if self.waiting >= self.queue_size or wait > self.max_wait:
+                self.reject(wait)
+
+            self.stats["queued"] += 1
+            self.waiting += 1
+            try:
+                deadline = time.monotonic() + self.max_wait
+                while wait:
+                    await asyncio.sleep(wait)
+                    wait = self.budget.try_acquire(tokens)
+                    if wait and time.monotonic() + wait > deadline:
+                        self.reject(wait)
+            finally:
+                self.waiting -= 1
+
+        self.stats["admitted"] += 1
+        self.stats["tokens"] += tokens
+        return tokens
+
+    def try_admit(self, messages, max_tokens):
+        # Admits the call only if the budget has room for it right now
+        tokens = self.estimate(messages, max_tokens)
+        if self.budget.try_acquire(tokens):
+            return False
+        self.stats["admitted"] += 1
+        self.stats["tokens"] += tokens
+        return True
+
+    def reject(self, wait):
+        self.stats["rejected"] += 1
+        raise AdmissionRejectedError(wait)
@@ -1,3 +1,14 @@
+import base64
+import hashlib
+import json
+import logging
+from collections import OrderedDict
+
+PRINCIPAL_CACHE_SIZE = 1024
+
+## sha256 digest of the X-Ms-Client-Principal header -> group ids (None when unavailable)
+principal_groups_cache = OrderedDict()
+
 def get_authenticated_user_details(request_headers):
     user_object = {}
 
@@ -17,4 +28,44 @@ def get_authenticated_user_details(request_headers):
     user_object['client_principal_b64'] = raw_user_object.get('X-Ms-Client-Principal')
     user_object['aad_id_token'] = raw_user_object.get('X-Ms-Token-Aad-Id-Token')
 
-    return user_object
\ No newline at end of file
+    return user_object
+
+def decode_client_principal_groups(client_principal_b64):
+    ## decode the group ids carried in the EasyAuth X-Ms-Client-Principal claims.
+    ## returns None when the token has no groups claim or the user is in too many
+    ## groups for them to fit in the token (group overage), in which case the
+    ## caller has to ask Microsoft Graph instead.
+    try:
+        client_principal = json.loads(base64.b64decode(client_principal_b64))
+    except Exception as e:
+        logging.warning(f"Unable to decode X-Ms-Client-Principal: {e}")
+        return None
+
+    groups = []
+    for claim in client_principal.get("claims", []):
+        claim_type = claim.get("typ")
+        if claim_type == "groups":
+            groups.append(claim.get("val"))
+        elif claim_type == "hasgroups" or (
+            claim_type == "_claim_names" and "groups" in claim.get("val", "")
+        ):
+            return None
+
+    return groups or None
+
+
+def get_principal_groups(client_principal_b64):
+    if not client_principal_b64:
+        return None
+
+    digest = hashlib.sha256(client_principal_b64.encode()).digest()
+    if digest in principal_groups_cache:
+        principal_groups_cache.move_to_end(digest)
+        return principal_groups_cache[digest]
+
+    groups = decode_client_principal_groups(client_principal_b64)
+    principal_groups_cache[digest] = groups
+    if len(principal_groups_cache) > PRINCIPAL_CACHE_SIZE:
+        principal_groups_cache.popitem(last=False)
+
+    return groups
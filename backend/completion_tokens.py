@@ -0,0 +1,102 @@
+from collections import deque
+
+# Context lengths of the chat models, matched on the longest prefix of the
+# model name
+MODEL_CONTEXT_LENGTHS = {
+    "gpt-35-turbo": 4096,
+    "gpt-35-turbo-16k": 16384,
+    "gpt-35-turbo-1106": 16385,
+    "gpt-35-turbo-0125": 16385,
+    "gpt-4": 8192,
+    "gpt-4-32k": 32768,
+    "gpt-4-1106": 128000,
+    "gpt-4-0125": 128000,
+    "gpt-4-turbo": 128000,
+    "gpt-4-vision": 128000,
+    "gpt-4o": 128000,
+}
+
+
+def model_context_length(model_name):
+    matches = [name for name in MODEL_CONTEXT_LENGTHS if model_name and model_name.startswith(name)]
+    return MODEL_CONTEXT_LENGTHS[max(matches, key=len)] if matches else None
+
+
+def completion_token_limit(context_length, prompt_tokens, answer_budget):
+    # Reserve what is left of the context window, up to the answer budget
+    if not context_length:
+        return answer_budget
+    return max(min(answer_budget, context_length - prompt_tokens), 1)
+
+
+def percentile(values, p):
+    index = min(int(len(values) * p), len(values) - 1)
+    return values[index]
+
+
+class CompletionStats:
+    # Lengths of the latest completions next to the max_tokens reserved for
+    # them, to tune AZURE_OPENAI_MAX_TOKENS from real answers
+    def __init__(self, window: int = 1000):
+        self.lengths = deque(maxlen=window)
+        self.reserved = deque(maxlen=window)
+        self.completions = 0
+        self.truncated = 0
+
+    def record(self, completion_tokens, max_tokens, finish_reason):
+        self.completions += 1
+        if finish_reason == "length":
+            self.truncated += 1
+        self.lengths.append(completion_tokens)
+        self.reserved.append(max_tokens or 0)
+
+    def snapshot(self):
+        if not self.lengths:
+            return {"completions": self.completions, "truncated": self.truncated}
+
+        lengths = sorted(self.lengths)
+        return {
+            "completions": self.completions,
+            "truncated": self.truncated,
+            "mean_tokens": sum(lengths) / len(lengths),
+            "p50_tokens": percentile(lengths, 0.5),
+            "p90_tokens": percentile(lengths, 0.9),
+            "p99_tokens": percentile(lengths, 0.99),
+            "max_tokens": lengths[-1],
+            "mean_reserved_tokens": sum(self.reserved) / len(self.reserved),
+        }
+
+
+class MeteredStream:
+    # Counts the content deltas of a streamed completion, about one token
+    # each, and records the length once the stream has been read to the end
+    def __init__(self, stream, stats, max_tokens):
+        self.stream = stream
+        self.response = stream.response
+        self.stats = stats
+        self.max_tokens = max_tokens
+
+    async def __aiter__(self):
+        tokens = 0
+        finish_reason = None
+        async for chunk in self.stream:
+            if chunk.choices:
+                choice = chunk.choices[0]
+                if choice.delta and choice.delta.content:
+                    tokens += 1
+                finish_reason = getattr(choice, "finish_reason", None) or finish_reason
+            yield chunk
+
+        self.stats.record(tokens, self.max_tokens, finish_reason)
+
+
+def record_completion(stats, completion, max_tokens, counter):
+    if not completion.choices:
+        return
+    usage = getattr(completion, "usage", None)
+    if usage is not None:
+        tokens = usage.completion_tokens
+    else:
+        # Count the answer when the service doesn't report usage
+        tokens = counter.count_text(completion.choices[0].message.content)
+    stats.record(tokens, max_tokens, completion.choices[0].finish_reason)
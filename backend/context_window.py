@@ -0,0 +1,132 @@
+import hashlib
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import orjson
+
+
+@dataclass
+class SummaryEntry:
+    # The first `count` messages of the conversation, identified by their
+    # hash, are replaced by `summary`
+    count: int
+    prefix_hash: str
+    summary: str
+
+
+def hash_messages(messages):
+    return hashlib.sha256(
+        orjson.dumps([(m["role"], m["content"]) for m in messages], default=str)
+    ).hexdigest()
+
+
+class ContextWindow:
+    # Keeps the newest turns of a conversation within a token budget and
+    # replaces the older ones with a rolling summary.
+    #
+    # When the turns no longer fit, the window is cut back to half the budget
+    # so the summary is extended once every few turns rather than on every
+    # turn, and the summary is cached per conversation so later turns reuse it.
+    #
+    # summarize is an async callable taking the previous summary (or None)
+    # and the messages to fold into it, and returning the new summary.
+
+    def __init__(
+        self, counter, summarize, token_budget: int, cache_size: int = 1000, token_cache_size: int = 50000
+    ):
+        self.counter = counter
+        self.summarize = summarize
+        self.token_budget = token_budget
+        self.cache_size = cache_size
+        self.token_cache_size = token_cache_size
+        self.summaries = OrderedDict()
+        self.token_counts = OrderedDict()
+        self.stats = {"summarized": 0, "reused": 0, "summary_failures": 0}
+
+    def cached_summary(self, conversation_key, messages):
+        entry = self.summaries.get(conversation_key)
+        if (
+            entry
+            and entry.count < len(messages)
+            and entry.prefix_hash == hash_messages(messages[: entry.count])
+        ):
+            self.summaries.move_to_end(conversation_key)
+            return entry
+        return None
+
+    def count_tokens(self, messages):
+        # Token counts per message, cached by content so each turn only
+        # encodes the messages that are new since the last one
+        counts = []
+        for message in messages:
+            key = hash_messages([message])
+            count = self.token_counts.get(key)
+            if count is None:
+                count = self.counter.count_messages([message])
+                self.token_counts[key] = count
+                if len(self.token_counts) > self.token_cache_size:
+                    self.token_counts.popitem(last=False)
+            else:
+                self.token_counts.move_to_end(key)
+            counts.append(count)
+        return counts
+
+    def cut(self, messages, start, token_counts, target):
+        # The newest messages that fit the target, starting at a user turn;
+        # the current question is always kept
+        end = len(messages) - 1
+        cut = end
+        tokens = token_counts[end]
+        for i in range(end - 1, start - 1, -1):
+            tokens += token_counts[i]
+            if tokens > target:
+                break
+            if messages[i]["role"] == "user":
+                cut = i
+        return cut
+
+    def summary_message(self, summary):
+        return {
+            "role": "assistant",
+            "content": f"Summary of our conversation so far: {summary}",
+        }
+
+    async def apply(self, conversation_key, messages):
+        # Conversations without an id are recognized by their first message;
+        # the prefix hash keeps a summary from being applied to another one
+        conversation_key = conversation_key or hash_messages(messages[:1])
+        token_counts = self.count_tokens(messages)
+        entry = self.cached_summary(conversation_key, messages)
+        start = entry.count if entry else 0
+        summary = entry.summary if entry else None
+        summary_tokens = self.counter.count_text(summary)
+
+        if summary_tokens + sum(token_counts[start:]) <= self.token_budget:
+            if entry:
+                self.stats["reused"] += 1
+                return [self.summary_message(summary)] + messages[start:]
+            return messages
+
+        cut = self.cut(messages, start, token_counts, self.token_budget // 2)
+        if cut == start:
+            # Not even one earlier turn can be dropped
+            return ([self.summary_message(summary)] if summary else []) + messages[start:]
+
+        try:
+            summary = await self.summarize(summary, messages[start:cut])
+        except Exception as e:
+            # Fall back to dropping the older turns without a summary
+            logging.warning(f"Failed to summarize the conversation: {e}")
+            self.stats["summary_failures"] += 1
+            return messages[cut:]
+
+        self.stats["summarized"] += 1
+        self.summaries[conversation_key] = SummaryEntry(
+            cut, hash_messages(messages[:cut]), summary
+        )
+        self.summaries.move_to_end(conversation_key)
+        while len(self.summaries) > self.cache_size:
+            self.summaries.popitem(last=False)
+
+        return [self.summary_message(summary)] + messages[cut:]
@@ -0,0 +1,132 @@
+import time
+import asyncio
+import logging
+
+from azure.identity.aio import DefaultAzureCredential
+
+
+class CredentialManager:
+    # Wraps a single Azure AD credential for the whole process, caching access
+    # tokens per scope and refreshing them in the background before they
+    # expire so no request has to wait on token acquisition.
+    #
+    # Implements the async TokenCredential protocol, so it can be passed
+    # anywhere the Azure SDKs accept a credential.
+
+    def __init__(self, credential=None, refresh_margin: int = 300, min_refresh_interval: int = 10):
+        self.credential = credential or DefaultAzureCredential()
+        self.refresh_margin = refresh_margin
+        self.min_refresh_interval = min_refresh_interval
+        self._tokens = {}
+        self._locks = {}
+        self._refresh_task = None
+        self.metrics = {
+            "acquisitions": 0,
+            "failures": 0,
+            "cache_hits": 0,
+            "last_latency_ms": 0.0,
+            "max_latency_ms": 0.0,
+            "total_latency_ms": 0.0,
+        }
+
+    async def get_token(self, *scopes, claims=None, tenant_id=None, **kwargs):
+        if claims:
+            # claims challenges must always go to AAD
+            return await self._acquire(scopes, claims=claims, tenant_id=tenant_id, **kwargs)
+
+        key = (scopes, tenant_id)
+        token = self._tokens.get(key)
+        if token and token.expires_on - time.time() > self.min_refresh_interval:
+            self.metrics["cache_hits"] += 1
+            return token
+
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            token = self._tokens.get(key)
+            if token and token.expires_on - time.time() > self.min_refresh_interval:
+                self.metrics["cache_hits"] += 1
+                return token
+
+            token = await self._acquire(scopes, tenant_id=tenant_id, **kwargs)
+            self._tokens[key] = token
+            return token
+
+    def get_bearer_token_provider(self, *scopes):
+        async def provider():
+            token = await self.get_token(*scopes)
+            return token.token
+
+        return provider
+
+    async def _acquire(self, scopes, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await self.credential.get_token(*scopes, **kwargs)
+        except Exception:
+            self.metrics["failures"] += 1
+            raise
+        finally:
+            latency_ms = (time.perf_counter() - start) * 1000
+            self.metrics["acquisitions"] += 1
+            self.metrics["last_latency_ms"] = latency_ms
+            self.metrics["total_latency_ms"] += latency_ms
+            self.metrics["max_latency_ms"] = max(self.metrics["max_latency_ms"], latency_ms)
+
+    async def refresh(self):
+        # Refresh every cached token that expires within the refresh margin
+        for (scopes, tenant_id), token in list(self._tokens.items()):
+            if token.expires_on - time.time() > self.refresh_margin:
+                continue
+            try:
+                self._tokens[(scopes, tenant_id)] = await self._acquire(scopes, tenant_id=tenant_id)
+            except Exception as e:
+                logging.warning(f"Failed to refresh access token for {scopes}: {e}")
+
+    def _next_refresh_delay(self):
+        if not self._tokens:
+            return self.refresh_margin
+        next_expiry = min(token.expires_on for token in self._tokens.values())
+        delay = next_expiry - self.refresh_margin - time.time()
+        return min(max(delay, self.min_refresh_interval), self.refresh_margin)
+
+    async def _refresh_loop(self):
+        while True:
+            await asyncio.sleep(self._next_refresh_delay())
+            await self.refresh()
+
+    async def start(self, *scopes):
+        # Prefetch tokens for the given scopes and start the background refresh
+        for scope in scopes:
+            try:
+                await self.get_token(scope)
+            except Exception as e:
+                logging.warning(f"Failed to prefetch access token for {scope}: {e}")
+
+        if self._refresh_task is None:
+            self._refresh_task = asyncio.create_task(self._refresh_loop())
+
+    def stats(self):
+        acquisitions = self.metrics["acquisitions"]
+        return {
+            **self.metrics,
+            "avg_latency_ms": (
+                self.metrics["total_latency_ms"] / acquisitions if acquisitions else 0.0
+            ),
+            "cached_scopes": len(self._tokens),
+        }
+
+    async def close(self):
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+            try:
+                await self._refresh_task
+            except asyncio.CancelledError:
+                pass
+            self._refresh_task = None
+        await self.credential.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
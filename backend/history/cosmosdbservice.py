@@ -1,8 +1,29 @@
 import uuid
+import base64
+import binascii
 from datetime import datetime
+from azure.core import MatchConditions
 from azure.cosmos.aio import CosmosClient
 from azure.cosmos import exceptions
   
+class InvalidContinuationTokenError(ValueError):
+    pass
+
+
+def encode_continuation_token(token):
+    ## the cosmos continuation token is passed to clients as an opaque, url safe cursor
+    return base64.urlsafe_b64encode(token.encode('utf-8')).decode('ascii') if token else None
+
+
+def decode_continuation_token(cursor):
+    if not cursor:
+        return None
+    try:
+        return base64.b64decode(cursor.encode('ascii'), altchars=b'-_', validate=True).decode('utf-8')
+    except (binascii.Error, UnicodeError, ValueError) as e:
+        raise InvalidContinuationTokenError("Invalid continuation token") from e
+
+
 class CosmosConversationClient():
     
     def __init__(self, cosmosdb_endpoint: str, credential: any, database_name: str, container_name: str, enable_message_feedback: bool = False):
@@ -11,6 +32,8 @@ class CosmosConversationClient():
         self.database_name = database_name
         self.container_name = container_name
         self.enable_message_feedback = enable_message_feedback
+        self.request_charges = {}
+        self.messages_written = 0
         try:
             self.cosmosdb_client = CosmosClient(self.cosmosdb_endpoint, credential=credential)
         except exceptions.CosmosHttpResponseError as e:
@@ -46,17 +69,38 @@ class CosmosConversationClient():
             
         return True, "CosmosDB client initialized successfully"
 
-    async def create_conversation(self, user_id, title = ''):
-        conversation = {
-            'id': str(uuid.uuid4()),  
+    def charge(self, operation):
+        ## response hook adding up the request units charged for an operation
+        def hook(headers, *_):
+            charges = self.request_charges.setdefault(operation, {'requests': 0, 'request_units': 0.0})
+            charges['requests'] += 1
+            charges['request_units'] += float(headers.get('x-ms-request-charge', 0))
+        return hook
+
+    def stats(self):
+        written = self.request_charges.get('create_messages', {}).get('request_units', 0.0)
+        return {
+            'messages_written': self.messages_written,
+            'request_units_per_message': written / self.messages_written if self.messages_written else 0.0,
+            'operations': self.request_charges
+        }
+
+    def conversation_document(self, user_id, title = '', conversation_id = None, created_at = None):
+        ## the id and creation time can be chosen by the caller, so they are known before the write
+        created_at = created_at or datetime.utcnow().isoformat()
+        return {
+            'id': conversation_id or str(uuid.uuid4()),  
             'type': 'conversation',
-            'createdAt': datetime.utcnow().isoformat(),  
-            'updatedAt': datetime.utcnow().isoformat(),  
+            'createdAt': created_at,  
+            'updatedAt': created_at,  
             'userId': user_id,
             'title': title
         }
+
+    async def create_conversation(self, user_id, title = '', conversation_id = None, created_at = None):
+        conversation = self.conversation_document(user_id, title, conversation_id, created_at)
         ## TODO: add some error handling based on the output of the upsert_item call
-        resp = await self.container_client.upsert_item(conversation)  
+        resp = await self.container_client.upsert_item(conversation, response_hook=self.charge('create_conversation'))  
         if resp:
             return resp
         else:
@@ -69,13 +113,73 @@ class CosmosConversationClient():
         else:
             return False
 
-    async def delete_conversation(self, user_id, conversation_id):
-        conversation = await self.container_client.read_item(item=conversation_id, partition_key=user_id)        
-        if conversation:
-            resp = await self.container_client.delete_item(item=conversation_id, partition_key=user_id)
+    async def update_conversation_title(self, user_id, conversation_id, title):
+        ## patch only the title, so concurrent updates of the conversation aren't overwritten
+        resp = await self.container_client.patch_item(
+            item=conversation_id,
+            partition_key=user_id,
+            patch_operations=[{'op': 'set', 'path': '/title', 'value': title}],
+            response_hook=self.charge('update_conversation_title')
+        )
+        if resp:
             return resp
         else:
-            return True
+            return False
+
+    async def read_item(self, user_id, item_id, item_type):
+        ## point read by id and partition key, much cheaper than a query. the returned item
+        ## carries its _etag for conditional writes
+        try:
+            item = await self.container_client.read_item(item=item_id, partition_key=user_id, response_hook=self.charge('read_item'))
+        except exceptions.CosmosResourceNotFoundError:
+            return None
+        return item if item.get('type') == item_type else None
+
+    async def update_item(self, user_id, item_id, item_type, update, attempts = 3):
+        ## read-modify-write with If-Match on the etag that was read, so a concurrent write is never
+        ## overwritten; when one happened, the update is applied again to the newer item
+        for attempt in range(attempts):
+            item = await self.read_item(user_id, item_id, item_type)
+            if not item:
+                return None
+            update(item)
+            try:
+                return await self.container_client.replace_item(
+                    item=item_id,
+                    body=item,
+                    etag=item['_etag'],
+                    match_condition=MatchConditions.IfNotModified,
+                    response_hook=self.charge('replace_item')
+                )
+            except exceptions.CosmosAccessConditionFailedError:
+                if attempt == attempts - 1:
+                    raise
+
+    async def update_conversation(self, user_id, conversation_id, update):
+        return await self.update_item(user_id, conversation_id, 'conversation', update)
+
+    async def delete_conversation(self, user_id, conversation_id, attempts = 3):
+        ## deletes the messages, then the conversation if it is unchanged since it was read. a message
+        ## written in between changes the conversation's etag, and is deleted on the next attempt
+        for attempt in range(attempts):
+            conversation = await self.get_conversation(user_id, conversation_id)
+            await self.delete_messages(conversation_id, user_id)
+            if not conversation:
+                return True
+            try:
+                await self.container_client.delete_item(
+                    item=conversation_id,
+                    partition_key=user_id,
+                    etag=conversation['_etag'],
+                    match_condition=MatchConditions.IfNotModified,
+                    response_hook=self.charge('delete_item')
+                )
+                return True
+            except exceptions.CosmosResourceNotFoundError:
+                return True
+            except exceptions.CosmosAccessConditionFailedError:
+                if attempt == attempts - 1:
+                    raise
 
         
     async def delete_messages(self, conversation_id, user_id):
@@ -106,29 +210,36 @@ class CosmosConversationClient():
         
         return conversations
 
-    async def get_conversation(self, user_id, conversation_id):
+    async def query_page(self, query, parameters, user_id, page_size, cursor = None):
+        ## one page of a single partition query, and the cursor of the next page or None. unlike
+        ## OFFSET, a continuation token doesn't charge for the items of the earlier pages
+        items = self.container_client.query_items(
+            query=query, parameters=parameters, partition_key=user_id, max_item_count=page_size
+        )
+        pages = items.by_page(decode_continuation_token(cursor))
+        try:
+            async for page in pages:
+                return [item async for item in page], encode_continuation_token(pages.continuation_token)
+        except exceptions.CosmosHttpResponseError as e:
+            if cursor and e.status_code == 400:
+                raise InvalidContinuationTokenError("Invalid continuation token") from e
+            raise
+        return [], None
+
+    async def get_conversations_page(self, user_id, page_size, cursor = None, sort_order = 'DESC'):
         parameters = [
-            {
-                'name': '@conversationId',
-                'value': conversation_id
-            },
             {
                 'name': '@userId',
                 'value': user_id
             }
         ]
-        query = f"SELECT * FROM c where c.id = @conversationId and c.type='conversation' and c.userId = @userId"
-        conversations = []
-        async for item in self.container_client.query_items(query=query, parameters=parameters):
-            conversations.append(item)
+        query = f"SELECT * FROM c where c.userId = @userId and c.type='conversation' order by c.updatedAt {sort_order}"
+        return await self.query_page(query, parameters, user_id, page_size, cursor)
 
-        ## if no conversations are found, return None
-        if len(conversations) == 0:
-            return None
-        else:
-            return conversations[0]
+    async def get_conversation(self, user_id, conversation_id):
+        return await self.read_item(user_id, conversation_id, 'conversation')
  
-    async def create_message(self, uuid, conversation_id, user_id, input_message: dict):
+    def message_document(self, uuid, conversation_id, user_id, input_message: dict):
         message = {
             'id': uuid,
             'type': 'message',
@@ -142,25 +253,42 @@ class CosmosConversationClient():
 
         if self.enable_message_feedback:
             message['feedback'] = ''
-        
-        resp = await self.container_client.upsert_item(message)  
-        if resp:
-            ## update the parent conversations's updatedAt field with the current message's createdAt datetime value
-            conversation = await self.get_conversation(user_id, conversation_id)
-            if not conversation:
+        return message
+
+    async def create_messages(self, conversation_id, user_id, input_messages, conversation = None):
+        ## writes the (uuid, message) pairs and sets the parent conversation's updatedAt to the last
+        ## message's createdAt in one transactional batch, so it is a single round trip within the
+        ## user's partition. a new conversation document can be passed to be created in the same batch.
+        messages = [self.message_document(id, conversation_id, user_id, input_message) for id, input_message in input_messages]
+        updated_at = messages[-1]['createdAt']
+        batch = [('upsert', (message,)) for message in messages]
+        if conversation:
+            batch.insert(0, ('upsert', ({**conversation, 'updatedAt': updated_at},)))
+        else:
+            batch.append(('patch', (conversation_id, [{'op': 'set', 'path': '/updatedAt', 'value': updated_at}])))
+
+        try:
+            await self.container_client.execute_item_batch(
+                batch_operations=batch, partition_key=user_id, response_hook=self.charge('create_messages')
+            )
+        except exceptions.CosmosBatchOperationError as e:
+            ## nothing is written when the parent conversation doesn't exist
+            if not conversation and e.error_index == len(batch) - 1 and e.operation_responses[e.error_index].get('statusCode') == 404:
                 return "Conversation not found"
-            conversation['updatedAt'] = message['createdAt']
-            await self.upsert_conversation(conversation)
+            raise
+        self.messages_written += len(messages)
+        return messages
+
+    async def create_message(self, uuid, conversation_id, user_id, input_message: dict):
+        resp = await self.create_messages(conversation_id, user_id, [(uuid, input_message)])
+        if resp == "Conversation not found":
             return resp
-        else:
-            return False
+        return resp[0]
     
     async def update_message_feedback(self, user_id, message_id, feedback):
-        message = await self.container_client.read_item(item=message_id, partition_key=user_id)
+        message = await self.update_item(user_id, message_id, 'message', lambda message: message.update(feedback=feedback))
         if message:
-            message['feedback'] = feedback
-            resp = await self.container_client.upsert_item(message)
-            return resp
+            return message
         else:
             return False
 
@@ -182,3 +310,17 @@ class CosmosConversationClient():
 
         return messages
 
+    async def get_messages_page(self, user_id, conversation_id, page_size, cursor = None):
+        parameters = [
+            {
+                'name': '@conversationId',
+                'value': conversation_id
+            },
+            {
+                'name': '@userId',
+                'value': user_id
+            }
+        ]
+        ## newest first, so the first page holds the latest turns of the conversation
+        query = f"SELECT * FROM c WHERE c.conversationId = @conversationId AND c.type='message' AND c.userId = @userId ORDER BY c.createdAt DESC"
+        return await self.query_page(query, parameters, user_id, page_size, cursor)
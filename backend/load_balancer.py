@@ -0,0 +1,322 @@
+import time
+import random
+import asyncio
+import logging
+from collections import deque
+from email.utils import parsedate_to_datetime
+
+import httpx
+import openai
+
+from backend.scheduler import INTERACTIVE
+
+
+class ReleasingStream(httpx.AsyncByteStream):
+    # The body of a streamed completion, calling release once it has been
+    # read to the end or closed
+    def __init__(self, stream, release):
+        self.stream = stream
+        self.release = release
+        self.released = False
+
+    async def __aiter__(self):
+        async for chunk in self.stream:
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self.stream.aclose()
+        finally:
+            if not self.released:
+                self.released = True
+                self.release()
+
+
+def hold_until_closed(response, release):
+    # A streamed completion keeps its deployment busy after the headers
+    # arrive. Returns False, without calling release, when the response
+    # body has already been read.
+    http_response = getattr(response, "http_response", None)
+    if http_response is None or http_response.is_closed:
+        return False
+    http_response.stream = ReleasingStream(http_response.stream, release)
+    return True
+
+
+class NoBackendAvailableError(Exception):
+    # Surfaced to the client as a 503 with a Retry-After hint
+    status_code = 503
+
+    def __init__(self, retry_after):
+        super().__init__("All Azure OpenAI backends are busy, please retry shortly")
+        self.retry_after = retry_after
+
+
+def parse_retry_after(headers, default):
+    if headers is None:
+        return default
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+    retry_after = headers.get("retry-after")
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            try:
+                return max(parsedate_to_datetime(retry_after).timestamp() - time.time(), 0)
+            except (TypeError, ValueError):
+                pass
+    return default
+
+
+class Backend:
+    def __init__(self, name, client, deployment, weight: float = 1.0):
+        self.name = name
+        self.client = client
+        self.deployment = deployment
+        self.weight = weight
+        self.outstanding = 0
+        self.latency = None
+        self.cooldown_until = 0.0
+        self.failures = 0
+        self.open_until = 0.0
+        self.trial = False
+        self.metrics = {"requests": 0, "failures": 0, "throttled": 0}
+
+    def state(self, now):
+        if self.cooldown_until > now:
+            return "cooling_down"
+        if self.open_until > now:
+            return "open"
+        if self.open_until:
+            return "half_open"
+        return "closed"
+
+    def available(self, now):
+        state = self.state(now)
+        # A half-open circuit lets a single trial request through
+        return state == "closed" or (state == "half_open" and not self.trial)
+
+
+class BackendPool:
+    # Spreads Azure OpenAI calls over weighted deployments. Each call goes to
+    # the available backend with the fewest outstanding requests relative to
+    # its weight and observed latency. Throttled backends cool down for their
+    # Retry-After, and backends that keep failing are taken out by a circuit
+    # breaker until a trial request succeeds again.
+
+    def __init__(
+        self,
+        backends,
+        failure_threshold: int = 5,
+        open_seconds: float = 30,
+        cooldown_seconds: float = 10,
+        latency_alpha: float = 0.2,
+        scheduler=None,
+    ):
+        self.backends = backends
+        self.scheduler = scheduler
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.cooldown_seconds = cooldown_seconds
+        self.latency_alpha = latency_alpha
+        self.completion_latencies = deque(maxlen=1000)
+        self.hedge_stats = {"calls": 0, "hedged": 0, "hedge_wins": 0}
+
+    def select(self, exclude=()):
+        now = time.monotonic()
+        candidates = [b for b in self.backends if b not in exclude and b.available(now)]
+        if not candidates:
+            return None
+
+        latencies = [b.latency for b in candidates if b.latency is not None]
+        default_latency = sum(latencies) / len(latencies) if latencies else 1.0
+        random.shuffle(candidates)
+        return min(
+            candidates,
+            key=lambda b: (b.outstanding + 1) / b.weight
+            * (b.latency if b.latency is not None else default_latency),
+        )
+
+    def retry_after(self):
+        now = time.monotonic()
+        waits = [max(b.cooldown_until, b.open_until) - now for b in self.backends]
+        return max(min(waits), 1)
+
+    async def call(self, request, tried=None, priority=INTERACTIVE, error=None):
+        # request is called with the selected backend and returns an
+        # awaitable; retryable errors move the call to the next backend.
+        # error is the last failure of the backends already tried.
+        tried = list(tried or [])
+        while True:
+            backend = self.select(exclude=tried)
+            if backend is None:
+                if error is not None:
+                    raise error
+                raise NoBackendAvailableError(self.retry_after())
+            tried.append(backend)
+
+            try:
+                return await self.call_backend(backend, request, priority)
+            except (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError) as e:
+                logging.warning(f"Azure OpenAI backend {backend.name} failed, trying the next one: {e}")
+                error = e
+
+    async def call_backend(self, backend, request, priority=INTERACTIVE):
+        if self.scheduler is None:
+            return await self.send(backend, request)
+
+        # Every upstream call takes a slot of the worker's scheduler, held
+        # until a streamed response has been read or closed
+        await self.scheduler.acquire(priority)
+        streaming = False
+        try:
+            start = time.monotonic()
+            try:
+                response = await self.send(backend, request)
+            except openai.RateLimitError:
+                self.scheduler.record(throttled=True)
+                raise
+            self.scheduler.record(latency=time.monotonic() - start)
+            streaming = hold_until_closed(response, self.scheduler.release)
+            return response
+        finally:
+            if not streaming:
+                self.scheduler.release()
+
+    def release(self, backend):
+        backend.outstanding -= 1
+
+    async def send(self, backend, request):
+        backend.metrics["requests"] += 1
+        backend.outstanding += 1
+        if backend.state(time.monotonic()) == "half_open":
+            backend.trial = True
+        start = time.monotonic()
+        streaming = False
+        try:
+            response = await request(backend)
+            streaming = hold_until_closed(response, lambda: self.release(backend))
+        except openai.RateLimitError as e:
+            backend.metrics["throttled"] += 1
+            backend.cooldown_until = time.monotonic() + parse_retry_after(
+                e.response.headers, self.cooldown_seconds
+            )
+            raise
+        except (openai.APIConnectionError, openai.InternalServerError):
+            self.record_failure(backend)
+            raise
+        finally:
+            if not streaming:
+                self.release(backend)
+            backend.trial = False
+
+        latency = time.monotonic() - start
+        backend.latency = (
+            latency
+            if backend.latency is None
+            else self.latency_alpha * latency + (1 - self.latency_alpha) * backend.latency
+        )
+        backend.failures = 0
+        backend.open_until = 0.0
+        return response
+
+    def hedge_delay(self, percentile, min_samples):
+        # None until enough completions have been timed
+        if not self.completion_latencies or len(self.completion_latencies) < min_samples:
+            return None
+        latencies = sorted(self.completion_latencies)
+        return latencies[min(int(len(latencies) * percentile / 100), len(latencies) - 1)]
+
+    async def hedged_call(
+        self, request, percentile: float = 95, min_samples: int = 20, allow_hedge=None, priority=INTERACTIVE
+    ):
+        # Like call, but when no response has arrived by the given percentile
+        # of completion latency, the same request also goes to another
+        # backend. The first response wins and the other call is cancelled.
+        # allow_hedge is asked before a duplicate is sent.
+        self.hedge_stats["calls"] += 1
+        start = time.monotonic()
+        primary = self.select()
+        if primary is None:
+            raise NoBackendAvailableError(self.retry_after())
+
+        tasks = [asyncio.create_task(self.call_backend(primary, request, priority))]
+        try:
+            delay = self.hedge_delay(percentile, min_samples)
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            alternate = None
+            if not done:
+                alternate = self.select(exclude=[primary])
+                # Asked only when a hedge can actually be sent
+                if alternate is not None and allow_hedge is not None and not allow_hedge():
+                    alternate = None
+            if alternate is not None:
+                self.hedge_stats["hedged"] += 1
+                tasks.append(asyncio.create_task(self.call_backend(alternate, request, priority)))
+
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not tasks[0]:
+                            self.hedge_stats["hedge_wins"] += 1
+                        self.completion_latencies.append(time.monotonic() - start)
+                        return task.result()
+
+            error = tasks[-1].exception()
+            if not isinstance(
+                error, (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)
+            ):
+                raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        # Every backend tried so far failed; go on like an unhedged call
+        logging.warning(f"Hedged Azure OpenAI call failed, trying the next backend: {error}")
+        return await self.call(
+            request,
+            tried=[primary, alternate] if alternate else [primary],
+            priority=priority,
+            error=error,
+        )
+
+    def record_failure(self, backend):
+        backend.metrics["failures"] += 1
+        backend.failures += 1
+        if backend.failures >= self.failure_threshold:
+            backend.open_until = time.monotonic() + self.open_seconds
+            logging.warning(f"Azure OpenAI backend {backend.name} is unavailable for {self.open_seconds}s")
+
+    def hedging_stats(self):
+        calls, hedged = self.hedge_stats["calls"], self.hedge_stats["hedged"]
+        return {
+            **self.hedge_stats,
+            "hedge_rate": hedged / calls if calls else 0.0,
+            "win_rate": self.hedge_stats["hedge_wins"] / hedged if hedged else 0.0,
+        }
+
+    def stats(self):
+        now = time.monotonic()
+        return [
+            {
+                "name": b.name,
+                "weight": b.weight,
+                "state": b.state(now),
+                "outstanding": b.outstanding,
+                "latency_ms": b.latency * 1000 if b.latency is not None else None,
+                **b.metrics,
+            }
+            for b in self.backends
+        ]
+
+    async def close(self):
+        for backend in self.backends:
+            await backend.client.close()
@@ -0,0 +1,104 @@
+import os
+import json
+import queue
+import atexit
+import random
+import logging
+from logging.handlers import QueueHandler, QueueListener
+
+REQUEST_LOG_SAMPLE_RATE = float(os.environ.get("REQUEST_LOG_SAMPLE_RATE", 1.0))
+
+SECRET_PARAMS = [
+    "key",
+    "connection_string",
+    "embedding_key",
+    "encoded_api_key",
+    "api_key",
+]
+
+queue_listener = None
+
+
+class DeferredQueueHandler(QueueHandler):
+    # Hand records to the listener thread unformatted, so building the log
+    # message (and any lazy arguments) happens off the event loop
+    def prepare(self, record):
+        return record
+
+
+def configure_logging(level=logging.DEBUG):
+    # Route every root log record through a queue drained by a background
+    # thread, so handler I/O never blocks the event loop
+    global queue_listener
+    if queue_listener is not None:
+        return
+
+    root = logging.getLogger()
+    handlers = root.handlers[:]
+    if not handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+        handlers = [handler]
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+
+    log_queue = queue.SimpleQueue()
+    root.addHandler(DeferredQueueHandler(log_queue))
+    root.setLevel(level)
+
+    queue_listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    queue_listener.start()
+    atexit.register(queue_listener.stop)
+
+
+def mask_secrets(params):
+    return {
+        field: "*****" if field in SECRET_PARAMS and value else value
+        for field, value in params.items()
+    }
+
+
+def redact_model_args(model_args):
+    # Only the data source settings hold secrets; everything else, including
+    # the messages, is logged as is without being copied
+    if not model_args.get("extra_body"):
+        return model_args
+
+    data_source = model_args["extra_body"]["data_sources"][0]
+    parameters = mask_secrets(data_source["parameters"])
+    if "authentication" in parameters:
+        parameters["authentication"] = mask_secrets(parameters["authentication"])
+    embedding_dependency = parameters.get("embedding_dependency", {})
+    if "authentication" in embedding_dependency:
+        parameters["embedding_dependency"] = {
+            **embedding_dependency,
+            "authentication": mask_secrets(embedding_dependency["authentication"]),
+        }
+
+    return {
+        **model_args,
+        "extra_body": {
+            **model_args["extra_body"],
+            "data_sources": [{**data_source, "parameters": parameters}],
+        },
+    }
+
+
+class LazyModelArgs:
+    # Redacts and serializes the model args only when the record is emitted
+    __slots__ = ("model_args",)
+
+    def __init__(self, model_args):
+        self.model_args = model_args
+
+    def __str__(self):
+        return json.dumps(redact_model_args(self.model_args), indent=4, default=str)
+
+
+def log_model_args(model_args):
+    if not logging.getLogger().isEnabledFor(logging.DEBUG):
+        return
+    if REQUEST_LOG_SAMPLE_RATE < 1.0 and random.random() >= REQUEST_LOG_SAMPLE_RATE:
+        return
+
+    logging.debug("REQUEST BODY: %s", LazyModelArgs(model_args))
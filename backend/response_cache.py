@@ -0,0 +1,156 @@
+import time
+import uuid
+import hashlib
+from collections import OrderedDict
+from dataclasses import dataclass
+from types import SimpleNamespace
+
+import orjson
+
+
+@dataclass
+class CachedAnswer:
+    model: str
+    object: str
+    content: str
+    context: dict = None
+
+
+def normalize_messages(messages):
+    # Whitespace differences don't change the question being asked
+    return [
+        {
+            "role": message["role"],
+            "content": (
+                " ".join(message["content"].split())
+                if isinstance(message["content"], str)
+                else message["content"]
+            ),
+        }
+        for message in messages
+    ]
+
+
+def make_cache_key(model_args):
+    # The key covers the conversation, the sampling settings and the whole
+    # data source, including the user's security filter, so an answer is only
+    # ever replayed to users who can access the same documents.
+    key_args = {k: v for k, v in model_args.items() if k not in ("messages", "stream")}
+    key_args["messages"] = normalize_messages(model_args["messages"])
+    return hashlib.sha256(
+        orjson.dumps(key_args, option=orjson.OPT_SORT_KEYS, default=str)
+    ).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, max_entries: int = 1000, ttl: float = 3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0, "stores": 0}
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry and entry[0] > time.monotonic():
+            self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry[1]
+
+        if entry:
+            del self.entries[key]
+        self.stats["misses"] += 1
+        return None
+
+    def put(self, key, answer: CachedAnswer):
+        if not answer.content:
+            return
+
+        self.entries[key] = (time.monotonic() + self.ttl, answer)
+        self.entries.move_to_end(key)
+        self.stats["stores"] += 1
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+
+def answer_from_completion(chatCompletion):
+    message = chatCompletion.choices[0].message if chatCompletion.choices else None
+    return CachedAnswer(
+        model=chatCompletion.model,
+        object=chatCompletion.object,
+        content=message.content if message else None,
+        context=getattr(message, "context", None),
+    )
+
+
+def new_response_metadata(answer: CachedAnswer):
+    # Replayed answers get a fresh id, which the frontend uses as the id of
+    # the assistant message it saves to the conversation history
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "model": answer.model,
+        "created": int(time.time()),
+        "object": answer.object,
+    }
+
+
+def replay_completion(answer: CachedAnswer):
+    message = SimpleNamespace(role="assistant", content=answer.content)
+    if answer.context is not None:
+        message.context = answer.context
+    return SimpleNamespace(
+        **new_response_metadata(answer),
+        choices=[SimpleNamespace(index=0, message=message)],
+    )
+
+
+class ReplayStream:
+    # Replays a cached answer as the chunks of a streamed completion
+    def __init__(self, answer: CachedAnswer):
+        self.answer = answer
+        self.metadata = new_response_metadata(answer)
+        self.metadata["object"] = "chat.completion.chunk"
+
+    def chunk(self, delta):
+        return SimpleNamespace(
+            **self.metadata, choices=[SimpleNamespace(index=0, delta=delta)]
+        )
+
+    async def __aiter__(self):
+        if self.answer.context is not None:
+            delta = SimpleNamespace(role="assistant", content=None)
+            delta.context = self.answer.context
+            yield self.chunk(delta)
+        yield self.chunk(SimpleNamespace(role="assistant", content=self.answer.content))
+
+
+class RecordingStream:
+    # Passes a streamed completion through while collecting the answer, and
+    # hands the answer to on_complete once the stream has been read to the end
+    def __init__(self, stream, on_complete):
+        self.stream = stream
+        self.response = stream.response
+        self.on_complete = on_complete
+
+    async def __aiter__(self):
+        model = None
+        context = None
+        content = []
+        async for chunk in self.stream:
+            model = model or chunk.model
+            if chunk.choices:
+                delta = chunk.choices[0].delta
+                if delta:
+                    if hasattr(delta, "context"):
+                        context = delta.context
+                    elif delta.content:
+                        content.append(delta.content)
+            yield chunk
+
+        self.on_complete(
+            CachedAnswer(
+                model=model,
+                object="chat.completion",
+                content="".join(content),
+                context=context,
+            )
+        )
@@ -0,0 +1,137 @@
+import time
+import heapq
+import asyncio
+import itertools
+from contextlib import asynccontextmanager
+
+# Priority classes, most urgent first
+INTERACTIVE = 0
+BACKGROUND = 1
+BULK = 2
+
+PRIORITIES = {"interactive": INTERACTIVE, "background": BACKGROUND, "bulk": BULK}
+PRIORITY_NAMES = {priority: name for name, priority in PRIORITIES.items()}
+
+# Share of the concurrency limit each class may fill, so lower classes
+# leave headroom for interactive bursts, and how many waiting calls each
+# class still joins, so lower classes are shed first
+CLASS_SHARES = {INTERACTIVE: 1.0, BACKGROUND: 0.75, BULK: 0.5}
+CLASS_QUEUE_LIMITS = {INTERACTIVE: 100, BACKGROUND: 50, BULK: 20}
+
+
+class SchedulerRejectedError(Exception):
+    # Surfaced to the client as a 503 with a Retry-After hint
+    status_code = 503
+
+    def __init__(self, retry_after):
+        super().__init__("The service is busy, please retry shortly")
+        self.retry_after = retry_after
+
+
+class PriorityScheduler:
+    # Limits the concurrent upstream calls of a worker and hands free slots
+    # to waiting calls in priority order. The limit adapts AIMD-style: it
+    # grows by one for every limit's worth of calls that succeed within the
+    # latency target, and is cut by the backoff factor, at most once per
+    # latency target, when a call is throttled or too slow.
+
+    def __init__(
+        self,
+        initial_limit: int = 32,
+        min_limit: int = 1,
+        max_limit: int = 256,
+        latency_target: float = 10,
+        backoff: float = 0.5,
+        max_wait: float = 10,
+    ):
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self.backoff = backoff
+        self.max_wait = max_wait
+        self.in_flight = 0
+        self.waiters = []
+        self.sequence = itertools.count()
+        self.last_decrease = 0.0
+        self.stats = {
+            "admitted": {name: 0 for name in PRIORITIES},
+            "shed": {name: 0 for name in PRIORITIES},
+            "decreases": 0,
+        }
+
+    def can_run(self, priority):
+        return self.in_flight < max(self.limit * CLASS_SHARES[priority], self.min_limit)
+
+    def waiting(self):
+        return sum(1 for _, _, future in self.waiters if not future.done())
+
+    async def acquire(self, priority):
+        name = PRIORITY_NAMES[priority]
+        ahead = any(p <= priority and not f.done() for p, _, f in self.waiters)
+        if not ahead and self.can_run(priority):
+            self.in_flight += 1
+            self.stats["admitted"][name] += 1
+            return
+
+        if self.waiting() >= CLASS_QUEUE_LIMITS[priority]:
+            self.stats["shed"][name] += 1
+            raise SchedulerRejectedError(self.max_wait)
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.sequence), future))
+        try:
+            await asyncio.wait_for(future, self.max_wait)
+        except asyncio.TimeoutError:
+            self.stats["shed"][name] += 1
+            raise SchedulerRejectedError(self.max_wait)
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The slot was handed over just as the caller went away
+                self.release()
+            raise
+        self.stats["admitted"][name] += 1
+
+    def release(self):
+        self.in_flight -= 1
+        self.dispatch()
+
+    def dispatch(self):
+        while self.waiters:
+            priority, _, future = self.waiters[0]
+            if future.done():
+                heapq.heappop(self.waiters)
+                continue
+            if not self.can_run(priority):
+                break
+            heapq.heappop(self.waiters)
+            self.in_flight += 1
+            future.set_result(None)
+
+    def record(self, latency=None, throttled=False):
+        now = time.monotonic()
+        if throttled or (latency is not None and latency > self.latency_target):
+            if now - self.last_decrease >= self.latency_target:
+                self.limit = max(self.min_limit, self.limit * self.backoff)
+                self.last_decrease = now
+                self.stats["decreases"] += 1
+        elif latency is not None:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            # A higher limit may let waiting calls start
+            self.dispatch()
+
+    @asynccontextmanager
+    async def slot(self, priority=INTERACTIVE):
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def snapshot(self):
+        return {
+            **self.stats,
+            "limit": self.limit,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting(),
+        }
@@ -0,0 +1,116 @@
+import time
+import logging
+from collections import OrderedDict
+
+import numpy as np
+
+
+class SemanticPartition:
+    # Question embeddings of one partition as rows of a float32 matrix, so a
+    # lookup is a single matrix-vector product. Rows are reused oldest first
+    # once the partition is full.
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.embeddings = None
+        self.expires = np.zeros(0)
+        self.answers = []
+        self.next = 0
+
+    def search(self, embedding, now):
+        if self.embeddings is None:
+            return None, -1.0
+
+        scores = self.embeddings[: len(self.answers)] @ embedding
+        scores[self.expires[: len(self.answers)] <= now] = -1.0
+        best = int(np.argmax(scores))
+        return self.answers[best], float(scores[best])
+
+    def add(self, embedding, answer, expires):
+        if self.embeddings is None:
+            self.embeddings = np.zeros((min(16, self.max_entries), len(embedding)), dtype=np.float32)
+            self.expires = np.zeros(len(self.embeddings))
+
+        row = self.next
+        if row == len(self.embeddings):
+            # Grow by doubling until the partition reaches its size bound
+            capacity = min(len(self.embeddings) * 2, self.max_entries)
+            grown = np.zeros((capacity, self.embeddings.shape[1]), dtype=np.float32)
+            grown[:row] = self.embeddings
+            self.embeddings = grown
+            grown = np.zeros(capacity)
+            grown[:row] = self.expires
+            self.expires = grown
+
+        self.embeddings[row] = embedding
+        self.expires[row] = expires
+        if row == len(self.answers):
+            self.answers.append(answer)
+        else:
+            self.answers[row] = answer
+        self.next = (row + 1) % self.max_entries
+
+
+class SemanticCache:
+    # Finds cached answers to paraphrased questions by the cosine similarity
+    # of their embeddings. Entries are partitioned by everything else that
+    # shapes the answer, including the user's security filter, and only ever
+    # compared within a partition.
+    #
+    # embed is an async callable returning the embedding of a text, so tests
+    # can replace the embedding deployment with a local stand-in.
+
+    def __init__(
+        self,
+        embed,
+        threshold: float = 0.95,
+        ttl: float = 3600,
+        partition_size: int = 500,
+        max_partitions: int = 100,
+    ):
+        self.embed = embed
+        self.threshold = threshold
+        self.ttl = ttl
+        self.partition_size = partition_size
+        self.max_partitions = max_partitions
+        self.partitions = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "embedding_failures": 0}
+
+    async def embed_question(self, question):
+        # A failed embedding only skips the cache, it never fails the request
+        try:
+            embedding = np.asarray(await self.embed(question), dtype=np.float32)
+        except Exception as e:
+            logging.warning(f"Failed to embed question for the semantic cache: {e}")
+            self.stats["embedding_failures"] += 1
+            return None
+
+        norm = np.linalg.norm(embedding)
+        return embedding / norm if norm else embedding
+
+    def get(self, partition_key, embedding):
+        partition = self.partitions.get(partition_key)
+        if partition is not None:
+            self.partitions.move_to_end(partition_key)
+            answer, score = partition.search(embedding, time.monotonic())
+            if score >= self.threshold:
+                self.stats["hits"] += 1
+                return answer
+
+        self.stats["misses"] += 1
+        return None
+
+    def put(self, partition_key, embedding, answer):
+        if not answer.content:
+            return
+
+        partition = self.partitions.get(partition_key)
+        if partition is None:
+            partition = self.partitions[partition_key] = SemanticPartition(self.partition_size)
+            while len(self.partitions) > self.max_partitions:
+                self.partitions.popitem(last=False)
+
+        partition.add(embedding, answer, time.monotonic() + self.ttl)
+        self.stats["stores"] += 1
+
+    def entries(self):
+        return sum(len(partition.answers) for partition in self.partitions.values())
@@ -0,0 +1,157 @@
+import copy
+import uuid
+import asyncio
+
+DONE = object()
+
+
+def with_new_id(completion):
+    # Every subscriber gets its own completion id, which the frontend uses as
+    # the id of the assistant message it saves to the conversation history
+    completion = copy.copy(completion)
+    completion.id = f"chatcmpl-{uuid.uuid4().hex}"
+    return completion
+
+
+class Subscription:
+    # One request's view of a shared streamed completion. Closing it only
+    # unsubscribes the request; the completion goes on for the others.
+    def __init__(self, flight, leader):
+        self.flight = flight
+        self.leader = leader
+        self.queue = asyncio.Queue()
+        self.id = None if leader else f"chatcmpl-{uuid.uuid4().hex}"
+        self.response = self
+
+    async def __aiter__(self):
+        while True:
+            item = await self.queue.get()
+            if item is DONE:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            if self.id:
+                item = copy.copy(item)
+                item.id = self.id
+            yield item
+
+    async def aclose(self):
+        # True when this was the last subscriber and the completion stopped
+        return self.flight.unsubscribe(self)
+
+
+class StreamFlight:
+    # Reads one upstream streamed completion in a background task and fans
+    # its chunks out to the queue of every subscribed request. Subscribers
+    # that join late first receive the chunks they missed.
+    def __init__(self, key, group, start):
+        self.key = key
+        self.group = group
+        self.chunks = []
+        self.subscribers = set()
+        self.done = False
+        self.started = asyncio.get_running_loop().create_future()
+        self.task = asyncio.create_task(self.run(start))
+
+    async def run(self, start):
+        stream = None
+        try:
+            stream, apim_request_id = await start()
+            self.started.set_result(apim_request_id)
+            async for chunk in stream:
+                self.chunks.append(chunk)
+                for subscription in self.subscribers:
+                    subscription.queue.put_nowait(chunk)
+            self.finish(DONE)
+        except asyncio.CancelledError:
+            # Every subscriber left, so nobody is waiting for the result
+            if not self.started.done():
+                self.started.cancel()
+            raise
+        except Exception as e:
+            if not self.started.done():
+                self.started.set_exception(e)
+            self.finish(e)
+        finally:
+            self.group.remove(self)
+            if stream is not None and hasattr(stream, "response"):
+                await stream.response.aclose()
+
+    def finish(self, item):
+        self.done = True
+        self.chunks.append(item)
+        for subscription in self.subscribers:
+            subscription.queue.put_nowait(item)
+
+    def subscribe(self, leader):
+        subscription = Subscription(self, leader)
+        for chunk in self.chunks:
+            subscription.queue.put_nowait(chunk)
+        self.subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self.subscribers.discard(subscription)
+        if not self.subscribers and not self.done:
+            # The last subscriber is gone, leader or not; stop the upstream
+            # completion nobody is reading anymore
+            self.group.remove(self)
+            self.task.cancel()
+            return True
+        return False
+
+
+class SingleFlight:
+    # Shares one upstream call between concurrent requests with the same key
+
+    def __init__(self):
+        self.flights = {}
+        self.tasks = {}
+        self.stats = {"leaders": 0, "followers": 0}
+
+    def remove(self, flight):
+        if self.flights.get(flight.key) is flight:
+            del self.flights[flight.key]
+
+    async def stream(self, key, start):
+        # start is a coroutine function returning the upstream stream and
+        # its apim request id; it is only called by the first request
+        flight = self.flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = self.flights[key] = StreamFlight(key, self, start)
+            self.stats["leaders"] += 1
+        else:
+            self.stats["followers"] += 1
+
+        subscription = flight.subscribe(leader)
+        try:
+            apim_request_id = await asyncio.shield(flight.started)
+        except BaseException:
+            flight.unsubscribe(subscription)
+            raise
+        return subscription, apim_request_id
+
+    def task_done(self, key):
+        def callback(task):
+            if self.tasks.get(key) is task:
+                del self.tasks[key]
+            # Mark the error as retrieved even if every request went away
+            if not task.cancelled():
+                task.exception()
+
+        return callback
+
+    async def complete(self, key, start):
+        task = self.tasks.get(key)
+        leader = task is None
+        if leader:
+            task = self.tasks[key] = asyncio.create_task(start())
+            task.add_done_callback(self.task_done(key))
+            self.stats["leaders"] += 1
+        else:
+            self.stats["followers"] += 1
+
+        # A request that goes away doesn't cancel the call the others wait on
+        completion, apim_request_id = await asyncio.shield(task)
+        return (completion if leader else with_new_id(completion)), apim_request_id
@@ -1,8 +1,14 @@
 import os
 import json
+import time
+import asyncio
+import hashlib
 import logging
-import requests
 import dataclasses
+from collections import OrderedDict
+
+import httpx
+import orjson
 
 DEBUG = os.environ.get("DEBUG", "false")
 if DEBUG.lower() == "true":
@@ -11,6 +17,18 @@ if DEBUG.lower() == "true":
 AZURE_SEARCH_PERMITTED_GROUPS_COLUMN = os.environ.get(
     "AZURE_SEARCH_PERMITTED_GROUPS_COLUMN"
 )
+AZURE_SEARCH_PERMITTED_GROUPS_CACHE_TTL = os.environ.get(
+    "AZURE_SEARCH_PERMITTED_GROUPS_CACHE_TTL", 300
+)
+AZURE_SEARCH_PERMITTED_GROUPS_CACHE_SIZE = os.environ.get(
+    "AZURE_SEARCH_PERMITTED_GROUPS_CACHE_SIZE", 1000
+)
+AZURE_SEARCH_FILTER_CACHE_TTL = os.environ.get("AZURE_SEARCH_FILTER_CACHE_TTL", 3600)
+AZURE_SEARCH_FILTER_CACHE_SIZE = os.environ.get("AZURE_SEARCH_FILTER_CACHE_SIZE", 1000)
+
+GRAPH_USER_GROUPS_ENDPOINT = (
+    "https://graph.microsoft.com/v1.0/me/transitiveMemberOf?$select=id&$top=999"
+)
 
 
 class JSONEncoder(json.JSONEncoder):
@@ -20,6 +38,14 @@ class JSONEncoder(json.JSONEncoder):
         return super().default(o)
 
 
+async def aclose_stream(r):
+    # async for does not close the iterator it stops consuming, so close it
+    # explicitly to release the upstream response right away
+    aclose = getattr(r, "aclose", None)
+    if aclose:
+        await aclose()
+
+
 async def format_as_ndjson(r):
     try:
         async for event in r:
@@ -27,6 +53,127 @@ async def format_as_ndjson(r):
     except Exception as error:
         logging.exception("Exception while generating response stream: %s", error)
         yield json.dumps({"error": str(error)})
+    finally:
+        await aclose_stream(r)
+
+
+def fast_dumps(obj):
+    return orjson.dumps(obj).decode("utf-8")
+
+
+async def format_as_compact_ndjson(r):
+    # Compact stream frames only hold plain dicts, so skip the custom encoder
+    try:
+        async for event in r:
+            yield fast_dumps(event) + "\n"
+    except Exception as error:
+        logging.exception("Exception while generating response stream: %s", error)
+        yield json.dumps({"error": str(error)})
+    finally:
+        await aclose_stream(r)
+
+
+def stream_event_content(event):
+    # Assistant content deltas can be merged; anything else (citations, tool
+    # messages, headers, errors) has to be sent as is
+    if "c" in event:
+        return event["c"]
+    messages = event.get("choices", [{}])[0].get("messages", [])
+    if len(messages) == 1 and messages[0].get("role") == "assistant":
+        return messages[0].get("content")
+    return None
+
+
+def append_stream_event_content(event, content):
+    if "c" in event:
+        event["c"] += content
+    else:
+        event["choices"][0]["messages"][0]["content"] += content
+
+
+async def coalesce_stream_events(r, window_ms, max_bytes):
+    # Batch consecutive assistant content deltas until the time window has
+    # elapsed or the batch has grown to max_bytes. The first delta and every
+    # non-content event are sent right away so time to first token and
+    # citations are not delayed.
+    if window_ms <= 0:
+        try:
+            async for event in r:
+                yield event
+        finally:
+            await aclose_stream(r)
+        return
+
+    loop = asyncio.get_running_loop()
+    events = r.__aiter__()
+    next_event = None
+    pending = None
+    pending_size = 0
+    deadline = 0
+    first_content_sent = False
+    try:
+        while True:
+            if next_event is None:
+                next_event = asyncio.ensure_future(events.__anext__())
+
+            timeout = None if pending is None else max(deadline - loop.time(), 0)
+            done, _ = await asyncio.wait({next_event}, timeout=timeout)
+            if not done:
+                yield pending
+                pending = None
+                continue
+
+            try:
+                event = next_event.result()
+            except StopAsyncIteration:
+                break
+            except Exception:
+                if pending:
+                    yield pending
+                    pending = None
+                raise
+            finally:
+                if next_event.done():
+                    next_event = None
+
+            if not event:
+                continue
+
+            content = stream_event_content(event)
+            if content is None:
+                if pending:
+                    yield pending
+                    pending = None
+                yield event
+                continue
+
+            if not first_content_sent:
+                first_content_sent = True
+                yield event
+                continue
+
+            if pending is None:
+                pending = event
+                pending_size = len(content.encode("utf-8"))
+                deadline = loop.time() + window_ms / 1000
+            else:
+                append_stream_event_content(pending, content)
+                pending_size += len(content.encode("utf-8"))
+
+            if pending_size >= max_bytes:
+                yield pending
+                pending = None
+
+        if pending:
+            yield pending
+    finally:
+        if next_event is not None:
+            next_event.cancel()
+            try:
+                await next_event
+            except (asyncio.CancelledError, Exception):
+                pass
+        await aclose_stream(events)
 
 
 def parse_multi_columns(columns: str) -> list:
@@ -36,41 +183,117 @@ def parse_multi_columns(columns: str) -> list:
         return columns.split(",")
 
 
-def fetchUserGroups(userToken, nextLink=None):
-    # Recursively fetch group membership
-    if nextLink:
-        endpoint = nextLink
-    else:
-        endpoint = "https://graph.microsoft.com/v1.0/me/transitiveMemberOf?$select=id"
+# Graph client shared by every request served by this worker
+graph_client = None
+
+# user object id -> (expiry timestamp, group membership)
+user_groups_cache = OrderedDict()
 
+
+def get_graph_client():
+    global graph_client
+    if graph_client is None:
+        graph_client = httpx.AsyncClient(timeout=10.0)
+    return graph_client
+
+
+async def close_graph_client():
+    global graph_client
+    if graph_client is not None:
+        await graph_client.aclose()
+        graph_client = None
+
+
+async def fetchUserGroups(userToken, user_id=None):
+    # Group membership only changes rarely, so cache it per user
+    if user_id:
+        cached = user_groups_cache.get(user_id)
+        if cached and cached[0] > time.monotonic():
+            user_groups_cache.move_to_end(user_id)
+            return cached[1]
+
+    client = get_graph_client()
     headers = {"Authorization": "bearer " + userToken}
+    groups = []
+    page = None
     try:
-        r = requests.get(endpoint, headers=headers)
-        if r.status_code != 200:
-            logging.error(f"Error fetching user groups: {r.status_code} {r.text}")
-            return []
-
-        r = r.json()
-        if "@odata.nextLink" in r:
-            nextLinkData = fetchUserGroups(userToken, r["@odata.nextLink"])
-            r["value"].extend(nextLinkData)
+        # Request the next page as soon as its link is known, so it is in
+        # flight while the current page is being processed
+        page = asyncio.create_task(
+            client.get(GRAPH_USER_GROUPS_ENDPOINT, headers=headers)
+        )
+        while page:
+            r = await page
+            if r.status_code != 200:
+                logging.error(f"Error fetching user groups: {r.status_code} {r.text}")
+                return []
 
-        return r["value"]
+            r = r.json()
+            page = None
+            if "@odata.nextLink" in r:
+                page = asyncio.create_task(
+                    client.get(r["@odata.nextLink"], headers=headers)
+                )
+            groups.extend(r["value"])
     except Exception as e:
+        if page:
+            page.cancel()
         logging.error(f"Exception in fetchUserGroups: {e}")
         return []
 
+    if user_id:
+        user_groups_cache[user_id] = (
+            time.monotonic() + float(AZURE_SEARCH_PERMITTED_GROUPS_CACHE_TTL),
+            groups,
+        )
+        user_groups_cache.move_to_end(user_id)
+        while len(user_groups_cache) > int(AZURE_SEARCH_PERMITTED_GROUPS_CACHE_SIZE):
+            user_groups_cache.popitem(last=False)
+
+    return groups
 
-def generateFilterString(userToken):
-    # Get list of groups user is a member of
-    userGroups = fetchUserGroups(userToken)
+
+# sha256 of the sorted group set -> (expiry timestamp, compiled filter)
+filter_cache = OrderedDict()
+filter_cache_stats = {"hits": 0, "misses": 0}
+
+
+def compileFilterString(group_ids):
+    # Users with the same group membership share one compiled filter
+    group_ids = sorted(set(group_ids))
+    key = hashlib.sha256("\n".join(group_ids).encode()).hexdigest()
+
+    cached = filter_cache.get(key)
+    if cached and cached[0] > time.monotonic():
+        filter_cache.move_to_end(key)
+        filter_cache_stats["hits"] += 1
+        return cached[1]
+
+    filter_cache_stats["misses"] += 1
+    filter_string = f"{AZURE_SEARCH_PERMITTED_GROUPS_COLUMN}/any(g:search.in(g, '{', '.join(group_ids)}'))"
+    filter_cache[key] = (
+        time.monotonic() + float(AZURE_SEARCH_FILTER_CACHE_TTL),
+        filter_string,
+    )
+    filter_cache.move_to_end(key)
+    while len(filter_cache) > int(AZURE_SEARCH_FILTER_CACHE_SIZE):
+        filter_cache.popitem(last=False)
+
+    return filter_string
+
+
+async def generateFilterString(userToken, user_id=None, group_ids=None):
+    # Get list of groups user is a member of, unless they were already
+    # provided by the user's token claims
+    if group_ids is None:
+        userGroups = await fetchUserGroups(userToken, user_id)
+        group_ids = [obj["id"] for obj in userGroups]
 
     # Construct filter string
-    if not userGroups:
+    if not group_ids:
         logging.debug("No user groups found")
 
-    group_ids = ", ".join([obj["id"] for obj in userGroups])
-    return f"{AZURE_SEARCH_PERMITTED_GROUPS_COLUMN}/any(g:search.in(g, '{group_ids}'))"
+    return compileFilterString(group_ids)
 
 
 def format_non_streaming_response(chatCompletion, history_metadata, apim_request_id):
@@ -104,43 +327,116 @@ def format_non_streaming_response(chatCompletion, history_metadata, apim_request
 
     return {}
 
-def format_stream_response(chatCompletionChunk, history_metadata, apim_request_id):
-    response_obj = {
-        "id": chatCompletionChunk.id,
-        "model": chatCompletionChunk.model,
-        "created": chatCompletionChunk.created,
-        "object": chatCompletionChunk.object,
-        "choices": [{"messages": []}],
-        "history_metadata": history_metadata,
-        "apim-request-id": apim_request_id,
-    }
-
+def format_stream_message(chatCompletionChunk):
     if len(chatCompletionChunk.choices) > 0:
         delta = chatCompletionChunk.choices[0].delta
         if delta:
             if hasattr(delta, "context"):
-                messageObj = {"role": "tool", "content": json.dumps(delta.context)}
-                response_obj["choices"][0]["messages"].append(messageObj)
-                return response_obj
+                return {"role": "tool", "content": json.dumps(delta.context)}
             if delta.role == "assistant" and hasattr(delta, "context"):
-                messageObj = {
+                return {
                     "role": "assistant",
                     "context": delta.context,
                 }
-                response_obj["choices"][0]["messages"].append(messageObj)
-                return response_obj
             else:
                 if delta.content:
-                    messageObj = {
+                    return {
                         "role": "assistant",
                         "content": delta.content,
                     }
-                    response_obj["choices"][0]["messages"].append(messageObj)
-                    return response_obj
+
+    return None
+
+
+def format_stream_response(chatCompletionChunk, history_metadata, apim_request_id):
+    response_obj = {
+        "id": chatCompletionChunk.id,
+        "model": chatCompletionChunk.model,
+        "created": chatCompletionChunk.created,
+        "object": chatCompletionChunk.object,
+        "choices": [{"messages": []}],
+        "history_metadata": history_metadata,
+        "apim-request-id": apim_request_id,
+    }
+
+    messageObj = format_stream_message(chatCompletionChunk)
+    if messageObj:
+        response_obj["choices"][0]["messages"].append(messageObj)
+        return response_obj
 
     return {}
 
 
+# Compact streaming format: a single header frame carries the response
+# metadata, every following frame only carries a message delta.
+#   {"h": {"id": ..., "model": ..., "created": ..., "object": ..., "history_metadata": ..., "apim-request-id": ...}}
+#   {"c": "assistant content delta"}
+#   {"m": {"role": "tool", "content": "..."}}
+def format_stream_header(chatCompletionChunk, history_metadata, apim_request_id):
+    return {
+        "h": {
+            "id": chatCompletionChunk.id,
+            "model": chatCompletionChunk.model,
+            "created": chatCompletionChunk.created,
+            "object": chatCompletionChunk.object,
+            "history_metadata": history_metadata,
+            "apim-request-id": apim_request_id,
+        }
+    }
+
+
+def format_compact_stream_frames(chatCompletionChunk, header_id, history_metadata, apim_request_id):
+    # Frames for one chunk in the compact format, and the id of the header
+    # sent so far (None before the first one). Azure opens a stream with a
+    # prompt_filter_results chunk that has no id, model or choices, so the
+    # header waits for a chunk that identifies the completion, and is sent
+    # again whenever the completion id changes.
+    frames = []
+    chunk_id = chatCompletionChunk.id
+    if (header_id is None and (chunk_id or chatCompletionChunk.choices)) or (
+        chunk_id and chunk_id != header_id
+    ):
+        frames.append(
+            format_stream_header(chatCompletionChunk, history_metadata, apim_request_id)
+        )
+        header_id = chunk_id
+    delta = format_stream_delta(chatCompletionChunk)
+    if delta:
+        frames.append(delta)
+    return frames, header_id
+
+
+def format_stream_delta(chatCompletionChunk):
+    messageObj = format_stream_message(chatCompletionChunk)
+    if not messageObj:
+        return None
+    if messageObj["role"] == "assistant" and "content" in messageObj:
+        return {"c": messageObj["content"]}
+    return {"m": messageObj}
+
+
+# History metadata that is only known after the answer, like the generated
+# title of a new conversation, follows the last frame in both formats:
+#   {"history_metadata": {...}}
+def format_stream_metadata(history_metadata):
+    return {"history_metadata": history_metadata}
+
+
+def heuristic_title(messages, max_words=6, max_length=60):
+    # The opening words of the latest question, used until the model has
+    # named the conversation
+    question = next(
+        (m["content"] for m in reversed(messages) if m["role"] == "user"), ""
+    )
+    if not isinstance(question, str):
+        question = str(question)
+    words = question.split()[:max_words]
+    title = " ".join(words).strip(" .,;:!?\"'")
+    if len(title) > max_length:
+        title = title[:max_length].rsplit(" ", 1)[0]
+    return title or "New chat"
+
+
 def format_pf_non_streaming_response(
     chatCompletion, history_metadata, response_field_name, citations_field_name, message_uuid=None
 ):
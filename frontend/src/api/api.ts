@@ -1,11 +1,39 @@
-import { UserInfo, ConversationRequest, Conversation, ChatMessage, CosmosDBHealth, CosmosDBStatus } from "./models";
+import { UserInfo, ConversationRequest, Conversation, ConversationPage, ChatMessage, MessagePage, ChatResponse, CosmosDBHealth, CosmosDBStatus } from "./models";
 import { chatHistorySampleData } from "../constants/chatHistory";
 
+const STREAM_FORMAT_HEADER = "X-Stream-Format";
+const COMPACT_STREAM_FORMAT = "compact";
+const CONTINUATION_TOKEN_HEADER = "X-Continuation-Token";
+
+// Returns a function that turns each parsed stream frame into a ChatResponse.
+// Compact streams send the response metadata once in a header frame ({"h": ...})
+// followed by delta frames ({"c": content} or {"m": message}); the header frame
+// itself yields null. Frames of regular streams are returned unchanged.
+export const createStreamFrameDecoder = (response: Response) => {
+    if (response.headers.get(STREAM_FORMAT_HEADER) !== COMPACT_STREAM_FORMAT) {
+        return (frame: any): ChatResponse | null => frame;
+    }
+
+    let header: any = {};
+    return (frame: any): ChatResponse | null => {
+        if (frame.h) {
+            header = frame.h;
+            return null;
+        }
+        if (frame.c === undefined && frame.m === undefined) {
+            return frame;
+        }
+        const message = frame.m ?? { role: "assistant", content: frame.c };
+        return { ...header, choices: [{ messages: [message] }] };
+    };
+}
+
 export async function conversationApi(options: ConversationRequest, abortSignal: AbortSignal): Promise<Response> {
     const response = await fetch("/conversation", {
         method: "POST",
         headers: {
-            "Content-Type": "application/json"
+            "Content-Type": "application/json",
+            [STREAM_FORMAT_HEADER]: COMPACT_STREAM_FORMAT
         },
         body: JSON.stringify({
             messages: options.messages
@@ -35,8 +63,9 @@ export const fetchChatHistoryInit = (): Conversation[] | null => {
     return chatHistorySampleData;
 }
 
-export const historyList = async (offset=0): Promise<Conversation[] | null> => {
-    const response = await fetch(`/history/list?offset=${offset}`, {
+export const historyList = async (continuationToken?: string | null): Promise<ConversationPage | null> => {
+    const query = continuationToken ? `?continuation_token=${encodeURIComponent(continuationToken)}` : "";
+    const response = await fetch(`/history/list${query}`, {
         method: "GET",
     }).then(async (res) => {
         const payload = await res.json();
@@ -44,25 +73,17 @@ export const historyList = async (offset=0): Promise<Conversation[] | null> => {
             console.error("There was an issue fetching your data.");
             return null;
         }
-        const conversations: Conversation[] = await Promise.all(payload.map(async (conv: any) => {
-            let convMessages: ChatMessage[] = [];
-            convMessages = await historyRead(conv.id)
-            .then((res) => {
-                return res
-            })
-            .catch((err) => {
-                console.error("error fetching messages: ", err)
-                return []
-            })
+        // Messages are read a page at a time when a conversation is opened, see historyRead
+        const conversations: Conversation[] = payload.map((conv: any) => {
             const conversation: Conversation = {
                 id: conv.id,
                 title: conv.title,
                 date: conv.createdAt,
-                messages: convMessages
+                messages: []
             };
             return conversation;
-        }));
-        return conversations;
+        });
+        return { conversations, continuationToken: res.headers.get(CONTINUATION_TOKEN_HEADER) };
     }).catch((err) => {
         console.error("There was an issue fetching your data.");
         return null
@@ -71,19 +92,22 @@ export const historyList = async (offset=0): Promise<Conversation[] | null> => {
     return response
 }
 
-export const historyRead = async (convId: string): Promise<ChatMessage[]> => {
+// Reads a page of a conversation's messages, newest page first, with the
+// messages of the page in chronological order. Returns null on failure.
+export const historyRead = async (convId: string, continuationToken?: string | null): Promise<MessagePage | null> => {
     const response = await fetch("/history/read", {
         method: "POST",
         body: JSON.stringify({
-            conversation_id: convId
+            conversation_id: convId,
+            continuation_token: continuationToken ?? undefined
         }),
         headers: {
             "Content-Type": "application/json"
         },
     })
     .then(async (res) => {
-        if(!res){
-            return []
+        if(!res?.ok){
+            return null
         }
         const payload = await res.json();
         let messages: ChatMessage[] = [];
@@ -99,10 +123,10 @@ export const historyRead = async (convId: string): Promise<ChatMessage[]> => {
                 messages.push(message)
             });
         }
-        return messages;
+        return { messages: messages.reverse(), continuationToken: res.headers.get(CONTINUATION_TOKEN_HEADER) };
     }).catch((err) => {
         console.error("There was an issue fetching your data.");
-        return []
+        return null
     })
     return response
 }
@@ -122,7 +146,8 @@ export const historyGenerate = async (options: ConversationRequest, abortSignal:
     const response = await fetch("/history/generate", {
         method: "POST",
         headers: {
-            "Content-Type": "application/json"
+            "Content-Type": "application/json",
+            [STREAM_FORMAT_HEADER]: COMPACT_STREAM_FORMAT
         },
         body: body,
         signal: abortSignal
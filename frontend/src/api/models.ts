@@ -38,6 +38,8 @@ export type Conversation = {
     title: string;
     messages: ChatMessage[];
     date: string;
+    // Set while older messages of the conversation are still to be read
+    messagesContinuationToken?: string | null;
 }
 
 export enum ChatCompletionType {
@@ -63,6 +65,18 @@ export type ChatResponse = {
     error?: any;
 }
 
+// A page of chat history; the next page is requested with continuationToken,
+// which is null on the last page
+export type ConversationPage = {
+    conversations: Conversation[];
+    continuationToken: string | null;
+}
+
+export type MessagePage = {
+    messages: ChatMessage[];
+    continuationToken: string | null;
+}
+
 export type ConversationRequest = {
     messages: ChatMessage[];
 };
@@ -7,7 +7,7 @@ import { GroupedChatHistory } from './ChatHistoryList';
 import styles from "./ChatHistoryPanel.module.css"
 import { useBoolean } from '@fluentui/react-hooks';
 import { Conversation } from '../../api/models';
-import { historyDelete, historyRename, historyList } from '../../api';
+import { historyDelete, historyRename, historyList, historyRead } from '../../api';
 import { useEffect, useRef, useState, useContext } from 'react';
 
 interface ChatHistoryListItemCellProps {
@@ -100,9 +100,17 @@ export const ChatHistoryListItemCell: React.FC<ChatHistoryListItemCellProps> = (
         setEditTitle(item?.title)
     };
 
-    const handleSelectItem = () => {
+    const handleSelectItem = async () => {
         onSelect(item)
         appStateContext?.dispatch({ type: 'UPDATE_CURRENT_CHAT', payload: item } )
+        // The history list doesn't include messages; the newest page is shown
+        // as soon as it is read, older pages are read from the chat on demand
+        if (item && item.messages.length === 0 && item.messagesContinuationToken === undefined) {
+            const page = await historyRead(item.id)
+            if (page) {
+                appStateContext?.dispatch({ type: 'PREPEND_CONVERSATION_MESSAGES', payload: { id: item.id, messages: page.messages, continuationToken: page.continuationToken } })
+            }
+        }
     }
 
     const truncatedTitle = (item?.title?.length > 28) ? `${item.title.substring(0, 28)} ...` : item.title;
@@ -247,7 +255,6 @@ export const ChatHistoryListItemGroups: React.FC<ChatHistoryListItemGroupsProps>
     const appStateContext = useContext(AppStateContext);
     const observerTarget = useRef(null);
     const [ , setSelectedItem] = React.useState<Conversation | null>(null);
-    const [offset, setOffset] = useState<number>(25);
     const [observerCounter, setObserverCounter] = useState(0);
     const [showSpinner, setShowSpinner] = useState(false);
     const firstRender = useRef(true);
@@ -270,17 +277,22 @@ export const ChatHistoryListItemGroups: React.FC<ChatHistoryListItemGroupsProps>
             return;
         }
         handleFetchHistory();
-        setOffset((offset) => offset += 25);
     }, [observerCounter]);
 
     const handleFetchHistory = async () => {
         const currentChatHistory = appStateContext?.state.chatHistory;
+        const continuationToken = appStateContext?.state.chatHistoryContinuationToken;
+        if (!continuationToken) {
+            // Every page has been loaded
+            return;
+        }
         setShowSpinner(true);
 
-        await historyList(offset).then((response) => {
-            const concatenatedChatHistory = currentChatHistory && response && currentChatHistory.concat(...response)
+        await historyList(continuationToken).then((response) => {
+            const concatenatedChatHistory = currentChatHistory && response && currentChatHistory.concat(...response.conversations)
             if (response) {
-                appStateContext?.dispatch({ type: 'FETCH_CHAT_HISTORY', payload: concatenatedChatHistory || response });
+                appStateContext?.dispatch({ type: 'FETCH_CHAT_HISTORY', payload: concatenatedChatHistory || response.conversations });
+                appStateContext?.dispatch({ type: 'SET_CHAT_HISTORY_CONTINUATION_TOKEN', payload: response.continuationToken });
             } else {
                 appStateContext?.dispatch({ type: 'FETCH_CHAT_HISTORY', payload: null });
             }
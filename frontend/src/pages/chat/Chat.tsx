@@ -17,6 +17,7 @@ import {
     ChatMessage,
     ConversationRequest,
     conversationApi,
+    createStreamFrameDecoder,
     Citation,
     ToolMessageContent,
     ChatResponse,
@@ -25,6 +26,7 @@ import {
     historyGenerate,
     historyUpdate,
     historyClear,
+    historyRead,
     ChatHistoryLoadingState,
     CosmosDBStatus,
     ErrorMessage
@@ -193,6 +195,7 @@ const Chat = () => {
             const response = await conversationApi(request, abortController.signal);
             if (response?.body) {
                 const reader = response.body.getReader();
+                const decodeFrame = createStreamFrameDecoder(response);
 
                 let runningText = "";
                 while (true) {
@@ -206,7 +209,12 @@ const Chat = () => {
                         try {
                             if (obj !== "" && obj !== "{}") {
                                 runningText += obj;
-                                result = JSON.parse(runningText);
+                                const frame = decodeFrame(JSON.parse(runningText));
+                                if (!frame) {
+                                    runningText = "";
+                                    return;
+                                }
+                                result = frame;
                                 if (result.choices?.length > 0) {
                                     result.choices[0].messages.forEach((msg) => {
                                         msg.id = result.id;
@@ -347,6 +355,7 @@ const Chat = () => {
             }
             if (response?.body) {
                 const reader = response.body.getReader();
+                const decodeFrame = createStreamFrameDecoder(response);
 
                 let runningText = "";
                 while (true) {
@@ -360,7 +369,18 @@ const Chat = () => {
                         try {
                             if (obj !== "" && obj !== "{}") {
                                 runningText += obj;
-                                result = JSON.parse(runningText);
+                                const frame = decodeFrame(JSON.parse(runningText));
+                                if (!frame) {
+                                    runningText = "";
+                                    return;
+                                }
+                                if (frame.history_metadata && !frame.choices) {
+                                    // Metadata sent after the answer, like the generated title of a new conversation
+                                    result.history_metadata = { ...result.history_metadata, ...frame.history_metadata };
+                                    runningText = "";
+                                    return;
+                                }
+                                result = frame;
                                 if (!result.choices?.[0]?.messages?.[0].content) {
                                     errorResponseMessage = NO_CONTENT_ERROR;
                                     throw Error();
@@ -554,6 +574,21 @@ const Chat = () => {
         setProcessMessages(messageStatus.Done)
     };
 
+    const [loadingEarlierMessages, setLoadingEarlierMessages] = useState<boolean>(false);
+
+    const loadEarlierMessages = async () => {
+        const conversation = appStateContext?.state.currentChat;
+        if (!conversation?.messagesContinuationToken || loadingEarlierMessages) {
+            return;
+        }
+        setLoadingEarlierMessages(true);
+        const page = await historyRead(conversation.id, conversation.messagesContinuationToken);
+        if (page) {
+            appStateContext?.dispatch({ type: 'PREPEND_CONVERSATION_MESSAGES', payload: { id: conversation.id, messages: page.messages, continuationToken: page.continuationToken } });
+        }
+        setLoadingEarlierMessages(false);
+    }
+
     const stopGenerating = () => {
         abortFuncs.current.forEach(a => a.abort());
         setShowLoadingMessage(false);
@@ -686,6 +721,14 @@ const Chat = () => {
                             </Stack>
                         ) : (
                             <div className={styles.chatMessageStream} style={{ marginBottom: isLoading ? "40px" : "0px" }} role="log">
+                                {appStateContext?.state.currentChat?.messagesContinuationToken && (
+                                    <CommandBarButton
+                                        className={styles.loadEarlierMessages}
+                                        text={loadingEarlierMessages ? "Loading earlier messages..." : "Load earlier messages"}
+                                        onClick={loadEarlierMessages}
+                                        disabled={loadingEarlierMessages}
+                                    />
+                                )}
                                 {messages.map((answer, index) => (
                                     <>
                                         {answer.role === "user" ? (
@@ -1,12 +1,13 @@
 import React, { createContext, useReducer, ReactNode, useEffect } from 'react';
 import { appStateReducer } from './AppReducer';
-import { Conversation, ChatHistoryLoadingState, CosmosDBHealth, historyList, historyEnsure, CosmosDBStatus, frontendSettings, FrontendSettings, Feedback } from '../api';
+import { Conversation, ChatMessage, ChatHistoryLoadingState, CosmosDBHealth, historyList, historyEnsure, CosmosDBStatus, frontendSettings, FrontendSettings, Feedback } from '../api';
   
 export interface AppState {
     isChatHistoryOpen: boolean;
     chatHistoryLoadingState: ChatHistoryLoadingState;
     isCosmosDBAvailable: CosmosDBHealth;
     chatHistory: Conversation[] | null;
+    chatHistoryContinuationToken: string | null;
     filteredChatHistory: Conversation[] | null;
     currentChat: Conversation | null;
     frontendSettings: FrontendSettings | null;
@@ -25,6 +26,8 @@ export type Action =
     | { type: 'DELETE_CHAT_HISTORY'}  // API Call
     | { type: 'DELETE_CURRENT_CHAT_MESSAGES', payload: string }  // API Call
     | { type: 'FETCH_CHAT_HISTORY', payload: Conversation[] | null }  // API Call
+    | { type: 'SET_CHAT_HISTORY_CONTINUATION_TOKEN', payload: string | null }
+    | { type: 'PREPEND_CONVERSATION_MESSAGES', payload: { id: string, messages: ChatMessage[], continuationToken: string | null } }  // API Call
     | { type: 'FETCH_FRONTEND_SETTINGS', payload: FrontendSettings | null }  // API Call
     | { type: 'SET_FEEDBACK_STATE'; payload: { answerId: string; feedback: Feedback.Positive | Feedback.Negative | Feedback.Neutral } }
     | { type: 'GET_FEEDBACK_STATE'; payload: string };
@@ -33,6 +36,7 @@ const initialState: AppState = {
     isChatHistoryOpen: false,
     chatHistoryLoadingState: ChatHistoryLoadingState.Loading,
     chatHistory: null,
+    chatHistoryContinuationToken: null,
     filteredChatHistory: null,
     currentChat: null,
     isCosmosDBAvailable: {
@@ -57,14 +61,15 @@ type AppStateProviderProps = {
 
     useEffect(() => {
         // Check for cosmosdb config and fetch initial data here
-        const fetchChatHistory = async (offset=0): Promise<Conversation[] | null> => {
-            const result = await historyList(offset).then((response) => {
+        const fetchChatHistory = async (): Promise<Conversation[] | null> => {
+            const result = await historyList().then((response) => {
                 if(response){
-                    dispatch({ type: 'FETCH_CHAT_HISTORY', payload: response});
+                    dispatch({ type: 'FETCH_CHAT_HISTORY', payload: response.conversations});
+                    dispatch({ type: 'SET_CHAT_HISTORY_CONTINUATION_TOKEN', payload: response.continuationToken });
                 }else{
                     dispatch({ type: 'FETCH_CHAT_HISTORY', payload: null });
                 }
-                return response
+                return response && response.conversations
             })
             .catch((err) => {
                 dispatch({ type: 'UPDATE_CHAT_HISTORY_LOADING_STATE', payload: ChatHistoryLoadingState.Fail });
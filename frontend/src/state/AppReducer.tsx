@@ -63,6 +63,26 @@ export const appStateReducer = (state: AppState, action: Action): AppState => {
             };
         case 'FETCH_CHAT_HISTORY':
             return { ...state, chatHistory: action.payload };
+        case 'SET_CHAT_HISTORY_CONTINUATION_TOKEN':
+            return { ...state, chatHistoryContinuationToken: action.payload };
+        case 'PREPEND_CONVERSATION_MESSAGES': {
+            // Messages read from the history are older than those already shown
+            const conversation = state.chatHistory?.find(conv => conv.id === action.payload.id)
+                ?? (state.currentChat?.id === action.payload.id ? state.currentChat : null);
+            if (!conversation) {
+                return state;
+            }
+            const updatedConversation = {
+                ...conversation,
+                messages: [...action.payload.messages, ...conversation.messages],
+                messagesContinuationToken: action.payload.continuationToken
+            };
+            return {
+                ...state,
+                chatHistory: state.chatHistory && state.chatHistory.map(conv => conv.id === action.payload.id ? updatedConversation : conv),
+                currentChat: state.currentChat?.id === action.payload.id ? updatedConversation : state.currentChat
+            };
+        }
         case 'SET_COSMOSDB_STATUS':
             return { ...state, isCosmosDBAvailable: action.payload };
         case 'FETCH_FRONTEND_SETTINGS':
@@ -0,0 +1,50 @@
+import asyncio
+import pytest
+from backend.admission import (
+    AdmissionController,
+    AdmissionRejectedError,
+    TokenBudget,
+    TokenCounter,
+)
+
+
+class WordCounter(TokenCounter):
+    def __init__(self):
+        self.encoding = None
+
+    def count_text(self, text):
+        return len(text.split())
+
+
+def test_budget_is_shared_through_its_file(tmp_path):
+    path = str(tmp_path / "budget")
+    worker_a = TokenBudget(600, path)
+    worker_b = TokenBudget(600, path)
+
+    assert worker_a.try_acquire(500) == 0
+    wait = worker_b.try_acquire(200)
+    # 10 tokens per second refill the missing 100 tokens in about 10s
+    assert 9 < wait <= 10
+    assert worker_b.try_acquire(100) == 0
+
+
+@pytest.mark.asyncio
+async def test_requests_queue_briefly_then_get_shed():
+    budget = TokenBudget(6000)
+    controller = AdmissionController(budget, WordCounter(), queue_size=1, max_wait=1)
+    messages = [{"role": "user", "content": "one two three"}]
+
+    # 3 framing + 4 + 3 words + 5990 max tokens leaves nothing in the budget
+    assert await controller.admit(messages, 5990) == 6000
+
+    # refilling 50 tokens takes 0.5s at 100 tokens per second
+    queued = asyncio.create_task(controller.admit(messages, 40))
+    await asyncio.sleep(0)
+    assert controller.waiting == 1
+
+    with pytest.raises(AdmissionRejectedError) as error:
+        await controller.admit(messages, 40)
+    assert error.value.status_code == 503 and error.value.retry_after > 0
+
+    assert await queued == 50
+    assert controller.stats == {"admitted": 2, "queued": 1, "rejected": 1, "tokens": 6050}
@@ -0,0 +1,36 @@
+import base64
+import json
+from backend.auth.auth_utils import get_principal_groups
+
+
+def encode_principal(claims):
+    principal = {"auth_typ": "aad", "claims": claims}
+    return base64.b64encode(json.dumps(principal).encode()).decode()
+
+
+def test_get_principal_groups():
+    principal = encode_principal(
+        [
+            {"typ": "name", "val": "user"},
+            {"typ": "groups", "val": "group1"},
+            {"typ": "groups", "val": "group2"},
+        ]
+    )
+    assert get_principal_groups(principal) == ["group1", "group2"]
+    assert get_principal_groups(principal) == ["group1", "group2"]
+
+
+def test_get_principal_groups_overage():
+    principal = encode_principal(
+        [
+            {"typ": "groups", "val": "group1"},
+            {"typ": "_claim_names", "val": '{"groups": "src1"}'},
+        ]
+    )
+    assert get_principal_groups(principal) is None
+
+
+def test_get_principal_groups_missing():
+    assert get_principal_groups(None) is None
+    assert get_principal_groups(encode_principal([{"typ": "name", "val": "user"}])) is None
+    assert get_principal_groups("not base64 json") is None
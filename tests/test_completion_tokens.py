@@ -0,0 +1,41 @@
+import pytest
+from types import SimpleNamespace
+from backend.completion_tokens import (
+    CompletionStats,
+    MeteredStream,
+    completion_token_limit,
+    model_context_length,
+)
+
+
+def test_max_tokens_fits_the_remaining_context():
+    assert model_context_length("gpt-35-turbo-16k") == 16384
+    assert model_context_length("gpt-4-32k-0613") == 32768
+    assert model_context_length("my-model") is None
+
+    assert completion_token_limit(16384, 2000, 1000) == 1000
+    assert completion_token_limit(4096, 3500, 1000) == 596
+    assert completion_token_limit(4096, 5000, 1000) == 1
+    assert completion_token_limit(None, 5000, 1000) == 1000
+
+
+class FakeStream:
+    response = None
+
+    async def __aiter__(self):
+        for content, finish_reason in [("Hello", None), (" world", None), (None, "length")]:
+            delta = SimpleNamespace(content=content)
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=delta, finish_reason=finish_reason)])
+
+
+@pytest.mark.asyncio
+async def test_streamed_completion_lengths_are_recorded():
+    stats = CompletionStats()
+    async for _ in MeteredStream(FakeStream(), stats, 2):
+        pass
+    stats.record(10, 100, "stop")
+
+    snapshot = stats.snapshot()
+    assert snapshot["completions"] == 2 and snapshot["truncated"] == 1
+    assert snapshot["p50_tokens"] == 10 and snapshot["max_tokens"] == 10
+    assert snapshot["mean_tokens"] == 6 and snapshot["mean_reserved_tokens"] == 51
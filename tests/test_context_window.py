@@ -0,0 +1,96 @@
+import pytest
+from backend.context_window import ContextWindow
+
+
+class WordCounter:
+    def count_text(self, text):
+        return len(text.split()) if text else 0
+
+    def count_messages(self, messages):
+        return sum(self.count_text(m["content"]) for m in messages)
+
+
+def conversation(turns):
+    messages = []
+    for i in range(turns):
+        messages.append({"role": "user", "content": f"question {i} " + "word " * 8})
+        messages.append({"role": "assistant", "content": f"answer {i} " + "word " * 8})
+    return messages
+
+
+class Summarizer:
+    def __init__(self):
+        self.calls = []
+
+    async def __call__(self, summary, messages):
+        self.calls.append((summary, len(messages)))
+        return f"summary of {len(messages)} after {summary}"
+
+
+@pytest.mark.asyncio
+async def test_short_conversations_are_sent_as_is():
+    summarize = Summarizer()
+    window = ContextWindow(WordCounter(), summarize, token_budget=100)
+    messages = conversation(2) + [{"role": "user", "content": "next"}]
+
+    assert await window.apply("conv", messages) == messages
+    assert summarize.calls == []
+
+
+@pytest.mark.asyncio
+async def test_older_turns_are_summarized_once_and_reused():
+    summarize = Summarizer()
+    window = ContextWindow(WordCounter(), summarize, token_budget=60)
+
+    # every message is 10 words, so 7 messages are over the budget
+    messages = conversation(3) + [{"role": "user", "content": "next question"}]
+    windowed = await window.apply("conv", messages)
+
+    # cut back to half the budget, at a user turn
+    assert windowed[0]["content"] == "Summary of our conversation so far: summary of 4 after None"
+    assert windowed[1:] == messages[4:]
+
+    # the next turn still fits, so the cached summary is reused
+    messages += [{"role": "assistant", "content": "short answer"}, {"role": "user", "content": "more"}]
+    windowed = await window.apply("conv", messages)
+    assert windowed[1:] == messages[4:]
+    assert len(summarize.calls) == 1 and window.stats["reused"] == 1
+
+    # once it overflows again only the newly dropped turns are summarized
+    messages += conversation(2)[1:] + [{"role": "user", "content": "last"}]
+    windowed = await window.apply("conv", messages)
+    assert summarize.calls[1][0] == "summary of 4 after None"
+    assert windowed[-1]["content"] == "last"
+
+
+@pytest.mark.asyncio
+async def test_summary_is_not_applied_to_a_different_conversation():
+    summarize = Summarizer()
+    window = ContextWindow(WordCounter(), summarize, token_budget=60)
+    messages = conversation(3) + [{"role": "user", "content": "next"}]
+    await window.apply("conv", messages)
+
+    edited = [{"role": "user", "content": "a different start"}] + messages[1:]
+    assert window.cached_summary("conv", edited) is None
+
+
+@pytest.mark.asyncio
+async def test_only_new_messages_are_counted_on_later_turns():
+    class CountingCounter(WordCounter):
+        def __init__(self):
+            self.counted = 0
+
+        def count_messages(self, messages):
+            self.counted += len(messages)
+            return super().count_messages(messages)
+
+    counter = CountingCounter()
+    window = ContextWindow(counter, Summarizer(), token_budget=100, token_cache_size=4)
+    messages = conversation(1) + [{"role": "user", "content": "next"}]
+    await window.apply("conv", messages)
+    assert counter.counted == 3
+
+    messages += [{"role": "assistant", "content": "answer"}, {"role": "user", "content": "more"}]
+    await window.apply("conv", messages)
+    assert counter.counted == 5
+    assert len(window.token_counts) == 4
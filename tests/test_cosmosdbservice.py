@@ -0,0 +1,143 @@
+import pytest
+from azure.cosmos import exceptions
+
+from backend.history.cosmosdbservice import (
+    CosmosConversationClient,
+    InvalidContinuationTokenError,
+)
+
+
+class FakeContainer:
+    def __init__(self):
+        self.batches = []
+
+    async def execute_item_batch(self, batch_operations, partition_key, response_hook=None):
+        self.batches.append((batch_operations, partition_key))
+        response_hook({"x-ms-request-charge": "12.5"}, [])
+        return []
+
+
+def make_client():
+    client = CosmosConversationClient.__new__(CosmosConversationClient)
+    client.enable_message_feedback = False
+    client.request_charges = {}
+    client.messages_written = 0
+    client.container_client = FakeContainer()
+    return client
+
+
+@pytest.mark.asyncio
+async def test_create_messages_is_a_single_batch():
+    client = make_client()
+    messages = await client.create_messages(
+        "c1",
+        "u1",
+        [("t1", {"role": "tool", "content": "{}"}), ("a1", {"role": "assistant", "content": "hi"})],
+    )
+
+    (batch, partition_key), = client.container_client.batches
+    assert partition_key == "u1"
+    assert [operation for operation, _ in batch] == ["upsert", "upsert", "patch"]
+    assert batch[2][1] == (
+        "c1",
+        [{"op": "set", "path": "/updatedAt", "value": messages[-1]["createdAt"]}],
+    )
+    assert client.stats()["request_units_per_message"] == 6.25
+
+
+@pytest.mark.asyncio
+async def test_create_messages_with_a_new_conversation():
+    client = make_client()
+    conversation = client.conversation_document("u1", "Title", "c1", "2024-01-01T00:00:00")
+    messages = await client.create_messages(
+        "c1", "u1", [("m1", {"role": "user", "content": "hello"})], conversation=conversation
+    )
+
+    (batch, _), = client.container_client.batches
+    assert [operation for operation, _ in batch] == ["upsert", "upsert"]
+    assert batch[0][1][0]["id"] == "c1"
+    assert batch[0][1][0]["updatedAt"] == messages[0]["createdAt"]
+    assert batch[1][1][0]["conversationId"] == "c1"
+
+
+class FakeItems:
+    def __init__(self, items):
+        self.items = items
+        self.conflicts = 0
+
+    async def read_item(self, item, partition_key, response_hook=None):
+        if (partition_key, item) not in self.items:
+            raise exceptions.CosmosResourceNotFoundError(status_code=404)
+        return dict(self.items[(partition_key, item)])
+
+    async def replace_item(self, item, body, etag, match_condition, response_hook=None):
+        if self.conflicts:
+            # Another write lands between the read and the replace
+            self.conflicts -= 1
+            self.items[(body["userId"], item)]["_etag"] += "'"
+        if self.items[(body["userId"], item)]["_etag"] != etag:
+            raise exceptions.CosmosAccessConditionFailedError(status_code=412)
+        self.items[(body["userId"], item)] = {**body, "_etag": etag + "+"}
+        return self.items[(body["userId"], item)]
+
+
+@pytest.mark.asyncio
+async def test_update_message_feedback_retries_on_etag_conflict():
+    client = make_client()
+    client.container_client = FakeItems(
+        {("u1", "m1"): {"id": "m1", "type": "message", "userId": "u1", "_etag": "1"}}
+    )
+    client.container_client.conflicts = 1
+
+    message = await client.update_message_feedback("u1", "m1", "positive")
+
+    assert message["feedback"] == "positive"
+    assert await client.update_message_feedback("u2", "m1", "positive") is False
+    assert await client.get_conversation("u1", "m1") is None
+
+
+class FakePages:
+    def __init__(self, pages, token):
+        self.pages = pages
+        self.continuation_token = None
+        self.token = token
+
+    async def __aiter__(self):
+        for page in self.pages:
+            # The token of the next page is known once a page is fetched
+            self.continuation_token = self.token
+
+            async def items(page=page):
+                for item in page:
+                    yield item
+
+            yield items()
+
+
+class FakeQuery:
+    def __init__(self):
+        self.calls = []
+
+    def query_items(self, query, parameters, partition_key, max_item_count):
+        self.calls.append((partition_key, max_item_count))
+        return self
+
+    def by_page(self, continuation_token):
+        self.calls.append(continuation_token)
+        return FakePages([[{"id": "c1"}, {"id": "c2"}], [{"id": "c3"}]], '{"token": 1}')
+
+
+@pytest.mark.asyncio
+async def test_conversation_pages_use_opaque_continuation_tokens():
+    client = make_client()
+    client.container_client = FakeQuery()
+
+    conversations, cursor = await client.get_conversations_page("u1", page_size=2)
+    assert [c["id"] for c in conversations] == ["c1", "c2"]
+    assert cursor and "{" not in cursor
+
+    await client.get_conversations_page("u1", page_size=2, cursor=cursor)
+    assert client.container_client.calls == [("u1", 2), None, ("u1", 2), '{"token": 1}']
+
+    with pytest.raises(InvalidContinuationTokenError):
+        await client.get_conversations_page("u1", page_size=2, cursor="%%%")
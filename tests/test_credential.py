@@ -0,0 +1,54 @@
+import time
+import pytest
+from azure.core.credentials import AccessToken
+from backend.credential import CredentialManager
+
+
+class FakeCredential:
+    def __init__(self, lifetime=3600):
+        self.lifetime = lifetime
+        self.calls = 0
+
+    async def get_token(self, *scopes, **kwargs):
+        self.calls += 1
+        return AccessToken(f"token-{self.calls}", int(time.time()) + self.lifetime)
+
+    async def close(self):
+        pass
+
+
+@pytest.mark.asyncio
+async def test_get_token_is_cached_per_scope():
+    credential = FakeCredential()
+    manager = CredentialManager(credential)
+
+    first = await manager.get_token("scope-a")
+    second = await manager.get_token("scope-a")
+    other = await manager.get_token("scope-b")
+
+    assert first.token == second.token
+    assert other.token != first.token
+    assert credential.calls == 2
+    assert manager.stats()["cache_hits"] == 1
+    assert manager.stats()["acquisitions"] == 2
+
+
+@pytest.mark.asyncio
+async def test_refresh_renews_expiring_tokens():
+    credential = FakeCredential(lifetime=60)
+    manager = CredentialManager(credential, refresh_margin=300)
+
+    token = await manager.get_token("scope-a")
+    await manager.refresh()
+    refreshed = await manager.get_token("scope-a")
+
+    assert refreshed.token != token.token
+    assert credential.calls == 2
+
+
+@pytest.mark.asyncio
+async def test_bearer_token_provider():
+    manager = CredentialManager(FakeCredential())
+    provider = manager.get_bearer_token_provider("scope-a")
+
+    assert await provider() == "token-1"
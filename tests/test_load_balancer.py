@@ -0,0 +1,226 @@
+import asyncio
+import json
+import httpx
+import pytest
+from openai import AsyncAzureOpenAI, RateLimitError
+from backend.load_balancer import Backend, BackendPool, NoBackendAvailableError
+from backend.scheduler import PriorityScheduler
+
+COMPLETION = {
+    "id": "chatcmpl-mock",
+    "object": "chat.completion",
+    "created": 0,
+    "model": "mock",
+    "choices": [
+        {"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "pong"}}
+    ],
+}
+
+
+def mock_backend(name, responses, weight=1.0, delay=0):
+    # responses is a list of (status, headers) served in order, then 200s
+    requests = []
+
+    async def handler(request):
+        requests.append(request)
+        await asyncio.sleep(delay)
+        status, headers = responses.pop(0) if responses else (200, {})
+        body = COMPLETION if status == 200 else {"error": {"message": name}}
+        return httpx.Response(status, json=body, headers=headers)
+
+    client = AsyncAzureOpenAI(
+        api_key="key",
+        api_version="2024-02-15-preview",
+        azure_endpoint=f"https://{name}.openai.azure.com",
+        http_client=httpx.AsyncClient(transport=httpx.MockTransport(handler)),
+        max_retries=0,
+    )
+    return Backend(name, client, f"{name}-deployment", weight), requests
+
+
+def call(backend):
+    return backend.client.chat.completions.create(
+        model=backend.deployment, messages=[{"role": "user", "content": "ping"}]
+    )
+
+
+@pytest.mark.asyncio
+async def test_throttled_backend_cools_down_for_its_retry_after():
+    east, east_requests = mock_backend("east", [(429, {"retry-after": "60"})], weight=10)
+    west, west_requests = mock_backend("west", [])
+    pool = BackendPool([east, west])
+
+    for _ in range(3):
+        response = await pool.call(call)
+        assert response.choices[0].message.content == "pong"
+
+    assert len(east_requests) == 1 and len(west_requests) == 3
+    assert "west-deployment" in str(west_requests[0].url)
+    assert pool.stats()[0]["state"] == "cooling_down"
+
+
+@pytest.mark.asyncio
+async def test_circuit_opens_after_repeated_failures_and_closes_after_a_trial(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr("backend.load_balancer.time.monotonic", lambda: now[0])
+    east, east_requests = mock_backend("east", [(500, {}), (500, {})], weight=10)
+    west, _ = mock_backend("west", [])
+    pool = BackendPool([east, west], failure_threshold=2, open_seconds=30)
+    west.latency = 1.0
+
+    await pool.call(call)
+    await pool.call(call)
+    assert east.state(now[0]) == "open"
+
+    await pool.call(call)
+    assert len(east_requests) == 2
+
+    now[0] = 31
+    assert east.state(now[0]) == "half_open"
+    west.latency = 1.0
+    await pool.call(call)
+    assert len(east_requests) == 3
+    assert east.state(now[0]) == "closed"
+
+
+@pytest.mark.asyncio
+async def test_least_outstanding_backend_is_selected():
+    east, _ = mock_backend("east", [])
+    west, _ = mock_backend("west", [])
+    pool = BackendPool([east, west])
+
+    east.outstanding = 2
+    assert pool.select() is west
+
+    # a heavier backend takes proportionally more outstanding requests
+    west.weight = 4
+    west.outstanding = 9
+    assert pool.select() is west
+    west.outstanding = 12
+    assert pool.select() is east
+
+
+@pytest.mark.asyncio
+async def test_errors_when_every_backend_is_throttled():
+    east, _ = mock_backend("east", [(429, {"retry-after": "5"})])
+    pool = BackendPool([east])
+
+    with pytest.raises(RateLimitError):
+        await pool.call(call)
+    with pytest.raises(NoBackendAvailableError) as error:
+        await pool.call(call)
+    assert 0 < error.value.retry_after <= 5
+
+
+@pytest.mark.asyncio
+async def test_slow_calls_are_hedged_to_another_backend():
+    east, east_requests = mock_backend("east", [], weight=10, delay=1)
+    west, west_requests = mock_backend("west", [])
+    pool = BackendPool([east, west])
+    pool.completion_latencies.extend([0.01] * 20)
+
+    response = await pool.hedged_call(call, percentile=95, min_samples=20)
+
+    assert response.choices[0].message.content == "pong"
+    assert len(east_requests) == 1 and len(west_requests) == 1
+    assert east.outstanding == 0
+    assert pool.hedging_stats() == {
+        "calls": 1, "hedged": 1, "hedge_wins": 1, "hedge_rate": 1.0, "win_rate": 1.0
+    }
+
+
+@pytest.mark.asyncio
+async def test_calls_are_not_hedged_without_enough_samples_or_budget():
+    east, _ = mock_backend("east", [], weight=10, delay=0.05)
+    west, west_requests = mock_backend("west", [])
+    pool = BackendPool([east, west])
+
+    await pool.hedged_call(call, min_samples=20)
+    pool.completion_latencies.extend([0.01] * 20)
+    await pool.hedged_call(call, min_samples=20, allow_hedge=lambda: False)
+
+    assert west_requests == []
+    assert pool.hedge_stats["hedged"] == 0
+
+
+@pytest.mark.asyncio
+async def test_failed_hedged_call_raises_the_backend_error():
+    east, _ = mock_backend("east", [(429, {"retry-after": "5"})])
+    pool = BackendPool([east])
+
+    with pytest.raises(RateLimitError):
+        await pool.hedged_call(call, min_samples=0)
+    with pytest.raises(NoBackendAvailableError):
+        await pool.hedged_call(call, min_samples=0)
+
+
+@pytest.mark.asyncio
+async def test_hedge_budget_is_only_asked_when_a_hedge_can_be_sent():
+    east, _ = mock_backend("east", [], delay=0.05)
+    pool = BackendPool([east])
+    pool.completion_latencies.extend([0.01] * 20)
+    asked = []
+
+    await pool.hedged_call(call, min_samples=20, allow_hedge=lambda: asked.append(True) or True)
+
+    assert asked == []
+
+
+def streaming_backend(name):
+    async def body():
+        chunk = {**COMPLETION, "object": "chat.completion.chunk", "choices": [
+            {"index": 0, "finish_reason": None, "delta": {"role": "assistant", "content": "pong"}}
+        ]}
+        yield f"data: {json.dumps(chunk)}\n\n".encode()
+        yield b"data: [DONE]\n\n"
+
+    async def handler(request):
+        return httpx.Response(200, content=body(), headers={"content-type": "text/event-stream"})
+
+    client = AsyncAzureOpenAI(
+        api_key="key",
+        api_version="2024-02-15-preview",
+        azure_endpoint=f"https://{name}.openai.azure.com",
+        http_client=httpx.AsyncClient(transport=httpx.MockTransport(handler)),
+        max_retries=0,
+    )
+    return Backend(name, client, f"{name}-deployment")
+
+
+def stream(backend):
+    return backend.client.chat.completions.with_raw_response.create(
+        model=backend.deployment, messages=[{"role": "user", "content": "ping"}], stream=True
+    )
+
+
+@pytest.mark.asyncio
+async def test_streamed_calls_stay_outstanding_until_the_stream_ends():
+    east = streaming_backend("east")
+    pool = BackendPool([east])
+
+    raw_response = await pool.call(stream)
+    assert east.outstanding == 1
+
+    chunks = [chunk async for chunk in raw_response.parse()]
+    assert chunks[0].choices[0].delta.content == "pong"
+    assert east.outstanding == 0
+
+    raw_response = await pool.call(stream)
+    await raw_response.parse().response.aclose()
+    assert east.outstanding == 0
+
+
+@pytest.mark.asyncio
+async def test_streamed_calls_hold_their_scheduler_slot_until_closed():
+    east = streaming_backend("east")
+    scheduler = PriorityScheduler(initial_limit=4)
+    pool = BackendPool([east], scheduler=scheduler)
+
+    raw_response = await pool.call(stream)
+    assert scheduler.in_flight == 1
+    # Latency is still recorded when the headers arrive
+    assert scheduler.limit > 4
+
+    await raw_response.parse().response.aclose()
+    assert scheduler.in_flight == 0
+    assert east.outstanding == 0
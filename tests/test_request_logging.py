@@ -0,0 +1,52 @@
+import json
+import logging
+from backend.request_logging import LazyModelArgs, log_model_args, redact_model_args
+
+
+MODEL_ARGS = {
+    "messages": [{"role": "user", "content": "hello"}],
+    "extra_body": {
+        "data_sources": [
+            {
+                "type": "azure_search",
+                "parameters": {
+                    "index_name": "index",
+                    "authentication": {"type": "api_key", "api_key": "secret"},
+                    "embedding_dependency": {
+                        "type": "endpoint",
+                        "authentication": {"type": "api_key", "key": "secret"},
+                    },
+                },
+            }
+        ]
+    },
+}
+
+
+def test_redact_model_args_masks_secrets_without_mutating():
+    redacted = redact_model_args(MODEL_ARGS)
+    parameters = redacted["extra_body"]["data_sources"][0]["parameters"]
+
+    assert parameters["authentication"]["api_key"] == "*****"
+    assert parameters["embedding_dependency"]["authentication"]["key"] == "*****"
+    assert parameters["index_name"] == "index"
+    assert redacted["messages"] is MODEL_ARGS["messages"]
+
+    original = MODEL_ARGS["extra_body"]["data_sources"][0]["parameters"]
+    assert original["authentication"]["api_key"] == "secret"
+    assert original["embedding_dependency"]["authentication"]["key"] == "secret"
+
+
+def test_lazy_model_args_serializes_on_demand():
+    logged = json.loads(str(LazyModelArgs(MODEL_ARGS)))
+    assert "secret" not in json.dumps(logged)
+
+
+def test_log_model_args_skipped_when_debug_disabled(monkeypatch):
+    def fail(*args, **kwargs):
+        raise AssertionError("model args should not be serialized")
+
+    monkeypatch.setattr(LazyModelArgs, "__str__", fail)
+    root = logging.getLogger()
+    monkeypatch.setattr(root, "level", logging.INFO)
+    log_model_args(MODEL_ARGS)
@@ -0,0 +1,94 @@
+import pytest
+from types import SimpleNamespace
+from backend.response_cache import (
+    CachedAnswer,
+    RecordingStream,
+    ReplayStream,
+    ResponseCache,
+    make_cache_key,
+)
+from backend.utils import format_stream_response
+
+
+def model_args(content, filter=None):
+    return {
+        "messages": [{"role": "user", "content": content}],
+        "temperature": 0,
+        "stream": True,
+        "extra_body": {
+            "data_sources": [
+                {"type": "azure_search", "parameters": {"index_name": "docs", "filter": filter}}
+            ]
+        },
+    }
+
+
+def test_cache_key_normalizes_messages_and_separates_filters():
+    key = make_cache_key(model_args("What is  the VPN?", "group_ids/any(g:search.in(g, 'a'))"))
+
+    assert key == make_cache_key(model_args(" What is the VPN? ", "group_ids/any(g:search.in(g, 'a'))"))
+    assert key != make_cache_key(model_args("What is the VPN?", "group_ids/any(g:search.in(g, 'b'))"))
+    assert key != make_cache_key(model_args("What is the VPN?"))
+
+
+def test_cache_evicts_least_recently_used_and_expired(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr("backend.response_cache.time.monotonic", lambda: now[0])
+    cache = ResponseCache(max_entries=2, ttl=10)
+    answer = CachedAnswer(model="gpt", object="chat.completion", content="hi")
+
+    cache.put("a", answer)
+    cache.put("b", answer)
+    cache.get("a")
+    cache.put("c", answer)
+
+    assert cache.get("b") is None
+    assert cache.get("a") is answer
+
+    now[0] = 11
+    assert cache.get("c") is None
+    assert cache.stats == {"hits": 2, "misses": 2, "stores": 3}
+
+
+def chunk(delta):
+    return SimpleNamespace(
+        id="chatcmpl-live",
+        model="gpt",
+        created=1,
+        object="chat.completion.chunk",
+        choices=[SimpleNamespace(index=0, delta=delta)],
+    )
+
+
+class FakeStream:
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.response = None
+
+    async def __aiter__(self):
+        for c in self.chunks:
+            yield c
+
+
+@pytest.mark.asyncio
+async def test_recorded_answer_replays_in_the_stream_format():
+    context = SimpleNamespace(role="assistant", content=None, context={"citations": [{"title": "doc"}]})
+    chunks = [
+        chunk(context),
+        chunk(SimpleNamespace(role="assistant", content="Hello")),
+        chunk(SimpleNamespace(role="assistant", content=" world")),
+    ]
+    recorded = []
+    live = [c async for c in RecordingStream(FakeStream(chunks), recorded.append)]
+
+    assert recorded[0].content == "Hello world"
+    assert recorded[0].context == {"citations": [{"title": "doc"}]}
+
+    replayed = [
+        format_stream_response(c, {}, None) async for c in ReplayStream(recorded[0])
+    ]
+    live = [format_stream_response(c, {}, None) for c in live]
+
+    assert replayed[0]["choices"][0]["messages"] == live[0]["choices"][0]["messages"]
+    assert replayed[1]["choices"][0]["messages"][0]["content"] == "Hello world"
+    assert replayed[0]["id"] != "chatcmpl-live"
@@ -0,0 +1,65 @@
+import asyncio
+import pytest
+from backend.scheduler import (
+    BULK,
+    INTERACTIVE,
+    PriorityScheduler,
+    SchedulerRejectedError,
+)
+
+
+@pytest.mark.asyncio
+async def test_waiting_calls_get_slots_in_priority_order():
+    scheduler = PriorityScheduler(initial_limit=1)
+    order = []
+
+    async def run(name, priority):
+        async with scheduler.slot(priority):
+            order.append(name)
+
+    await scheduler.acquire(INTERACTIVE)
+    bulk = asyncio.create_task(run("bulk", BULK))
+    interactive = asyncio.create_task(run("interactive", INTERACTIVE))
+    await asyncio.sleep(0)
+    assert scheduler.waiting() == 2
+
+    scheduler.release()
+    await asyncio.gather(bulk, interactive)
+    assert order == ["interactive", "bulk"]
+    assert scheduler.in_flight == 0
+
+
+def test_limit_grows_additively_and_backs_off_on_throttling():
+    scheduler = PriorityScheduler(initial_limit=4, latency_target=10)
+    for _ in range(4):
+        scheduler.record(latency=1)
+    assert scheduler.limit == pytest.approx(4.9, abs=0.05)
+
+    scheduler.record(throttled=True)
+    assert scheduler.limit == pytest.approx(2.45, abs=0.05)
+    # one cut per latency target, however many calls were throttled
+    scheduler.record(throttled=True)
+    assert scheduler.stats["decreases"] == 1
+
+
+@pytest.mark.asyncio
+async def test_bulk_work_leaves_headroom_and_is_shed_first(monkeypatch):
+    monkeypatch.setattr("backend.scheduler.CLASS_QUEUE_LIMITS", {INTERACTIVE: 2, BULK: 1})
+    scheduler = PriorityScheduler(initial_limit=4, max_wait=0.05)
+
+    await scheduler.acquire(BULK)
+    await scheduler.acquire(BULK)
+    # bulk calls may only fill half of the limit
+    waiting_bulk = asyncio.create_task(scheduler.acquire(BULK))
+    await asyncio.sleep(0)
+    with pytest.raises(SchedulerRejectedError):
+        await scheduler.acquire(BULK)
+
+    # interactive calls still get the remaining slots right away
+    await scheduler.acquire(INTERACTIVE)
+    await scheduler.acquire(INTERACTIVE)
+    assert scheduler.in_flight == 4
+
+    with pytest.raises(SchedulerRejectedError):
+        await waiting_bulk
+    assert scheduler.stats["shed"]["bulk"] == 2
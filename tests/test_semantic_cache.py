@@ -0,0 +1,54 @@
+import pytest
+import numpy as np
+from backend.response_cache import CachedAnswer
+from backend.semantic_cache import SemanticCache
+
+VOCABULARY = ["how", "do", "i", "reset", "my", "password", "vpn", "connect", "to", "the"]
+
+
+async def embed(text):
+    # bag of words stand-in for the embedding deployment
+    words = text.lower().replace("?", "").split()
+    return [float(words.count(word)) for word in VOCABULARY]
+
+
+def answer(content):
+    return CachedAnswer(model="gpt", object="chat.completion", content=content)
+
+
+@pytest.mark.asyncio
+async def test_paraphrase_hits_only_within_its_partition():
+    cache = SemanticCache(embed, threshold=0.8)
+    cache.put("group-a", await cache.embed_question("How do I reset my password?"), answer("a"))
+
+    paraphrase = await cache.embed_question("how do i reset the password")
+    assert cache.get("group-a", paraphrase).content == "a"
+    assert cache.get("group-b", paraphrase) is None
+    assert cache.get("group-a", await cache.embed_question("connect to the vpn")) is None
+    assert cache.stats["hits"] == 1 and cache.stats["misses"] == 2
+
+
+@pytest.mark.asyncio
+async def test_partitions_are_size_bounded():
+    cache = SemanticCache(embed, threshold=0.99, partition_size=2, max_partitions=2)
+    questions = ["reset password", "connect vpn", "reset vpn"]
+    for question in questions:
+        cache.put("group-a", await cache.embed_question(question), answer(question))
+
+    assert cache.entries() == 2
+    assert cache.get("group-a", await cache.embed_question("reset password")) is None
+    assert cache.get("group-a", await cache.embed_question("reset vpn")).content == "reset vpn"
+
+    cache.put("group-b", np.ones(len(VOCABULARY), dtype=np.float32), answer("b"))
+    cache.put("group-c", np.ones(len(VOCABULARY), dtype=np.float32), answer("c"))
+    assert list(cache.partitions) == ["group-b", "group-c"]
+
+
+@pytest.mark.asyncio
+async def test_embedding_failure_skips_the_cache():
+    async def failing_embed(text):
+        raise RuntimeError("throttled")
+
+    cache = SemanticCache(failing_embed)
+    assert await cache.embed_question("reset password") is None
+    assert cache.stats["embedding_failures"] == 1
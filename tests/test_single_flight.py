@@ -0,0 +1,105 @@
+import asyncio
+import pytest
+from types import SimpleNamespace
+from backend.single_flight import SingleFlight
+
+
+class FakeUpstream:
+    def __init__(self, count):
+        self.count = count
+        self.release = asyncio.Event()
+        self.closed = False
+        self.response = self
+
+    async def __aiter__(self):
+        for i in range(self.count):
+            if i == 1:
+                # hold the stream open until the test lets it continue
+                await self.release.wait()
+            yield SimpleNamespace(id="chatcmpl-upstream", content=str(i))
+
+    async def aclose(self):
+        self.closed = True
+
+
+def starter(upstream, calls):
+    async def start():
+        calls.append(1)
+        return upstream, "apim-1"
+
+    return start
+
+
+async def read(subscription):
+    return [chunk async for chunk in subscription]
+
+
+@pytest.mark.asyncio
+async def test_concurrent_streams_share_one_upstream_call():
+    group = SingleFlight()
+    upstream = FakeUpstream(3)
+    calls = []
+
+    leader, apim_request_id = await group.stream("key", starter(upstream, calls))
+    follower, _ = await group.stream("key", starter(upstream, calls))
+    readers = [asyncio.create_task(read(leader)), asyncio.create_task(read(follower))]
+    upstream.release.set()
+    leader_chunks, follower_chunks = await asyncio.gather(*readers)
+
+    assert calls == [1] and apim_request_id == "apim-1"
+    assert [c.content for c in leader_chunks] == ["0", "1", "2"]
+    assert [c.content for c in follower_chunks] == ["0", "1", "2"]
+    assert leader_chunks[0].id == "chatcmpl-upstream"
+    assert follower_chunks[0].id != "chatcmpl-upstream"
+    assert group.flights == {} and group.stats == {"leaders": 1, "followers": 1}
+
+
+@pytest.mark.asyncio
+async def test_followers_keep_streaming_when_the_leader_disconnects():
+    group = SingleFlight()
+    upstream = FakeUpstream(3)
+
+    leader, _ = await group.stream("key", starter(upstream, []))
+    follower, _ = await group.stream("key", starter(upstream, []))
+    follower_reader = asyncio.create_task(read(follower))
+    await asyncio.sleep(0)
+
+    await leader.aclose()
+    upstream.release.set()
+
+    assert [c.content for c in await follower_reader] == ["0", "1", "2"]
+
+
+@pytest.mark.asyncio
+async def test_upstream_is_closed_when_every_subscriber_leaves():
+    group = SingleFlight()
+    upstream = FakeUpstream(3)
+
+    leader, _ = await group.stream("key", starter(upstream, []))
+    follower, _ = await group.stream("key", starter(upstream, []))
+    await asyncio.sleep(0)
+    # Only the last subscriber to leave stops the completion
+    assert await leader.aclose() is False
+    assert await follower.aclose() is True
+    await asyncio.sleep(0)
+
+    assert upstream.closed
+    assert group.flights == {}
+
+
+@pytest.mark.asyncio
+async def test_concurrent_completions_share_one_upstream_call():
+    group = SingleFlight()
+    calls = []
+
+    async def start():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return SimpleNamespace(id="chatcmpl-upstream"), "apim-1"
+
+    results = await asyncio.gather(group.complete("key", start), group.complete("key", start))
+
+    assert calls == [1]
+    assert results[0][0].id == "chatcmpl-upstream"
+    assert results[1][0].id != "chatcmpl-upstream"
+    assert group.tasks == {}
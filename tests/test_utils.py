@@ -1,3 +1,4 @@
+import httpx
 import pytest
 from backend.utils import format_as_ndjson, parse_multi_columns
 
@@ -27,3 +28,203 @@ def test_parse_multi_columns():
     assert parse_multi_columns(test_pipes) == ["col1", "col2", "col3"]
     assert parse_multi_columns(test_commas) == ["col1", "col2", "col3"]
     assert parse_multi_columns(test_single) == ["col1"]
+
+
+@pytest.mark.asyncio
+async def test_fetch_user_groups_follows_next_link_and_caches(monkeypatch):
+    from backend import utils
+
+    requests_made = []
+
+    def handler(request):
+        requests_made.append(str(request.url))
+        if "page2" in str(request.url):
+            return httpx.Response(200, json={"value": [{"id": "group2"}]})
+        return httpx.Response(
+            200,
+            json={
+                "value": [{"id": "group1"}],
+                "@odata.nextLink": "https://graph.microsoft.com/v1.0/page2",
+            },
+        )
+
+    monkeypatch.setattr(
+        utils, "graph_client", httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    )
+    monkeypatch.setattr(utils, "user_groups_cache", utils.OrderedDict())
+
+    groups = await utils.fetchUserGroups("token", "user1")
+    assert groups == [{"id": "group1"}, {"id": "group2"}]
+    assert len(requests_made) == 2
+
+    groups = await utils.fetchUserGroups("token", "user1")
+    assert groups == [{"id": "group1"}, {"id": "group2"}]
+    assert len(requests_made) == 2
+
+
+@pytest.mark.asyncio
+async def test_fetch_user_groups_error_is_not_cached(monkeypatch):
+    from backend import utils
+
+    def handler(request):
+        return httpx.Response(401, text="unauthorized")
+
+    monkeypatch.setattr(
+        utils, "graph_client", httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    )
+    monkeypatch.setattr(utils, "user_groups_cache", utils.OrderedDict())
+
+    assert await utils.fetchUserGroups("token", "user1") == []
+    assert "user1" not in utils.user_groups_cache
+
+
+def test_compile_filter_string_is_shared_across_group_order(monkeypatch):
+    from backend import utils
+
+    monkeypatch.setattr(utils, "AZURE_SEARCH_PERMITTED_GROUPS_COLUMN", "group_ids")
+    monkeypatch.setattr(utils, "filter_cache", utils.OrderedDict())
+    monkeypatch.setattr(utils, "filter_cache_stats", {"hits": 0, "misses": 0})
+
+    first = utils.compileFilterString(["b", "a"])
+    second = utils.compileFilterString(["a", "b", "a"])
+
+    assert first == "group_ids/any(g:search.in(g, 'a, b'))"
+    assert second == first
+    assert utils.filter_cache_stats == {"hits": 1, "misses": 1}
+
+
+def make_chunk(content=None, context=None):
+    from types import SimpleNamespace
+
+    delta = SimpleNamespace(role="assistant", content=content)
+    if context is not None:
+        delta.context = context
+    return SimpleNamespace(
+        id="chunk-id",
+        model="gpt",
+        created=1,
+        object="chat.completion.chunk",
+        choices=[SimpleNamespace(delta=delta)],
+    )
+
+
+def test_compact_stream_frames():
+    from backend.utils import (
+        fast_dumps,
+        format_stream_delta,
+        format_stream_header,
+        format_stream_response,
+    )
+
+    header = format_stream_header(make_chunk("hi"), {"conversation_id": "c1"}, "apim")
+    assert header["h"]["id"] == "chunk-id"
+    assert header["h"]["history_metadata"] == {"conversation_id": "c1"}
+    assert header["h"]["apim-request-id"] == "apim"
+
+    assert format_stream_delta(make_chunk("hi")) == {"c": "hi"}
+    assert format_stream_delta(make_chunk(context={"citations": []})) == {
+        "m": {"role": "tool", "content": '{"citations": []}'}
+    }
+    assert format_stream_delta(make_chunk()) is None
+
+    full = format_stream_response(make_chunk("hi"), {}, "apim")
+    assert len(fast_dumps(format_stream_delta(make_chunk("hi")))) < len(fast_dumps(full))
+
+
+def test_compact_stream_header_waits_for_completion_chunk():
+    from types import SimpleNamespace
+
+    from backend.utils import format_compact_stream_frames
+
+    prompt_filter = SimpleNamespace(
+        id="", model="", created=0, object="", choices=[], prompt_filter_results=[]
+    )
+    frames, header_id = format_compact_stream_frames(prompt_filter, None, {}, "apim")
+    assert frames == []
+    assert header_id is None
+
+    frames, header_id = format_compact_stream_frames(make_chunk("hi"), header_id, {}, "apim")
+    assert frames[0]["h"]["id"] == "chunk-id"
+    assert frames[0]["h"]["model"] == "gpt"
+    assert frames[1] == {"c": "hi"}
+
+    frames, header_id = format_compact_stream_frames(make_chunk("!"), header_id, {}, "apim")
+    assert frames == [{"c": "!"}]
+
+    next_completion = make_chunk("again")
+    next_completion.id = "other-id"
+    frames, header_id = format_compact_stream_frames(next_completion, header_id, {}, "apim")
+    assert frames[0]["h"]["id"] == "other-id"
+    assert header_id == "other-id"
+
+
+@pytest.mark.asyncio
+async def test_coalesce_stream_events_batches_content():
+    import asyncio
+    from backend.utils import coalesce_stream_events
+
+    async def events():
+        yield {"m": {"role": "tool", "content": "citations"}}
+        yield {"c": "a"}
+        yield {"c": "b"}
+        yield {"c": "c"}
+        await asyncio.sleep(0.05)
+        yield {"c": "d"}
+        yield {}
+        yield {"c": "e"}
+
+    result = [event async for event in coalesce_stream_events(events(), 20, 1024)]
+    assert result == [
+        {"m": {"role": "tool", "content": "citations"}},
+        {"c": "a"},
+        {"c": "bc"},
+        {"c": "de"},
+    ]
+
+
+@pytest.mark.asyncio
+async def test_coalesce_stream_events_flushes_on_size_and_error():
+    from backend.utils import coalesce_stream_events
+
+    async def events():
+        yield {"choices": [{"messages": [{"role": "assistant", "content": "a"}]}]}
+        yield {"choices": [{"messages": [{"role": "assistant", "content": "bb"}]}]}
+        yield {"choices": [{"messages": [{"role": "assistant", "content": "cc"}]}]}
+        yield {"choices": [{"messages": [{"role": "assistant", "content": "d"}]}]}
+        raise Exception("upstream failed")
+
+    result = []
+    with pytest.raises(Exception, match="upstream failed"):
+        async for event in coalesce_stream_events(events(), 1000, 4):
+            result.append(event["choices"][0]["messages"][0]["content"])
+    assert result == ["a", "bbcc", "d"]
+
+
+@pytest.mark.asyncio
+async def test_closing_the_stream_closes_its_source():
+    from backend.utils import coalesce_stream_events
+
+    closed = []
+
+    async def events():
+        try:
+            for i in range(10):
+                yield {"c": str(i)}
+        finally:
+            closed.append(True)
+
+    stream = format_as_ndjson(coalesce_stream_events(events(), 20, 1024))
+    assert await stream.__anext__() == '{"c": "0"}\n'
+    await stream.aclose()
+    assert closed == [True]
+
+
+def test_heuristic_title():
+    from backend.utils import heuristic_title
+
+    messages = [
+        {"role": "user", "content": "How do I reset my password for the VPN portal?"},
+    ]
+    assert heuristic_title(messages) == "How do I reset my password"
+    assert heuristic_title([{"role": "user", "content": "Hello!"}]) == "Hello"
+    assert heuristic_title([{"role": "user", "content": "  "}]) == "New chat"
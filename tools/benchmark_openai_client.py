@@ -0,0 +1,110 @@
+import os
+import sys
+import time
+import asyncio
+import argparse
+
+from aiohttp import web
+
+# Add parent directory to sys.path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+"""
+Measure the per-request overhead of building a new Azure OpenAI client on every
+request versus reusing the pooled, app-lifetime client.
+
+Both modes call a local mock chat completions endpoint, so the numbers only
+reflect client construction and connection setup, not model latency.
+
+usage: python tools/benchmark_openai_client.py --requests 200
+"""
+
+MOCK_COMPLETION = {
+    "id": "chatcmpl-mock",
+    "object": "chat.completion",
+    "created": 0,
+    "model": "mock",
+    "choices": [
+        {
+            "index": 0,
+            "finish_reason": "stop",
+            "message": {"role": "assistant", "content": "pong"},
+        }
+    ],
+    "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+}
+
+
+async def mock_chat_completions(request):
+    return web.json_response(MOCK_COMPLETION, headers={"apim-request-id": "mock"})
+
+
+async def start_mock_server(port):
+    mock_app = web.Application()
+    mock_app.router.add_post(
+        "/openai/deployments/{deployment}/chat/completions", mock_chat_completions
+    )
+    runner = web.AppRunner(mock_app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", port)
+    await site.start()
+    return runner
+
+
+async def call(client):
+    await client.chat.completions.create(
+        model=app.AZURE_OPENAI_MODEL,
+        messages=[{"role": "user", "content": "ping"}],
+    )
+
+
+async def run_per_request(n):
+    start = time.perf_counter()
+    for _ in range(n):
+        client = app.init_openai_client()
+        await call(client)
+        await client.close()
+    return time.perf_counter() - start
+
+
+async def run_pooled(n):
+    client = app.init_openai_client()
+    start = time.perf_counter()
+    for _ in range(n):
+        await call(client)
+    elapsed = time.perf_counter() - start
+    await client.close()
+    return elapsed
+
+
+async def main(n, port):
+    runner = await start_mock_server(port)
+    try:
+        # warm up imports and the mock server
+        await run_pooled(5)
+
+        per_request = await run_per_request(n)
+        pooled = await run_pooled(n)
+    finally:
+        await runner.cleanup()
+
+    print(f"requests:            {n}")
+    print(f"client per request:  {per_request / n * 1000:.2f} ms/request")
+    print(f"pooled client:       {pooled / n * 1000:.2f} ms/request")
+    print(f"saved per request:   {(per_request - pooled) / n * 1000:.2f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--port", type=int, default=18080)
+    args = parser.parse_args()
+
+    # point the app at the mock endpoint before its settings are read
+    os.environ["AZURE_OPENAI_ENDPOINT"] = f"http://127.0.0.1:{args.port}"
+    os.environ["AZURE_OPENAI_KEY"] = "mock-key"
+    os.environ["AZURE_OPENAI_MODEL"] = "mock"
+
+    import app
+
+    asyncio.run(main(args.requests, args.port))
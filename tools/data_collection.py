@@ -12,6 +12,7 @@ from dotenv import load_dotenv
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 import app
+from backend.scheduler import BULK
 
 #function to enable loading of the .env file into the global variables of the app.py module
 
@@ -58,7 +59,7 @@ async def process(data: list, file):
 
           request = {"messages":messages, "id":"1"}
 
-          response = await app.complete_chat_request(request)
+          response = await app.complete_chat_request(request, priority=BULK)
 
           #print(json.dumps(response))
 